@@ -1,18 +1,27 @@
 import datetime
+import hashlib
 import json
 import os
-import math 
+import threading
+import time
+from formula_engine import FormulaError, compile_formula
+from normalization_worker import INGEST_FIELDS
 
 # --- CONFIGURATION FILE PATH ---
 CONFIG_FILE_PATH = 'metrics_config.json'
 
 # --- Internal Constants for Simplicity ---
-# Define required input keys and their defaults for safety
+# Fallback defaults for formula inputs that are missing from both the payload
+# and the "inputs" section of the configuration
 DEFAULT_INPUTS = {
-    "total_lines": 1, 
-    "covered_lines": 0, 
-    "pipelineDurationMs": 0 
+    "total_lines": 1,
+    "covered_lines": 0,
+    "pipelineDurationMs": 0
 }
+# Fixed rounding applied to every metric value
+ROUND_DIGITS = 2
+# How often the config watcher stats metrics_config.json for changes
+CONFIG_POLL_INTERVAL_S = float(os.getenv('CONFIG_POLL_INTERVAL_S', 1.0))
 # ------------------------------------------
 
 def load_config():
@@ -21,12 +30,12 @@ def load_config():
         # Check if the file exists before trying to open it
         if not os.path.exists(CONFIG_FILE_PATH):
             raise FileNotFoundError(f"Config file not found: {CONFIG_FILE_PATH}")
-            
+
         with open(CONFIG_FILE_PATH, 'r') as f:
             config = json.load(f)
         print(f"[CONFIG] Configuration loaded from {CONFIG_FILE_PATH}.")
         return config
-        
+
     except FileNotFoundError as e:
         print(f"[CONFIG ERROR] {e}. Cannot start aggregation service.")
         return None
@@ -34,100 +43,297 @@ def load_config():
         print(f"[CONFIG ERROR] Failed to decode JSON from {CONFIG_FILE_PATH}. Check file syntax.")
         return None
 
-# Load configuration globally once when the service starts
+class CompiledMetric:
+    """
+    A metric from the configuration with its formula compiled and its inputs bound.
+    Each input variable of the formula has a precomputed getter, so evaluating a
+    build is one list comprehension plus one call of the compiled formula.
+    """
+    __slots__ = ('key', 'formula', 'unit', 'description', 'getters')
+
+    def __init__(self, key, formula, unit, description, getters):
+        self.key = key
+        self.formula = formula
+        self.unit = unit
+        self.description = description
+        self.getters = getters
+
+    def evaluate(self, raw_data):
+        """Evaluates the metric for one build. Failed evaluations yield 0."""
+        try:
+            return round(self.formula(*[get(raw_data) for get in self.getters]), ROUND_DIGITS)
+        except ZeroDivisionError:
+            # e.g. coverage of a build with no executable lines
+            return 0
+        except Exception as e:
+            print(f"[FORMULA ERROR] Failed to evaluate formula for {self.key}. Error: {e}")
+            return 0
+
+    def evaluate_batch(self, rows):
+        """Evaluates the metric for many builds in one vectorized formula call."""
+        columns = {
+            variable: [get(row) for row in rows]
+            for variable, get in zip(self.formula.variables, self.getters)
+        }
+        return [round(value, ROUND_DIGITS) for value in self.formula.evaluate_batch(columns, len(rows))]
+
+def _plain_getter(name, default):
+    """Getter reading an input straight from the payload."""
+    return lambda data: data.get(name, default)
+
+def _derived_getter(name, formula, default):
+    """
+    Getter for an input defined by its own formula over payload fields
+    (e.g. pipeline_duration_s from pipelineDurationMs). A value already present
+    in the payload under the input's name takes precedence.
+    """
+    getters = [_plain_getter(v, DEFAULT_INPUTS.get(v, 0)) for v in formula.variables]
+
+    def get(data):
+        if name in data:
+            return data[name]
+        try:
+            return formula(*[g(data) for g in getters])
+        except Exception:
+            return default
+    return get
+
+def compile_metrics(config, formula_cache=None, strict=False):
+    """
+    Compiles every metric formula of a configuration and binds its inputs.
+    Inputs are resolved from the payload, from the optional "inputs" section
+    (defaults and derived-input formulas), then from DEFAULT_INPUTS.
+
+    formula_cache maps formula source -> CompiledFormula; formulas found there are
+    reused instead of recompiled, and every formula used is recorded in it.
+    Invalid formulas are reported and left out, or raise FormulaError when strict.
+    """
+    if formula_cache is None:
+        formula_cache = {}
+
+    def compile_cached(source, name):
+        formula = formula_cache.get(source)
+        if formula is None:
+            formula = formula_cache[source] = compile_formula(source, name)
+        return formula
+
+    input_defs = config.get('inputs', {})
+    input_getters = {}
+    for name, definition in input_defs.items():
+        default = definition.get('default', DEFAULT_INPUTS.get(name, 0))
+        if 'formula' in definition:
+            try:
+                formula = compile_cached(definition['formula'], f"inputs.{name}")
+            except FormulaError as e:
+                if strict:
+                    raise
+                print(f"[CONFIG ERROR] Input '{name}': {e}")
+                continue
+            input_getters[name] = _derived_getter(name, formula, default)
+        else:
+            input_getters[name] = _plain_getter(name, default)
+
+    compiled = {}
+    for metric_key, metric_def in config.get('metrics', {}).items():
+        try:
+            formula = compile_cached(metric_def['formula'], metric_key)
+        except (FormulaError, KeyError, TypeError) as e:
+            if strict:
+                raise FormulaError(f"Metric '{metric_key}': {e}") from None
+            print(f"[CONFIG ERROR] Metric '{metric_key}' skipped: {e}")
+            continue
+        getters = [
+            input_getters.get(v) or _plain_getter(v, DEFAULT_INPUTS.get(v, 0))
+            for v in formula.variables
+        ]
+        compiled[metric_key] = CompiledMetric(
+            metric_key, formula, metric_def.get('unit'),
+            metric_def.get('description', 'No description provided in config.'),
+            getters
+        )
+    return compiled
+
+class MetricsSnapshot:
+    """
+    An immutable, fully compiled view of one configuration.
+    The active snapshot is swapped by a single reference assignment, so a reader
+    that grabs it once sees one consistent config for a whole build or batch.
+    """
+    __slots__ = ('version', 'config', 'metrics', 'formula_cache')
+
+    def __init__(self, version, config, metrics, formula_cache):
+        self.version = version
+        self.config = config
+        self.metrics = metrics
+        self.formula_cache = formula_cache
+
+def config_version(config):
+    """
+    Content-derived config version: identical configs get the same version in
+    every worker process and service, and any edit produces a new one.
+    """
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:12]
+
+def _file_fingerprint():
+    """Cheap change check for the config file: (inode, size, mtime) from one stat call."""
+    try:
+        st = os.stat(CONFIG_FILE_PATH)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _build_snapshot(config, previous=None, strict=False):
+    """Compiles a configuration into a snapshot, reusing the previous snapshot's compiled formulas."""
+    formula_cache = {}
+    reused = previous.formula_cache if previous else {}
+    # Seed the new cache with only the formulas that still appear, so removed ones are dropped
+    sources = [d.get('formula') for d in config.get('inputs', {}).values()]
+    sources += [d.get('formula') for d in config.get('metrics', {}).values()]
+    for source in sources:
+        if source in reused:
+            formula_cache[source] = reused[source]
+    metrics = compile_metrics(config, formula_cache, strict=strict)
+    return MetricsSnapshot(config_version(config), config, metrics, formula_cache)
+
+# Load and compile the configuration globally once when the service starts
+# Fingerprint of the config file as last examined (accepted or rejected)
+_seen_fingerprint = _file_fingerprint()
 METRICS_CONFIG = load_config()
+_snapshot = _build_snapshot(METRICS_CONFIG) if METRICS_CONFIG else None
+_reload_lock = threading.Lock()
+_watcher_thread = None
+
+def current_snapshot():
+    """Returns the active compiled configuration (None if no valid config was ever loaded)."""
+    return _snapshot
+
+def reload_config(force=False):
+    """
+    Reloads metrics_config.json if its stat fingerprint changed (or when forced).
+    The new file is parsed and strictly validated; on any error the active
+    snapshot stays in place. Returns True if a new snapshot was swapped in.
+    """
+    global _snapshot, _seen_fingerprint, METRICS_CONFIG
+    with _reload_lock:
+        fingerprint = _file_fingerprint()
+        previous = _snapshot
+        if fingerprint is None or (not force and previous is not None and fingerprint == _seen_fingerprint):
+            return False
+        # Record the file as examined up front so a rejected file is not re-validated on every poll
+        _seen_fingerprint = fingerprint
+
+        config = load_config()
+        if not config or not isinstance(config.get('metrics'), dict):
+            print("[CONFIG ERROR] Reload rejected: configuration has no 'metrics' section. Keeping the active config.")
+            return False
+        try:
+            snapshot = _build_snapshot(config, previous, strict=True)
+        except FormulaError as e:
+            print(f"[CONFIG ERROR] Reload rejected: {e}. Keeping the active config.")
+            return False
+
+        if previous is not None and snapshot.version == previous.version:
+            return False
+
+        reused = sum(1 for f in snapshot.formula_cache.values()
+                     if previous is not None and previous.formula_cache.get(f.source) is f)
+        _snapshot = snapshot
+        METRICS_CONFIG = config
+        print(f"[CONFIG] Swapped in config version {snapshot.version} "
+              f"({len(snapshot.metrics)} metrics, {reused}/{len(snapshot.formula_cache)} formulas reused).")
+        return True
+
+def _watch_config():
+    """Background loop polling the config file's stat fingerprint."""
+    while True:
+        time.sleep(CONFIG_POLL_INTERVAL_S)
+        try:
+            reload_config()
+        except Exception as e:
+            print(f"[CONFIG ERROR] Config watcher error: {e}")
+
+def start_config_watcher():
+    """Starts the background config watcher thread once per process."""
+    global _watcher_thread
+    if _watcher_thread is None:
+        _watcher_thread = threading.Thread(target=_watch_config, name='metrics-config-watcher', daemon=True)
+        _watcher_thread.start()
+    return _watcher_thread
 
 def calculate_metric_value(metric_key, config, raw_data):
     """
-    Calculates a single metric value by dynamically executing the formula 
-    loaded from the simplified metrics configuration using eval().
+    Calculates a single metric value using the compiled formula
+    from the metrics configuration.
     """
-    if not config or metric_key not in config['metrics']:
+    snapshot = _snapshot
+    if snapshot is not None and config is snapshot.config:
+        metrics = snapshot.metrics
+    else:
+        metrics = compile_metrics(config or {})
+    metric = metrics.get(metric_key)
+    if metric is None:
         print(f"[ERROR] Metric key '{metric_key}' not found in configuration.")
         return 0
+    return metric.evaluate(raw_data)
 
-    metric_def = config['metrics'][metric_key]
-    
-    # 1. Pull formula directly from metric definition (simplified config structure)
-    formula = metric_def['formula'] 
-    
-    # --- Prepare Execution Scope ---
-    scope = {}
-    
-    # 2. Populate scope with required variables from raw_data
-    # This replaces the complex INPUT_MAP logic
-    if metric_key == 'line_code_coverage':
-        # Required variables for coverage formula: covered_lines, total_lines
-        scope['covered_lines'] = raw_data.get('covered_lines', DEFAULT_INPUTS['covered_lines'])
-        scope['total_lines'] = raw_data.get('total_lines', DEFAULT_INPUTS['total_lines'])
-
-    elif metric_key == 'pipeline_duration_s':
-        # Required variable for pipeline duration: duration_ms (mapped from pipelineDurationMs)
-        scope['duration_ms'] = raw_data.get('pipelineDurationMs', DEFAULT_INPUTS['pipelineDurationMs'])
-        # 3. Hardcoded conversion logic to fix the simple formula "pipeline_duration_s"
-        formula = "duration_ms / 1000.0" 
-
-    # --- Safety Check: Prevent division by zero ---
-    if metric_key == 'line_code_coverage':
-        if scope.get('total_lines', 0) == 0:
-            return 0
-    
-    # --- Execute Dynamic Formula ---
-    try:
-        # CRITICAL STEP: eval() executes the string formula using the variables in the scope.
-        # We restrict the environment to prevent security risks (no builtins)
-        result = eval(formula, {"__builtins__": None, "math": math}, scope)
-        
-        # 4. Apply fixed rounding (2 decimals)
-        return round(result, 2)
-        
-    except Exception as e:
-        print(f"[FORMULA ERROR] Failed to evaluate formula for {metric_key}. Error: {e}")
-        print(f"  [FORMULA DEBUG] Formula: {formula}, Scope: {scope}")
-        return 0
+def _project_id(raw_data):
+    """Project identifier of a build (normalized project_id or the CI job id)."""
+    return str(raw_data.get('project_id') or raw_data.get('jobId') or 'default')
+
+def _summary(snapshot, project_id, build_id, timestamp, values, raw_data=None):
+    """
+    Builds the summary record from per-metric values, carrying over the build's start
+    time ('build_ts', the normalized 'timestamp') and ingestion stamps.
+    Metrics hold bare values; their units and descriptions are stored once per
+    config_version (see summary_schema) instead of in every summary.
+    """
+    summary = {
+        'project_id': project_id,
+        'build_id': build_id,
+        'timestamp': timestamp,
+        'config_version': snapshot.version,
+        'metrics': dict(zip(snapshot.metrics, values))
+    }
+    if raw_data is not None:
+        if raw_data.get('timestamp') is not None:
+            summary['build_ts'] = raw_data['timestamp']
+        for field in INGEST_FIELDS:
+            if field in raw_data:
+                summary[field] = raw_data[field]
+    return summary
 
 def aggregate_metrics(raw_data):
     """
-    Calculates aggregated metrics by iterating through the configuration
-    and dynamically executing the formulas defined in metrics_config.json.
+    Calculates aggregated metrics by evaluating every compiled formula
+    from metrics_config.json against the build data.
     """
-    if not METRICS_CONFIG:
+    snapshot = _snapshot
+    if snapshot is None:
         print("[AGGREGATION] ERROR: Configuration missing. Cannot aggregate metrics.")
         return {'build_id': raw_data.get('build_id', 'unknown'), 'timestamp': datetime.datetime.now().timestamp(), 'metrics': {}}
 
-    print("\n--- 3. AGGREGATION ENGINE (CALCULATING DYNAMICALLY) ---")
-    
     # Build ID fallback logic improved to check common fields
     build_id = raw_data.get('build_id') or raw_data.get('buildNumber', 'unknown-build')
-    timestamp = datetime.datetime.now().timestamp() 
-    
-    final_metrics = {}
-    
-    # Iterate over all defined metrics in the config
-    for metric_key, metric_def in METRICS_CONFIG['metrics'].items():
-        
-        # Calculate the value using the dynamic function
-        value = calculate_metric_value(metric_key, METRICS_CONFIG, raw_data)
-        
-        final_metrics[metric_key] = {
-            'value': value,
-            'unit': metric_def['unit'],
-            'description': metric_def.get('description', 'No description provided in config.')
-        }
-        
-    print(f"  [AGGREGATION] Calculated summary for build {build_id}.")
-    
-    # Debug line using the dynamically calculated value
-    coverage_value = final_metrics.get('line_code_coverage', {}).get('value', 'N/A')
-    print(f"  [AGGREGATION] Code Coverage: {coverage_value}%")
-    print("-----------------------------------------------------")
-    
-    # Prepare the final summary record
-    final_summary = {
-        'build_id': build_id,
-        'timestamp': timestamp,
-        'metrics': final_metrics
-    }
-    
-    # Return the summary dictionary for the worker to save
-    return final_summary
\ No newline at end of file
+    values = [metric.evaluate(raw_data) for metric in snapshot.metrics.values()]
+    return _summary(snapshot, _project_id(raw_data), build_id, datetime.datetime.now().timestamp(), values, raw_data)
+
+def aggregate_metrics_batch(rows):
+    """
+    Batch variant of aggregate_metrics: each formula is evaluated once over
+    all builds (vectorized with NumPy when available).
+    Returns one summary per input row, in order.
+    """
+    if not rows:
+        return []
+    snapshot = _snapshot
+    if snapshot is None:
+        return [aggregate_metrics(row) for row in rows]
+
+    timestamp = datetime.datetime.now().timestamp()
+    columns = [metric.evaluate_batch(rows) for metric in snapshot.metrics.values()]
+    return [
+        _summary(snapshot, _project_id(row), row.get('build_id') or row.get('buildNumber', 'unknown-build'),
+                 timestamp, values, row)
+        for row, values in zip(rows, zip(*columns) if columns else [()] * len(rows))
+    ]
@@ -0,0 +1,14 @@
+"""
+Load generation and benchmarks for the CI metrics pipeline.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks --count 5000 --redis memory
+    python -m benchmarks --count 5000 --redis local --url http://127.0.0.1:5000 --save-baseline benchmarks/baseline.json
+    python -m benchmarks --count 5000 --redis memory --baseline benchmarks/baseline.json
+
+`--redis memory` uses fakeredis (pip install fakeredis) as an in-memory stand-in;
+`--redis local` uses the Redis configured for the services. Against a real Redis
+the benchmark drains ci_data_queue and overwrites the latest build summary, so
+point it at a dedicated instance (REDIS_HOST / REDIS_PORT).
+"""
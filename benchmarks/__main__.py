@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import drivers, harness
+from benchmarks.payloads import DEFAULT_SIZE_MIX, generate_payloads, parse_size_mix
+from normalization_worker import normalize_data
+from worker_processor import WORKER_BATCH_SIZE
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Benchmark the CI metrics pipeline stage by stage.")
+    parser.add_argument('--count', type=int, default=2000, help="Number of synthetic builds (default: 2000).")
+    parser.add_argument('--projects', type=int, default=10, help="Number of synthetic projects (default: 10).")
+    parser.add_argument('--project-skew', type=float, default=1.0,
+                        help="Zipf exponent of builds per project; 0 spreads them evenly (default: 1.0).")
+    parser.add_argument('--sizes', type=parse_size_mix,
+                        default=DEFAULT_SIZE_MIX, help="Payload size mix, e.g. small=0.7,medium=0.25,large=0.05.")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed of the payload generator (default: 42).")
+    parser.add_argument('--redis', choices=('memory', 'local'), default='memory',
+                        help="In-memory fakeredis stand-in or the services' Redis (default: memory).")
+    parser.add_argument('--url', help="Benchmark ingestion over HTTP against this running service instead of in-process.")
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent HTTP clients for --url (default: 1).")
+    parser.add_argument('--ingest-batch', type=int, default=1,
+                        help="Records per ingestion request; above 1 uses /webhook/ci/batch (default: 1).")
+    parser.add_argument('--worker-batch', type=int, default=WORKER_BATCH_SIZE,
+                        help=f"Messages per worker batch (default: {WORKER_BATCH_SIZE}).")
+    parser.add_argument('--memory-sample', type=int, default=500,
+                        help="Builds re-run under tracemalloc per stage for the memory figures; 0 skips (default: 500).")
+    parser.add_argument('--output', help="Write the results as JSON to this file.")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Write the results as the new baseline.")
+    parser.add_argument('--baseline', metavar='PATH', help="Compare against this baseline and exit 1 on regressions.")
+    parser.add_argument('--max-throughput-drop', type=float, default=harness.MAX_THROUGHPUT_DROP)
+    parser.add_argument('--max-latency-increase', type=float, default=harness.MAX_LATENCY_INCREASE)
+    parser.add_argument('--max-memory-increase', type=float, default=harness.MAX_MEMORY_INCREASE)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.url and args.redis == 'memory':
+        raise SystemExit("[BENCHMARK] --url needs --redis local: the worker stage must read the service's queue.")
+
+    r = drivers.connect_redis(args.redis)
+    drivers.bind_services(r)
+    drivers.cleanup(r)
+
+    payloads = generate_payloads(args.count, args.projects, args.project_skew, args.sizes, args.seed)
+    ingested = drivers.as_ingested(payloads)
+    rows = [normalize_data(record) for record in ingested]
+    sample = max(0, min(args.memory_sample, args.count))
+    print(f"[BENCHMARK] {args.count} builds over {args.projects} projects, Redis: {args.redis}, "
+          f"ingestion: {args.url or 'in-process'}")
+
+    def ingestion(subset):
+        if args.url:
+            return drivers.ingestion_calls_http(args.url, subset, args.ingest_batch)
+        return drivers.ingestion_calls_inprocess(subset, args.ingest_batch)
+
+    ingest_unit = 'request' if args.ingest_batch == 1 else f"request of {args.ingest_batch}"
+    results = [
+        harness.run_timed('normalization', drivers.normalization_calls(ingested)),
+        harness.run_timed('aggregation', drivers.aggregation_calls(rows)),
+        harness.run_timed('aggregation_batch', drivers.aggregation_batch_calls(rows, args.worker_batch),
+                          unit=f"batch of {args.worker_batch}"),
+        harness.run_timed('ingestion', ingestion(payloads), unit=ingest_unit,
+                          concurrency=args.concurrency if args.url else 1),
+    ]
+    results.append(harness.run_timed('worker', drivers.worker_calls(r, args.worker_batch),
+                                     unit=f"batch of {args.worker_batch}"))
+
+    if sample:
+        by_name = {result.name: result for result in results}
+        harness.measure_memory(by_name['normalization'], drivers.normalization_calls(ingested[:sample]))
+        harness.measure_memory(by_name['aggregation'], drivers.aggregation_calls(rows[:sample]))
+        harness.measure_memory(by_name['aggregation_batch'],
+                               drivers.aggregation_batch_calls(rows[:sample], args.worker_batch))
+        if not args.url:
+            # Over HTTP the ingestion work happens in another process
+            harness.measure_memory(by_name['ingestion'], ingestion(payloads[:sample]))
+            harness.measure_memory(by_name['worker'], drivers.worker_calls(r, args.worker_batch))
+    drivers.cleanup(r)
+
+    settings = {key: value for key, value in vars(args).items()
+                if key not in ('output', 'save_baseline', 'baseline')}
+    report = harness.build_report(results, settings)
+    harness.print_report(report)
+    if args.output:
+        harness.save_report(report, args.output)
+    if args.save_baseline:
+        harness.save_report(report, args.save_baseline)
+
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            raise SystemExit(f"[BENCHMARK] Baseline {args.baseline} not found. Create it with --save-baseline.")
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('settings', {}).get('count') != args.count:
+            print("[BENCHMARK] Warning: baseline was recorded with different settings; comparison may be noisy.")
+        regressions = harness.compare_to_baseline(report, baseline, args.max_throughput_drop,
+                                                  args.max_latency_increase, args.max_memory_increase)
+        if regressions:
+            print("\n[BENCHMARK] REGRESSIONS against baseline:")
+            for message in regressions:
+                print(f"  - {message}")
+            sys.exit(1)
+        print("\n[BENCHMARK] All stages within thresholds of the baseline.")
+
+if __name__ == '__main__':
+    main()
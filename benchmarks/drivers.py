@@ -0,0 +1,99 @@
+import requests
+
+import aggregation_service
+import ingestion_service
+import project_summaries
+import settings
+import worker_processor
+from normalization_worker import normalize_data
+from benchmarks.payloads import PROJECT_PREFIX
+
+def connect_redis(kind):
+    """Returns the Redis client for the run: 'memory' (fakeredis stand-in) or 'local' (the services' Redis)."""
+    if kind == 'memory':
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("[BENCHMARK] --redis memory requires fakeredis (pip install fakeredis).")
+        return fakeredis.FakeRedis()
+    return settings.redis_client()
+
+def bind_services(r):
+    """Points the in-process ingestion service and worker at r and loads the metrics configuration."""
+    ingestion_service.redis_client = r
+    # Benchmarks measure the Redis path; the write-ahead log would hide failures
+    ingestion_service.wal = None
+    settings.QUEUE_BACKEND = 'list'
+    worker_processor.r = r
+    if not aggregation_service.reload_config(force=True) and aggregation_service.current_snapshot() is None:
+        raise SystemExit("[BENCHMARK] metrics_config.json could not be loaded. Run from the repository root.")
+
+def cleanup(r):
+    """Removes the queue, the latest summaries and all history and statistics of benchmark projects."""
+    keys = [settings.REDIS_QUEUE, settings.SUMMARY_KEY, settings.SUMMARY_VERSION_KEY]
+    for pattern in (f"history:{PROJECT_PREFIX}*", f"stats:{PROJECT_PREFIX}*", f"latest:{PROJECT_PREFIX}*"):
+        keys.extend(r.scan_iter(match=pattern, count=1000))
+    r.zremrangebylex(project_summaries.INDEX_KEY, f"[{PROJECT_PREFIX}", f"[{PROJECT_PREFIX}\xff")
+    for start in range(0, len(keys), 500):
+        r.delete(*keys[start:start + 500])
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+# --- STAGE CALLS ---
+# Each builder returns (function, item_count) pairs for benchmarks.harness.run_timed
+
+def normalization_calls(payloads):
+    return [(lambda payload=payload: normalize_data(payload), 1) for payload in payloads]
+
+def aggregation_calls(rows):
+    return [(lambda row=row: aggregation_service.aggregate_metrics(row), 1) for row in rows]
+
+def aggregation_batch_calls(rows, batch_size):
+    return [(lambda batch=batch: aggregation_service.aggregate_metrics_batch(batch), len(batch))
+            for batch in _chunks(rows, batch_size)]
+
+def ingestion_calls_inprocess(payloads, batch_size=1):
+    """Posts through the Flask test client: the full request path without sockets."""
+    client = ingestion_service.app.test_client()
+    if batch_size > 1:
+        return [(lambda batch=batch: client.post('/webhook/ci/batch', json=batch).status_code < 300, len(batch))
+                for batch in _chunks(payloads, batch_size)]
+    return [(lambda payload=payload: client.post('/webhook/ci', json=payload).status_code < 300, 1)
+            for payload in payloads]
+
+def ingestion_calls_http(url, payloads, batch_size=1, session=None):
+    """Posts to a running ingestion service (Flask or ASGI mode) over keep-alive HTTP."""
+    session = session or requests.Session()
+    base = url.rstrip('/')
+    if batch_size > 1:
+        return [(lambda batch=batch: session.post(f"{base}/webhook/ci/batch", json=batch, timeout=30).status_code < 300,
+                 len(batch))
+                for batch in _chunks(payloads, batch_size)]
+    return [(lambda payload=payload: session.post(f"{base}/webhook/ci", json=payload, timeout=30).status_code < 300, 1)
+            for payload in payloads]
+
+def worker_calls(r, batch_size):
+    """
+    One call per worker batch currently in the queue: pop, normalize, aggregate
+    and persist, exactly as the worker loop does (without the blocking wait).
+    """
+    pending = r.llen(settings.REDIS_QUEUE)
+
+    def run_batch():
+        raw_messages = r.rpop(settings.REDIS_QUEUE, batch_size)
+        if not raw_messages:
+            return False
+        worker_processor.persist_summaries(*worker_processor.process_batch(raw_messages))
+        return True
+
+    return [(run_batch, min(batch_size, pending - start)) for start in range(0, pending, batch_size)]
+
+def as_ingested(payloads):
+    """Copies of the payloads as the ingestion service queues them (build_id normalized, trace fields stamped)."""
+    records = []
+    for payload in payloads:
+        record = dict(payload)
+        ingestion_service.validate_payload(record)
+        records.append(ingestion_service.stamp_trace(record))
+    return records
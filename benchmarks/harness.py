@@ -0,0 +1,145 @@
+import json
+import platform
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# --- DEFAULT REGRESSION THRESHOLDS (relative to the baseline) ---
+# Fail if throughput drops by more than this fraction
+MAX_THROUGHPUT_DROP = 0.20
+# Fail if p95 latency grows by more than this fraction
+MAX_LATENCY_INCREASE = 0.30
+# Fail if peak traced memory grows by more than this fraction
+MAX_MEMORY_INCREASE = 0.50
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list (q in 0..100)."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(q / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+class StageResult:
+    """Throughput, latency distribution and memory of one benchmark stage."""
+
+    def __init__(self, name, items, elapsed_s, latencies_s, errors=0, unit='item'):
+        self.name = name
+        self.items = items
+        self.elapsed_s = elapsed_s
+        self.latencies = sorted(latencies_s)
+        self.errors = errors
+        self.unit = unit
+        self.peak_memory_bytes = None
+        self.memory_items = None
+
+    def to_dict(self):
+        latency_ms = {f"p{q}": round(percentile(self.latencies, q) * 1000, 4) if self.latencies else None
+                      for q in (50, 95, 99)}
+        latency_ms['mean'] = round(sum(self.latencies) / len(self.latencies) * 1000, 4) if self.latencies else None
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'elapsed_s': round(self.elapsed_s, 4),
+            'throughput_per_s': round(self.items / self.elapsed_s, 2) if self.elapsed_s else None,
+            'latency_unit': self.unit,
+            'latency_ms': latency_ms,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'memory_items': self.memory_items,
+        }
+
+def _timed_call(name, function):
+    started = time.perf_counter()
+    try:
+        ok = function()
+    except Exception as e:
+        print(f"[BENCHMARK] {name}: call failed: {e}")
+        ok = False
+    return time.perf_counter() - started, ok is not False
+
+def run_timed(name, calls, unit='item', concurrency=1):
+    """
+    Runs calls, a list of (function, item_count) pairs, timing each call
+    (on concurrency threads when above 1). A call that raises or returns False
+    counts as an error.
+    """
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(lambda call: _timed_call(name, call[0]), calls))
+    else:
+        outcomes = [_timed_call(name, function) for function, _ in calls]
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, _ in outcomes]
+    errors = sum(1 for _, ok in outcomes if not ok)
+    return StageResult(name, sum(count for _, count in calls), elapsed, latencies, errors, unit)
+
+def measure_memory(result, calls):
+    """
+    Re-runs a sample of a stage's calls under tracemalloc and records the peak
+    traced allocation. Kept out of the timed pass because tracing slows Python down.
+    """
+    tracemalloc.start()
+    try:
+        items = 0
+        for function, item_count in calls:
+            try:
+                function()
+            except Exception:
+                pass
+            items += item_count
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result.peak_memory_bytes = peak
+    result.memory_items = items
+    return result
+
+def build_report(results, settings):
+    return {
+        'created_at': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': settings,
+        'stages': {result.name: result.to_dict() for result in results},
+    }
+
+def print_report(report):
+    print(f"\n{'stage':<18}{'items':>8}{'errors':>8}{'items/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>11}")
+    for name, stage in report['stages'].items():
+        latency = stage['latency_ms']
+        memory = stage['peak_memory_bytes']
+        print(f"{name:<18}{stage['items']:>8}{stage['errors']:>8}{stage['throughput_per_s'] or 0:>12.1f}"
+              f"{latency['p50'] or 0:>10.3f}{latency['p95'] or 0:>10.3f}{latency['p99'] or 0:>10.3f}"
+              f"{(memory or 0) / 1024:>11.1f}")
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"[BENCHMARK] Results written to {path}")
+
+def compare_to_baseline(report, baseline, max_throughput_drop=MAX_THROUGHPUT_DROP,
+                        max_latency_increase=MAX_LATENCY_INCREASE, max_memory_increase=MAX_MEMORY_INCREASE):
+    """
+    Compares each stage with the baseline. Returns the list of regression messages
+    (empty when every stage is within its thresholds). Stages missing from either
+    side are skipped.
+    """
+    regressions = []
+    for name, stage in report['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if base is None:
+            continue
+        if base['throughput_per_s'] and stage['throughput_per_s'] is not None:
+            floor = base['throughput_per_s'] * (1 - max_throughput_drop)
+            if stage['throughput_per_s'] < floor:
+                regressions.append(f"{name}: throughput {stage['throughput_per_s']:.1f}/s is below "
+                                   f"{floor:.1f}/s (baseline {base['throughput_per_s']:.1f}/s)")
+        base_p95, p95 = base['latency_ms'].get('p95'), stage['latency_ms'].get('p95')
+        if base_p95 and p95 is not None and p95 > base_p95 * (1 + max_latency_increase):
+            regressions.append(f"{name}: p95 latency {p95:.3f} ms exceeds {base_p95 * (1 + max_latency_increase):.3f} ms "
+                               f"(baseline {base_p95:.3f} ms)")
+        base_memory, memory = base.get('peak_memory_bytes'), stage.get('peak_memory_bytes')
+        if base_memory and memory is not None and memory > base_memory * (1 + max_memory_increase):
+            regressions.append(f"{name}: peak memory {memory / 1024:.1f} KiB exceeds "
+                               f"{base_memory * (1 + max_memory_increase) / 1024:.1f} KiB (baseline {base_memory / 1024:.1f} KiB)")
+    return regressions
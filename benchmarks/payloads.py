@@ -0,0 +1,63 @@
+import random
+
+# Synthetic builds belong to projects with this prefix, so their history and statistics can be cleaned up
+PROJECT_PREFIX = 'bench-'
+
+# Payload size classes: number of extra per-suite entries carried along (ignored by the pipeline, but parsed and queued)
+SIZE_CLASSES = {'small': 0, 'medium': 20, 'large': 400}
+DEFAULT_SIZE_MIX = {'small': 0.7, 'medium': 0.25, 'large': 0.05}
+
+def parse_size_mix(text):
+    """Parses 'small=0.7,large=0.3' into a weight dict."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SIZE_CLASSES:
+            raise ValueError(f"Unknown payload size '{name}'. Use one of: {', '.join(SIZE_CLASSES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def project_weights(projects, skew):
+    """Zipf-like weights: skew 0 spreads builds evenly, higher values concentrate them on a few projects."""
+    return [1.0 / (rank ** skew) for rank in range(1, projects + 1)]
+
+def generate_payloads(count, projects=10, skew=1.0, size_mix=None, seed=42, start_time=1709280000):
+    """
+    Generates count CI payloads in the SQ-5 schema of ci_run_data.json.
+    The same arguments always produce the same payloads. Build numbers increase
+    per project and start times advance by a few minutes per build.
+    """
+    rng = random.Random(seed)
+    size_mix = size_mix or DEFAULT_SIZE_MIX
+    sizes, size_weights = list(size_mix), list(size_mix.values())
+    names = [f"{PROJECT_PREFIX}{index:03d}" for index in range(projects)]
+    weights = project_weights(projects, skew)
+    build_numbers = dict.fromkeys(names, 0)
+    timestamp = start_time
+
+    payloads = []
+    for _ in range(count):
+        project = rng.choices(names, weights)[0]
+        build_numbers[project] += 1
+        timestamp += rng.randint(30, 300)
+        total_lines = rng.randint(500, 50000)
+        payload = {
+            'jobId': project,
+            'buildNumber': build_numbers[project],
+            'startTime': timestamp,
+            'pipelineDurationMs': rng.randint(20000, 1800000),
+            'reportVersion': rng.choice(('SQ-5.0', 'SQ-5.1')),
+            'covered_lines': rng.randint(0, total_lines),
+            'total_lines': total_lines,
+            'coverageThresholdPassed': rng.random() < 0.8,
+        }
+        suites = SIZE_CLASSES[rng.choices(sizes, size_weights)[0]]
+        if suites:
+            payload['testSuites'] = [
+                {'name': f"suite-{index}", 'tests': rng.randint(1, 200), 'failures': rng.randint(0, 3),
+                 'durationMs': rng.randint(10, 60000)}
+                for index in range(suites)
+            ]
+        payloads.append(payload)
+    return payloads
@@ -1,30 +1,212 @@
 # ci_data_watcher.py (watcher service)
 import time, os, hashlib, requests
-import json 
+import argparse
+import fnmatch
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-WEBHOOK_URL = "http://127.0.0.1:5000/webhook/ci" 
+import coverage_bitmaps
+import coverage_reports
+
+WEBHOOK_URL = "http://127.0.0.1:5000/webhook/ci"
+BATCH_WEBHOOK_URL = "http://127.0.0.1:5000/webhook/ci/batch"
 TARGET_FILE = "ci_run_data.json"
+# Records posted per batch request in tailing mode
+TAIL_BATCH_SIZE = 500
+# Tailing mode re-checks the file this often even without filesystem events
+TAIL_POLL_INTERVAL_S = 1.0
+# Concurrent webhook posts (also the keep-alive connection pool size)
+POST_WORKERS = int(os.getenv('WATCHER_POST_WORKERS', 8))
+# Failed posts are stored here and replayed once ingestion is reachable again
+SPOOL_DIR = os.getenv('WATCHER_SPOOL_DIR', '.watcher_spool')
+SPOOL_BACKOFF_INITIAL_S = 1.0
+SPOOL_BACKOFF_MAX_S = 60.0
+# Project of coverage reports (LCOV / Cobertura) in --watch-dir whose file name
+# does not name one; '<project>__<build_id>.<ext>' sets both per file
+COVERAGE_PROJECT = os.getenv('WATCHER_COVERAGE_PROJECT', 'default')
 
 _last_hash = None
+_last_fingerprint = None
 _last_trigger = 0
 
+# --- HTTP DELIVERY ---
+# One pooled keep-alive session shared by all posting threads
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POST_WORKERS))
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=POST_WORKERS))
+
+class RetrySpool:
+    """
+    Disk-backed queue of posts that could not be delivered.
+    Each failed post is one JSON file (url + payload), named so that a sorted
+    listing replays them in failure order. A background thread replays the
+    spool with exponential backoff while ingestion stays unreachable.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, url, payload):
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+        temp_path = os.path.join(self.directory, name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump({'url': url, 'payload': payload}, f)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        self._wakeup.set()
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def replay_once(self):
+        """Replays spooled posts oldest first. Returns False at the first one that still fails."""
+        for name in self.pending():
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                print(f"[WATCHER] Dropping unreadable spool entry {name}.")
+                os.remove(path)
+                continue
+            if not post_json(entry['url'], entry['payload']):
+                return False
+            os.remove(path)
+            print(f"[WATCHER] Replayed spooled post {name}.")
+        return True
+
+    def _run(self):
+        backoff = SPOOL_BACKOFF_INITIAL_S
+        while True:
+            if not self.pending():
+                # Sleep until a new failure is spooled
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            if self.replay_once():
+                backoff = SPOOL_BACKOFF_INITIAL_S
+            else:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, SPOOL_BACKOFF_MAX_S)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='watcher-spool-replay', daemon=True)
+            self._thread.start()
+            count = len(self.pending())
+            if count:
+                print(f"[WATCHER] {count} spooled post(s) pending replay from {self.directory}.")
+
+SPOOL = None
+
+def post_json(url, payload, timeout=5):
+    """
+    Posts one JSON payload over the shared session.
+    Returns True when ingestion gave a final answer (2xx, or a 4xx that a retry
+    would not change) and False when the post should be retried later.
+    """
+    try:
+        resp = SESSION.post(url, json=payload, timeout=timeout)
+    except requests.exceptions.ConnectionError:
+        print(f"[WATCHER] Webhook error: Connection Refused. Check if {url} is running.")
+        return False
+    except requests.exceptions.RequestException as e:
+        print("[WATCHER] Webhook error:", e)
+        return False
+    print(f"[WATCHER] Webhook status: {resp.status_code}")
+    return resp.status_code < 500 and resp.status_code != 429
+
+def retry_after_seconds(resp, default=SPOOL_BACKOFF_INITIAL_S):
+    """Seconds to wait from a response's Retry-After header (delta-seconds form), capped at the spool backoff."""
+    try:
+        delay = float(resp.headers.get('Retry-After', default))
+    except (TypeError, ValueError):
+        delay = default
+    return min(max(delay, 0.0), SPOOL_BACKOFF_MAX_S)
+
+def deliver(url, payload):
+    """Posts a payload, spooling it to disk for replay if ingestion cannot take it now."""
+    if post_json(url, payload):
+        return True
+    if SPOOL is not None:
+        SPOOL.add(url, payload)
+        print("[WATCHER] Post spooled for retry.")
+    return False
+
+def file_fingerprint(path):
+    """
+    Cheap change indicator from a single stat call: (inode, size, mtime in ns).
+    Returns None if the file cannot be stat'ed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def wait_for_stable_fingerprint(path, settle_time):
+    """
+    Waits until the file's stat fingerprint stops changing (no file reads while
+    the writer is busy). If it never settles within settle_time, the latest
+    fingerprint is returned; None if the file is gone.
+    """
+    deadline = time.time() + settle_time
+    last_seen = None
+    while time.time() < deadline:
+        fp = file_fingerprint(path)
+        if fp and fp == last_seen:
+            return fp
+        last_seen = fp
+        time.sleep(0.05)
+    return file_fingerprint(path)
+
+def read_snapshot(path):
+    """Reads a file once; returns (content bytes, SHA256 hex digest) or (None, None)."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        return data, hashlib.sha256(data).hexdigest()
+    except Exception:
+        return None, None
+
+def parse_coverage_file(path):
+    """
+    Parses an LCOV or Cobertura report (with per-file line bitmaps) in one streaming
+    pass, hashing it on the way. Returns (CoverageTotals, SHA256 hex digest); memory
+    stays flat for any file size apart from about one bit per source line.
+    """
+    digest = hashlib.sha256()
+
+    def chunks():
+        with open(path, 'rb') as f:
+            for chunk in coverage_reports.read_chunks(f):
+                digest.update(chunk)
+                yield chunk
+
+    totals = coverage_reports.parse_chunks(chunks(), lines=True)
+    return totals, digest.hexdigest()
+
+def coverage_build_params(path):
+    """Build metadata of a coverage report file: project and build id from its name, start time from its mtime."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    project, separator, build_id = stem.partition('__')
+    if not separator:
+        project, build_id = COVERAGE_PROJECT, stem
+    return {'jobId': project, 'build_id': build_id, 'startTime': os.stat(path).st_mtime * 1000}
+
 class StableFileHandler(FileSystemEventHandler):
     def __init__(self, settle_time=0.6, debounce=0.5):
         super().__init__()
         self.settle_time = settle_time
         self.debounce = debounce
 
-    def compute_hash(self, path):
-        """Computes SHA256 hash of the file content."""
-        try:
-            with open(path, "rb") as f:
-                data = f.read()
-            return hashlib.sha256(data).hexdigest()
-        except Exception:
-            return None
-
     def on_modified(self, event):
         # Only care about our target file
         if event.is_directory:
@@ -32,33 +214,30 @@ class StableFileHandler(FileSystemEventHandler):
         if not event.src_path.endswith(TARGET_FILE):
             return
 
-        global _last_hash, _last_trigger
-
-        # 1) Give the FS a moment to finish bursts of writes and settle hash
-        stable_hash = None
-        deadline = time.time() + self.settle_time
-        last_seen = None
-        while time.time() < deadline:
-            h = self.compute_hash(TARGET_FILE)
-            if h and h == last_seen:
-                stable_hash = h
-                break
-            last_seen = h
-            time.sleep(0.05)
-
-        # If we couldn't get a stable hash, compute once more and proceed
-        if stable_hash is None:
-            stable_hash = self.compute_hash(TARGET_FILE)
+        global _last_hash, _last_fingerprint, _last_trigger
 
-        if stable_hash is None:
-            # file unreadable (still mid-write) — ignore this event
+        # 1) Give the FS a moment to finish bursts of writes
+        stable_fingerprint = wait_for_stable_fingerprint(TARGET_FILE, self.settle_time)
+
+        if stable_fingerprint is None:
+            # file vanished (e.g. replaced mid-write) — ignore this event
             return
 
         # Debounce by time
         if time.time() - _last_trigger < self.debounce:
             return
 
-        # Only proceed if content actually changed
+        # Unchanged size/mtime/inode: nothing to read or hash
+        if stable_fingerprint == _last_fingerprint:
+            return
+        _last_fingerprint = stable_fingerprint
+
+        # 2) Fingerprint changed: read once, hash, and reuse the same bytes for the post
+        content, stable_hash = read_snapshot(TARGET_FILE)
+        if stable_hash is None:
+            return
+
+        # Only proceed if content actually changed (e.g. not just touched)
         if stable_hash == _last_hash:
             return
 
@@ -67,43 +246,323 @@ class StableFileHandler(FileSystemEventHandler):
 
         print(f"[WATCHER] Detected real change — posting to webhook...")
         try:
-            with open(TARGET_FILE, 'r') as f:
-                data_to_post = json.load(f)
-                
-            resp = requests.post(WEBHOOK_URL, json=data_to_post, timeout=5)
-            
+            data_to_post = json.loads(content)
+
             # The ingestion service should now correctly read build_id/buildNumber
-            print(f"[WATCHER] Webhook status: {resp.status_code}")
-            
-        except requests.exceptions.ConnectionError:
-            # Log connection error more clearly
-            print(f"[WATCHER] Webhook error: Connection Refused. Check if {WEBHOOK_URL} is running.")
-        except json.JSONDecodeError:
+            deliver(WEBHOOK_URL, data_to_post)
+
+        except (json.JSONDecodeError, UnicodeDecodeError):
             # Log if the file is invalid JSON (e.g., empty or corrupted)
             print(f"[WATCHER] Webhook error: Could not decode JSON from {TARGET_FILE}. Skipping post.")
         except Exception as e:
             # Catch other unexpected errors
             print("[WATCHER] Webhook error:", e)
 
+class ReportDirectoryHandler(FileSystemEventHandler):
+    """
+    Watches a drop directory of per-project report files (one build per file,
+    matched by a glob pattern). JSON files are posted as they are; any other
+    file is parsed as an LCOV or Cobertura coverage report and its totals are
+    posted as a build record, with the compressed per-file line bitmaps. Change detection works per file like
+    StableFileHandler; settling and posting run on a bounded thread pool so
+    many CI agents can write reports concurrently without blocking the observer.
+    """
+
+    def __init__(self, directory, pattern='*.json', settle_time=0.6, workers=POST_WORKERS):
+        super().__init__()
+        self.directory = directory
+        self.pattern = pattern
+        self.settle_time = settle_time
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='watcher-post')
+        # path -> (fingerprint, sha256) of the last posted version
+        self.state = {}
+        self.in_progress = set()
+        # Paths changed again while being processed; resubmitted once the current run ends
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def matches(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory) and \
+            fnmatch.fnmatch(os.path.basename(path), self.pattern)
+
+    def on_created(self, event):
+        self.on_modified(event)
+
+    def on_moved(self, event):
+        # Atomic writers (write temp file, then rename) show up as moves
+        if not event.is_directory:
+            self.submit(event.dest_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.submit(event.src_path)
+
+    def submit(self, path):
+        """Schedules a file for processing, or marks it dirty if it is already being processed."""
+        if not self.matches(path):
+            return
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.in_progress:
+                self.dirty.add(path)
+                return
+            self.in_progress.add(path)
+        self.executor.submit(self.process, path)
+
+    def process(self, path):
+        try:
+            fingerprint = wait_for_stable_fingerprint(path, self.settle_time)
+            if fingerprint is None:
+                self.state.pop(path, None)
+                return
+            last_fingerprint, last_hash = self.state.get(path, (None, None))
+            if fingerprint == last_fingerprint:
+                return
+            if not path.endswith('.json'):
+                self.process_coverage(path, fingerprint, last_hash)
+                return
+            content, content_hash = read_snapshot(path)
+            if content_hash is None or content_hash == last_hash:
+                self.state[path] = (fingerprint, last_hash)
+                return
+            try:
+                data_to_post = json.loads(content)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                print(f"[WATCHER] Could not decode JSON from {path}. Skipping post.")
+                return
+            self.state[path] = (fingerprint, content_hash)
+            print(f"[WATCHER] Detected change in {os.path.basename(path)} — posting to webhook...")
+            deliver(BATCH_WEBHOOK_URL if isinstance(data_to_post, list) else WEBHOOK_URL, data_to_post)
+        except Exception as e:
+            print(f"[WATCHER] Error processing {path}: {e}")
+        finally:
+            with self.lock:
+                self.in_progress.discard(path)
+                resubmit = path in self.dirty
+                self.dirty.discard(path)
+            if resubmit:
+                # Changed during this run: the fingerprint check skips it if nothing new landed
+                self.submit(path)
+
+    def process_coverage(self, path, fingerprint, last_hash):
+        """Parses a coverage report in the watcher (never loaded whole) and posts its totals and line bitmaps."""
+        try:
+            totals, content_hash = parse_coverage_file(path)
+        except coverage_reports.CoverageReportError as e:
+            print(f"[WATCHER] Could not parse coverage report {path}: {e}. Skipping post.")
+            return
+        self.state[path] = (fingerprint, content_hash)
+        if content_hash == last_hash:
+            return
+        record = coverage_reports.build_record(coverage_build_params(path), totals)
+        record['line_coverage'] = coverage_bitmaps.to_payload(coverage_bitmaps.encode_files(totals.line_maps))
+        summary = totals.summary()
+        print(f"[WATCHER] Parsed {os.path.basename(path)} ({summary['format']}, {summary['files']} files, "
+              f"{summary['covered_lines']}/{summary['total_lines']} lines) — posting to webhook...")
+        deliver(WEBHOOK_URL, record)
+
+    def scan(self):
+        """Submits every matching file already in the directory (start-up catch-up)."""
+        for name in sorted(os.listdir(self.directory)):
+            self.submit(os.path.join(self.directory, name))
+
+def run_directory_mode(directory, pattern):
+    """Watches a drop directory of report files and posts each new or changed report."""
+    handler = ReportDirectoryHandler(directory, pattern)
+    obs = Observer()
+    obs.schedule(handler, directory, recursive=False)
+    obs.start()
+    print(f"[WATCHER] PID {os.getpid()}, watching {os.path.abspath(directory)}/{pattern} "
+          f"with {POST_WORKERS} posting threads")
+    handler.scan()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        obs.stop()
+    obs.join()
+    handler.executor.shutdown(wait=True)
+
+class NdjsonTailer(FileSystemEventHandler):
+    """
+    Tailing mode for an append-only NDJSON file (one build per line).
+    Keeps the byte offset of the last fully posted line in a sidecar file,
+    reads only the lines appended since then (one seek, then line by line),
+    and posts every complete new record through the batch webhook. The offset
+    advances after each delivered batch, so a failed batch never re-posts earlier ones.
+    A trailing partial line is left for the next poll. A changed inode or a
+    file shorter than the offset (rotation/truncation) restarts from byte 0.
+    Polls run on both the observer thread and the main loop, so a lock keeps
+    a single reader advancing the offset at a time.
+    """
+
+    def __init__(self, path, offset_path=None):
+        super().__init__()
+        self.path = path
+        self.offset_path = offset_path or f"{path}.offset"
+        self.offset, self.inode = self.load_offset()
+        self.lock = threading.Lock()
+        # Set from Retry-After when ingestion answers 429; polls wait until then
+        self.retry_at = 0.0
+
+    def load_offset(self):
+        try:
+            with open(self.offset_path, 'r') as f:
+                state = json.load(f)
+            return int(state['offset']), state.get('inode')
+        except (OSError, ValueError, KeyError):
+            return 0, None
+
+    def save_offset(self):
+        # Write-then-rename so a crash never leaves a torn offset file
+        temp_path = f"{self.offset_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'offset': self.offset, 'inode': self.inode}, f)
+        os.replace(temp_path, self.offset_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and os.path.abspath(event.src_path) == os.path.abspath(self.path):
+            self.poll()
+
+    def poll(self):
+        """Reads and posts everything appended since the persisted offset."""
+        with self.lock:
+            self._poll()
+
+    def _poll(self):
+        if time.time() < self.retry_at:
+            return
+        fingerprint = file_fingerprint(self.path)
+        if fingerprint is None:
+            return
+        inode, size, _ = fingerprint
+
+        if inode != self.inode or size < self.offset:
+            if self.inode is not None:
+                print(f"[WATCHER] {self.path} was rotated or truncated. Reading from the start.")
+            self.offset, self.inode = 0, inode
+        if size == self.offset:
+            return
+
+        # Lines are read one at a time, so memory is bounded by one batch however far behind we are
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            position = self.offset
+            records = []
+            while position < size:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # Only complete lines are consumed; a partial last line waits for its newline
+                    break
+                position += len(line)
+                if line.strip():
+                    try:
+                        records.append(json.loads(line))
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        print(f"[WATCHER] Skipping malformed NDJSON line in {self.path}.")
+                if len(records) >= TAIL_BATCH_SIZE:
+                    if not self.commit_batch(records, position):
+                        return
+                    records = []
+            if position > self.offset:
+                self.commit_batch(records, position)
+
+    def commit_batch(self, records, position):
+        """
+        Posts a batch and, once it is delivered, advances the persisted offset to
+        position (the end of the batch's last line). Returns False if the batch
+        must be retried on a later poll; the offset then stays before it.
+        """
+        if records and not self.post_batch(records):
+            return False
+        self.offset = position
+        self.save_offset()
+        return True
+
+    def post_batch(self, records):
+        try:
+            resp = SESSION.post(BATCH_WEBHOOK_URL, json=records, timeout=10)
+        except requests.exceptions.ConnectionError:
+            print(f"[WATCHER] Webhook error: Connection Refused. Check if {BATCH_WEBHOOK_URL} is running.")
+            return False
+        except Exception as e:
+            print("[WATCHER] Webhook error:", e)
+            return False
+        if resp.status_code == 429:
+            # Queue is saturated: keep the offset and back off before the next poll
+            delay = retry_after_seconds(resp)
+            self.retry_at = time.time() + delay
+            print(f"[WATCHER] Batch webhook status: 429. Retrying in {delay:g}s.")
+            return False
+        if resp.status_code >= 500:
+            print(f"[WATCHER] Batch webhook status: {resp.status_code}. Will retry.")
+            return False
+        # 2xx and per-record rejections (4xx) are final; retrying would not change the outcome
+        print(f"[WATCHER] Posted {len(records)} record(s) from {self.path}. Webhook status: {resp.status_code}")
+        return True
+
+def run_tail_mode(path):
+    """Follows an append-only NDJSON file and posts new records as they are appended."""
+    tailer = NdjsonTailer(path)
+    obs = Observer()
+    obs.schedule(tailer, os.path.dirname(os.path.abspath(path)), recursive=False)
+    obs.start()
+    print(f"[WATCHER] PID {os.getpid()}, tailing {os.path.abspath(path)} from byte {tailer.offset}")
+
+    try:
+        while True:
+            # Catch up on start-up and cover missed filesystem events
+            tailer.poll()
+            time.sleep(TAIL_POLL_INTERVAL_S)
+    except KeyboardInterrupt:
+        obs.stop()
+    obs.join()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Posts CI run data to the ingestion webhook.")
+    parser.add_argument('--tail', metavar='NDJSON_FILE',
+                        help="Tail an append-only NDJSON file instead of watching the single-build JSON file.")
+    parser.add_argument('--watch-dir', metavar='DIR',
+                        help="Watch a drop directory of per-project report files instead of a single file.")
+    parser.add_argument('--pattern', default='*.json',
+                        help="Glob for report files in --watch-dir (default: *.json); e.g. '*.info' or '*.xml' "
+                             "for LCOV / Cobertura coverage reports named <project>__<build_id>.<ext>.")
+    parser.add_argument('--project', default=COVERAGE_PROJECT,
+                        help="Project of coverage reports whose file name does not contain '__'.")
+    parser.add_argument('--spool-dir', default=SPOOL_DIR,
+                        help=f"Directory for posts awaiting retry (default: {SPOOL_DIR}).")
+    args = parser.parse_args()
+    COVERAGE_PROJECT = args.project
+
+    # Failed posts survive ingestion outages and watcher restarts
+    SPOOL = RetrySpool(args.spool_dir)
+    SPOOL.start()
+
+    if args.tail:
+        run_tail_mode(args.tail)
+        raise SystemExit(0)
+    if args.watch_dir:
+        run_directory_mode(args.watch_dir, args.pattern)
+        raise SystemExit(0)
+
     handler = StableFileHandler(settle_time=1.0, debounce=0.6)
     obs = Observer()
     obs.schedule(handler, ".", recursive=False)
     obs.start()
     print(f"[WATCHER] PID {os.getpid()}, watching {os.getcwd()}/{TARGET_FILE}")
-    
+
     # Initialize hash by checking the file once on startup (Simulated)
-    initial_hash = handler.compute_hash(TARGET_FILE)
+    _last_fingerprint = file_fingerprint(TARGET_FILE)
+    initial_content, initial_hash = read_snapshot(TARGET_FILE)
     if initial_hash:
         _last_hash = initial_hash
         print("[WATCHER] Initial state loaded.")
         # Attempt to post the initial data to ensure the pipeline is initialized
         try:
-            with open(TARGET_FILE, 'r') as f:
-                data_to_post = json.load(f)
-            resp = requests.post(WEBHOOK_URL, json=data_to_post, timeout=5)
-            print(f"[WATCHER] Initial data loaded. Posting to webhook. Status: {resp.status_code}")
+            data_to_post = json.loads(initial_content)
+            print("[WATCHER] Initial data loaded. Posting to webhook.")
+            deliver(WEBHOOK_URL, data_to_post)
         except Exception as e:
             print(f"[WATCHER] Initial webhook post failed: {e}")
 
@@ -112,4 +571,4 @@ if __name__ == "__main__":
             time.sleep(1)
     except KeyboardInterrupt:
         obs.stop()
-    obs.join()
\ No newline at end of file
+    obs.join()
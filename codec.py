@@ -0,0 +1,83 @@
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# --- CONFIGURATION ---
+# Codec used for newly written queue messages and stored summaries: 'json' or 'msgpack'.
+# Readers accept both, so writers can be switched one service at a time during a rollout.
+MESSAGE_CODEC = os.getenv('MESSAGE_CODEC', 'json')
+
+# Binary messages start with this byte. 0xC1 is never used by MessagePack and
+# cannot start a JSON document, so legacy unmarked JSON stays readable.
+MSGPACK_MARKER = b'\xc1'
+
+class CodecError(ValueError):
+    """Raised when a message cannot be decoded with the codec its marker names."""
+
+class JsonCodec:
+    name = 'json'
+
+    @staticmethod
+    def encode(obj):
+        # Unmarked, compact JSON: identical to what pre-codec writers produced, minus whitespace
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj):
+        return MSGPACK_MARKER + msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data[1:], raw=False, strict_map_key=False)
+
+CODECS = {'json': JsonCodec, 'msgpack': MsgpackCodec}
+
+def _writer_codec():
+    if MESSAGE_CODEC not in CODECS:
+        print(f"[CODEC] Unknown MESSAGE_CODEC '{MESSAGE_CODEC}'. Writing JSON.")
+        return JsonCodec
+    if MESSAGE_CODEC == 'msgpack' and msgpack is None:
+        print("[CODEC] MESSAGE_CODEC=msgpack but msgpack is not installed (pip install msgpack). Writing JSON.")
+        return JsonCodec
+    return CODECS[MESSAGE_CODEC]
+
+WRITER = _writer_codec()
+
+def encode(obj):
+    """Encodes obj with the configured writer codec. Returns bytes."""
+    return WRITER.encode(obj)
+
+def decode(data):
+    """
+    Decodes a message written by any codec, dispatching on its first byte.
+    Accepts bytes or str (legacy JSON read through a decoding client).
+    Raises CodecError for malformed data or a codec that is not installed.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:1] == MSGPACK_MARKER:
+        if msgpack is None:
+            raise CodecError("Message is MessagePack-encoded but msgpack is not installed")
+        try:
+            return MsgpackCodec.decode(data)
+        except Exception as e:
+            raise CodecError(f"Invalid MessagePack message: {e}") from None
+    try:
+        return JsonCodec.decode(data)
+    except ValueError as e:
+        raise CodecError(f"Invalid JSON message: {e}") from None
+
+def to_json(obj):
+    """Serializes a decoded message for HTTP responses (compact JSON text)."""
+    return json.dumps(obj, separators=(',', ':'))
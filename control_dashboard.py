@@ -1,128 +1,408 @@
+import argparse
+import math
 import subprocess
 import os
 import signal
+import socket
 import time
-import sys 
+import sys
 import atexit
+import urllib.error
+import urllib.request
+
+import redis
+
+import settings
+from settings import REDIS_DB, REDIS_HOST, REDIS_PORT, WORKER_METRICS_PORT, queue_length
 
 # Dictionary to hold the subprocess Popen objects
-# Key: Service name (string), Value: Process object (subprocess.Popen)
-PROCESSES = {} 
+# Key: Instance name (string), Value: Process object (subprocess.Popen)
+# Single-instance services use the service name; extra worker instances are 'worker-1', 'worker-2', ...
+PROCESSES = {}
+
+# Restart bookkeeping per instance: {'failures': int, 'next_start': float or None}
+RESTARTS = {}
+
+# Number of instances the orchestrator keeps running per service
+DESIRED = {}
 
 # --- SERVICE CONFIGURATION ---
+# requires: services that must be ready before this one starts (independent services start together)
+# redis:    wait for a Redis PING before starting
+# port:     readiness waits until the port accepts connections
+# health:   readiness waits until GET http://localhost:{port}{health} answers 200
+# scalable: may run as several instances (--workers / --autoscale)
+# args:     extra command-line arguments of the script
 SERVICES = {
-    # Worker must start first as it is the consumer
-    'worker': {'script': 'worker_processor.py', 'port': None},
-    # API must start before Ingestion to avoid errors
-    'dashboard_api': {'script': 'dashboard_api.py', 'port': 5002},
+    # Worker is the consumer; its /healthz sidecar reports Redis and the metrics config.
+    # The stream backend is consumed by stream_worker.py, one consumer process per instance
+    'worker': ({'script': 'stream_worker.py', 'args': ('--processes', '1'), 'port': None, 'redis': True, 'scalable': True}
+               if settings.QUEUE_BACKEND == 'stream' else
+               {'script': 'worker_processor.py', 'port': None, 'redis': True, 'scalable': True}),
+    # API serves the dashboard from Redis
+    'dashboard_api': {'script': 'dashboard_api.py', 'port': settings.DASHBOARD_API_PORT, 'health': '/metrics', 'redis': True},
     # Ingestion API needs to be running to receive data from the watcher
-    'ingestion': {'script': 'ingestion_service.py', 'port': 5000}, 
+    'ingestion': {'script': 'ingestion_service.py', 'port': settings.INGESTION_PORT, 'health': '/metrics'},
     # Watcher starts last as it triggers the whole pipeline
-    'watcher': {'script': 'ci_data_watcher.py', 'port': None}
+    'watcher': {'script': 'ci_data_watcher.py', 'port': None, 'requires': ('ingestion',)}
 }
 
-def start_service(service_name):
-    """Starts a single service in a new subprocess, redirecting output to the console."""
+# --- READINESS ---
+# How long a service may take to become ready before the orchestrator moves on without it
+READY_TIMEOUT_S = float(os.getenv('ORCHESTRATOR_READY_TIMEOUT_S', 30))
+READY_POLL_INTERVAL_S = 0.1
+# Worker instance i gets its /healthz sidecar on WORKER_METRICS_PORT + i
+
+# --- RESTART POLICY ---
+# Crashed children are restarted after a delay doubling per consecutive crash, up to the maximum
+RESTART_BACKOFF_INITIAL_S = 1.0
+RESTART_BACKOFF_MAX_S = 60.0
+# A child that ran at least this long before exiting is considered healthy again (backoff resets)
+RESTART_RESET_AFTER_S = 60.0
+SUPERVISE_INTERVAL_S = 0.5
+
+# --- AUTOSCALING (--autoscale) ---
+# Target number of queued messages per worker instance
+AUTOSCALE_MESSAGES_PER_WORKER = int(os.getenv('AUTOSCALE_MESSAGES_PER_WORKER', 5000))
+AUTOSCALE_MAX_WORKERS = int(os.getenv('AUTOSCALE_MAX_WORKERS', 8))
+# Queue depth is checked this often; workers are added at once but removed one per cooldown
+AUTOSCALE_INTERVAL_S = 5.0
+AUTOSCALE_SCALE_DOWN_COOLDOWN_S = 60.0
+
+def instance_name(service_name, index=0):
+    return service_name if index == 0 else f"{service_name}-{index}"
+
+def instance_port(service_name, index=0):
+    """Port the instance's readiness is checked on (None if it has none)."""
+    if service_name == 'worker':
+        if not WORKER_METRICS_PORT:
+            return None
+        # stream_worker.py serves its consumer's sidecar on the port after WORKER_METRICS_PORT
+        return WORKER_METRICS_PORT + index + (1 if settings.QUEUE_BACKEND == 'stream' else 0)
+    return SERVICES[service_name]['port']
+
+def instance_env(service_name, index=0):
+    env = dict(os.environ)
+    if service_name == 'worker':
+        # Stable per instance, so restarts and rescaling reuse the same rolling statistics shard
+        env['WORKER_ID'] = f"{socket.gethostname()}-worker-{index}"
+        if WORKER_METRICS_PORT:
+            # Each worker instance gets its own /metrics and /healthz port
+            env['WORKER_METRICS_PORT'] = str(WORKER_METRICS_PORT + index)
+    return env
+
+def start_service(service_name, index=0):
+    """Starts a single service instance in a new subprocess, redirecting output to the console."""
     config = SERVICES[service_name]
     script = config['script']
-    
+    name = instance_name(service_name, index)
+
     # 1. Check if a process object exists and is still running
-    current_process = PROCESSES.get(service_name)
+    current_process = PROCESSES.get(name)
     if current_process and current_process.poll() is None:
-        print(f"[ORCHESTRATOR] {service_name.upper()} is already running (PID: {current_process.pid}).")
+        print(f"[ORCHESTRATOR] {name.upper()} is already running (PID: {current_process.pid}).")
         return True
-    
+
     # 2. If a process object exists but has stopped, clean it up
     if current_process and current_process.poll() is not None:
-        del PROCESSES[service_name]
+        del PROCESSES[name]
 
     try:
         # Start the subprocess, using stdout/stderr of the parent process
         # start_new_session=True creates a new process group, which simplifies cleanup
         process = subprocess.Popen(
-            [sys.executable, script], 
+            [sys.executable, script, *config.get('args', ())],
             stdout=sys.stdout, # Direct child output to the parent console
             stderr=sys.stderr, # Direct child output to the parent console
-            start_new_session=True 
+            env=instance_env(service_name, index),
+            start_new_session=True
         )
-        PROCESSES[service_name] = process
-        print(f"[ORCHESTRATOR] STARTED {service_name.upper()} (PID: {process.pid}) running script: {script}")
+        process.started_at = time.monotonic()
+        PROCESSES[name] = process
+        print(f"[ORCHESTRATOR] STARTED {name.upper()} (PID: {process.pid}) running script: {script}")
         return True
     except FileNotFoundError:
         print(f"[ORCHESTRATOR] ERROR: Python or script {script} not found.")
         return False
     except Exception as e:
-        print(f"[ORCHESTRATOR] ERROR starting {service_name}: {e}")
+        print(f"[ORCHESTRATOR] ERROR starting {name}: {e}")
         return False
 
-def stop_service(service_name):
-    """Stops a single service subprocess."""
-    process = PROCESSES.get(service_name)
+def stop_service(service_name, index=0):
+    """Stops a single service instance (SIGTERM, then SIGKILL if it does not exit within 5 seconds)."""
+    name = instance_name(service_name, index)
+    RESTARTS.pop(name, None)
+    process = PROCESSES.get(name)
     if process and process.poll() is None:
         try:
             # We use os.kill to terminate the process
             os.kill(process.pid, signal.SIGTERM)
-            process.wait(timeout=5) # Wait for the process to terminate
-            del PROCESSES[service_name]
-            print(f"[ORCHESTRATOR] STOPPED {service_name.upper()} (PID: {process.pid})")
+            try:
+                process.wait(timeout=5) # Wait for the process to terminate
+            except subprocess.TimeoutExpired:
+                print(f"[ORCHESTRATOR] {name.upper()} did not exit after SIGTERM. Killing it.")
+                process.kill()
+                process.wait()
+            del PROCESSES[name]
+            print(f"[ORCHESTRATOR] STOPPED {name.upper()} (PID: {process.pid})")
             return True
         except ProcessLookupError:
             # Process was already gone
-            if service_name in PROCESSES:
-                del PROCESSES[service_name]
+            if name in PROCESSES:
+                del PROCESSES[name]
             return True
         except Exception as e:
-            print(f"ERROR stopping {service_name}: {e}")
+            print(f"ERROR stopping {name}: {e}")
             return False
-    
+
     # Clean up if process object exists but has stopped
-    if service_name in PROCESSES and process and process.poll() is not None:
-        del PROCESSES[service_name]
+    if name in PROCESSES and process and process.poll() is not None:
+        del PROCESSES[name]
         return True
-    
+
     return False
 
+# --- READINESS CHECKS ---
+
+def redis_ready():
+    try:
+        return redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, socket_connect_timeout=1).ping()
+    except redis.exceptions.RedisError:
+        return False
+
+def port_open(port):
+    try:
+        with socket.create_connection(('localhost', port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+def http_ok(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+def instance_ready(service_name, index=0):
+    """Readiness of one running instance: its port accepts connections and its health endpoint answers 200."""
+    port = instance_port(service_name, index)
+    if port is None:
+        # No endpoint to probe: ready once started
+        return True
+    health = '/healthz' if service_name == 'worker' else SERVICES[service_name].get('health')
+    if health:
+        return http_ok(f"http://localhost:{port}{health}")
+    return port_open(port)
+
+def wait_until(check, timeout):
+    """Polls check() until it returns True or timeout seconds pass. Returns the last result."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if check():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(READY_POLL_INTERVAL_S)
+
+def wait_for_service(service_name, timeout=READY_TIMEOUT_S):
+    """
+    Waits until every desired instance of a service is ready. Returns False if an
+    instance exited or the timeout passed first.
+    """
+    started = time.monotonic()
+    pending = set(range(DESIRED.get(service_name, 1)))
+
+    def check():
+        for index in list(pending):
+            process = PROCESSES.get(instance_name(service_name, index))
+            if process is None or process.poll() is not None:
+                raise ChildProcessError(instance_name(service_name, index))
+            if instance_ready(service_name, index):
+                pending.discard(index)
+        return not pending
+
+    try:
+        ready = wait_until(check, timeout)
+    except ChildProcessError as e:
+        print(f"[ORCHESTRATOR] {str(e).upper()} exited during startup.")
+        return False
+    if ready:
+        print(f"[ORCHESTRATOR] {service_name.upper()} ready in {time.monotonic() - started:.2f}s.")
+    else:
+        print(f"[ORCHESTRATOR] WARNING: {service_name.upper()} not ready after {timeout:.0f}s. Continuing.")
+    return ready
+
+def start_pipeline():
+    """
+    Starts every service as soon as the services it requires are ready.
+    Independent services start together, so a cold start takes as long as the
+    slowest dependency chain rather than the sum of fixed delays.
+    """
+    remaining = list(SERVICES)
+    handled = set()
+    redis_checked = False
+    while remaining:
+        wave = [name for name in remaining if all(dep in handled for dep in SERVICES[name].get('requires', ()))]
+        if not redis_checked and any(SERVICES[name].get('redis') for name in wave):
+            redis_checked = True
+            if wait_until(redis_ready, READY_TIMEOUT_S):
+                print(f"[ORCHESTRATOR] Redis at {REDIS_HOST}:{REDIS_PORT} is ready.")
+            else:
+                print(f"[ORCHESTRATOR] WARNING: Redis at {REDIS_HOST}:{REDIS_PORT} not reachable. Starting services anyway.")
+        for name in wave:
+            for index in range(DESIRED.get(name, 1)):
+                start_service(name, index)
+        for name in wave:
+            # Dependents start even if a service is not ready; supervision restarts it if it crashed
+            wait_for_service(name)
+            handled.add(name)
+            remaining.remove(name)
+
+# --- SUPERVISION ---
+
+def restart_delay(failures):
+    return min(RESTART_BACKOFF_MAX_S, RESTART_BACKOFF_INITIAL_S * 2 ** (failures - 1))
+
+def supervise(now=None):
+    """
+    Restarts instances that exited, waiting restart_delay() after each
+    consecutive crash. An instance that had been running for
+    RESTART_RESET_AFTER_S counts as a first crash again.
+    """
+    now = time.monotonic() if now is None else now
+    for service_name, count in DESIRED.items():
+        for index in range(count):
+            name = instance_name(service_name, index)
+            process = PROCESSES.get(name)
+            state = RESTARTS.setdefault(name, {'failures': 0, 'next_start': None})
+            if process is not None and process.poll() is None:
+                continue
+            if state['next_start'] is None:
+                if process is not None and now - getattr(process, 'started_at', now) >= RESTART_RESET_AFTER_S:
+                    state['failures'] = 0
+                state['failures'] += 1
+                state['next_start'] = now + restart_delay(state['failures'])
+                exit_code = process.returncode if process is not None else None
+                print(f"[ORCHESTRATOR] {name.upper()} exited (code {exit_code}). "
+                      f"Restarting in {restart_delay(state['failures']):.1f}s (crash #{state['failures']}).")
+            elif now >= state['next_start']:
+                state['next_start'] = None
+                start_service(service_name, index)
+
+# --- WORKER SCALING ---
+
+def scale_workers(count):
+    """Starts or stops worker instances so that exactly count are desired; the highest indexes stop first."""
+    current = DESIRED.get('worker', 0)
+    if count == current:
+        return
+    print(f"[ORCHESTRATOR] Scaling workers from {current} to {count}.")
+    DESIRED['worker'] = count
+    for index in range(current, count):
+        start_service('worker', index)
+    for index in reversed(range(count, current)):
+        stop_service('worker', index)
+
+def desired_workers(depth, min_workers, max_workers):
+    return max(min_workers, min(max_workers, math.ceil(depth / AUTOSCALE_MESSAGES_PER_WORKER)))
+
+class Autoscaler:
+    """Follows ci_data_queue depth: scales up at once, scales down one worker per cooldown."""
+
+    def __init__(self, min_workers, max_workers):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.client = settings.redis_client()
+        self.next_check = 0.0
+        self.last_change = time.monotonic()
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now < self.next_check:
+            return
+        self.next_check = now + AUTOSCALE_INTERVAL_S
+        try:
+            depth = queue_length(self.client)
+        except redis.exceptions.RedisError as e:
+            print(f"[ORCHESTRATOR] Autoscaler could not read the queue depth: {e}")
+            return
+        current = DESIRED.get('worker', 0)
+        target = desired_workers(depth, self.min_workers, self.max_workers)
+        if target > current:
+            scale_workers(target)
+            self.last_change = now
+        elif target < current and now - self.last_change >= AUTOSCALE_SCALE_DOWN_COOLDOWN_S:
+            scale_workers(current - 1)
+            self.last_change = now
+
 def cleanup_all():
     """Stops all running services on script exit or interrupt."""
     if not PROCESSES:
         return
 
     print("\n\n--- Orchestrator: Initiating graceful shutdown of all services... ---")
-    
+    # Nothing may be restarted while shutting down
+    DESIRED.clear()
+
     # Stop services in reverse order (Watcher -> Ingestion -> API -> Worker)
     for name in reversed(list(SERVICES.keys())):
-        stop_service(name)
-        
+        indexes = [0 if instance == name else int(instance[len(name) + 1:])
+                   for instance in list(PROCESSES) if instance == name or instance.startswith(f"{name}-")]
+        for index in sorted(indexes, reverse=True):
+            stop_service(name, index)
+
     print("--- Orchestrator: All services stopped. ---")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Starts and supervises the CI metrics pipeline.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker instances: worker_processor.py, or stream_worker.py with "
+                             "QUEUE_BACKEND=stream (initial count with --autoscale; default: 1).")
+    parser.add_argument('--autoscale', action='store_true',
+                        help="Scale workers with the ci_data_queue depth between --min-workers and --max-workers.")
+    parser.add_argument('--min-workers', type=int, default=1)
+    parser.add_argument('--max-workers', type=int, default=AUTOSCALE_MAX_WORKERS)
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
+    args = parse_args()
     # Register the cleanup function to run on normal exit or interrupt
     atexit.register(cleanup_all)
-    
+    # Stop children on SIGTERM too (e.g. from a process manager), not only on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+
     print("=====================================================")
     print(" CI/CD PIPELINE ORCHESTRATOR (Command Line Mode)     ")
     print("=====================================================")
-    
-    print("\n--- Starting Full Pipeline Sequentially ---")
-    
-    # Start services in defined order
-    for name in SERVICES.keys():
-        start_service(name)
-        # Add a slight delay for API services to bind ports
-        if SERVICES[name].get('port'):
-            time.sleep(1.5)
+
+    DESIRED.update({name: 1 for name in SERVICES})
+    DESIRED['worker'] = max(1, args.workers)
+    autoscaler = None
+    if args.autoscale:
+        min_workers = max(1, args.min_workers)
+        DESIRED['worker'] = max(min_workers, min(args.max_workers, DESIRED['worker']))
+        autoscaler = Autoscaler(min_workers, max(min_workers, args.max_workers))
+
+    print("\n--- Starting Full Pipeline ---")
+    started = time.monotonic()
+    start_pipeline()
 
     print("\n-----------------------------------------------------")
-    print(f"Pipeline is RUNNING.                                  ")
+    print(f"Pipeline is RUNNING (started in {time.monotonic() - started:.1f}s, "
+          f"{DESIRED['worker']} worker(s){', autoscaling' if autoscaler else ''}).")
     print("Press Ctrl+C to stop all services gracefully.          ")
     print("-------------------------------------------------------")
 
     try:
-        # Keep the main process alive indefinitely until interrupted (Ctrl+C)
+        # Keep the main process alive, restarting crashed services, until interrupted (Ctrl+C)
         while True:
-            time.sleep(0.5)
-            
+            time.sleep(SUPERVISE_INTERVAL_S)
+            supervise()
+            if autoscaler is not None:
+                autoscaler.tick()
+
     except KeyboardInterrupt:
         print("\nInterrupt received. Exiting Orchestrator...")
-    # The atexit handler (cleanup_all) will run automatically here
\ No newline at end of file
+    # The atexit handler (cleanup_all) will run automatically here
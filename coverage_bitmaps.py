@@ -0,0 +1,210 @@
+import base64
+import hashlib
+import os
+import re
+import struct
+import zlib
+
+# --- CONFIGURATION ---
+# Line bitmaps of a build are kept for this long after it was ingested
+COVERAGE_LINES_RETENTION_S = int(os.getenv('COVERAGE_LINES_RETENTION_S', 90 * 24 * 3600))
+# zlib level of stored bitmaps; coverage runs are long, so even fast levels compress well
+COMPRESSION_LEVEL = 6
+# Changed files fetched per HMGET while diffing
+DIFF_CHUNK = 1000
+# Highest accepted line number; bounds the bitmap of a single file to MAX_LINE_NUMBER / 8 bytes
+MAX_LINE_NUMBER = int(os.getenv('COVERAGE_MAX_LINE_NUMBER', 1_000_000))
+# Upper bound on the decompressed size of one blob (two bitmaps of MAX_LINE_NUMBER bits plus the header)
+MAX_BLOB_SIZE = 2 * (MAX_LINE_NUMBER // 8 + 1) + 4
+
+KEY_PREFIX = 'coverage_lines'
+
+# --- KEY LAYOUT ---
+# coverage_lines:{project}:{build}           HASH  path -> compressed bitmaps of the file (see encode)
+# coverage_lines:{project}:{build}:digests   HASH  path -> 8-byte digest of the blob, compared before any blob is read
+
+# Length of the covered bitmap inside a decompressed blob
+_HEADER = struct.Struct('>I')
+_RUNS = re.compile('1+')
+
+class CoverageBitmapError(ValueError):
+    """Raised for line coverage data that cannot be decoded."""
+
+def _key(project_id, build_id, *parts):
+    return ':'.join((KEY_PREFIX, str(project_id), str(build_id)) + parts)
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+# --- BITMAPS ---
+# A file's lines are an int used as a bitmap: bit n is set when line n is in the set
+
+def from_lines(numbers):
+    """
+    Bitmap of an iterable of line numbers.
+    Raises CoverageBitmapError for numbers outside 1..MAX_LINE_NUMBER.
+    """
+    numbers = list(numbers)
+    if not numbers:
+        return 0
+    low, high = min(numbers), max(numbers)
+    if low < 1 or high > MAX_LINE_NUMBER:
+        raise CoverageBitmapError(f"Line numbers must be between 1 and {MAX_LINE_NUMBER}, got {low if low < 1 else high}")
+    bits = bytearray(high // 8 + 1)
+    try:
+        for n in numbers:
+            bits[n >> 3] |= 1 << (n & 7)
+    except (IndexError, OverflowError, TypeError):
+        raise CoverageBitmapError("Line numbers must be integers") from None
+    return int.from_bytes(bits, 'little')
+
+def to_ranges(bitmap):
+    """Set lines of a bitmap as inclusive [first, last] ranges."""
+    bits = bin(bitmap)[:1:-1]
+    return [[run.start(), run.end() - 1] for run in _RUNS.finditer(bits)]
+
+def _to_bytes(bitmap):
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+def encode(covered, instrumented):
+    """
+    Compressed blob of one file: covered and instrumented line bitmaps, zlib
+    compressed together. Covered lines always count as instrumented.
+    """
+    covered_bytes = _to_bytes(covered)
+    raw = _HEADER.pack(len(covered_bytes)) + covered_bytes + _to_bytes(instrumented | covered)
+    return zlib.compress(raw, COMPRESSION_LEVEL)
+
+def decode(blob):
+    """
+    Returns (covered, instrumented) bitmaps of a blob made by encode().
+    Blobs that decompress to more than MAX_BLOB_SIZE bytes are rejected unread.
+    """
+    try:
+        inflater = zlib.decompressobj()
+        raw = inflater.decompress(blob, MAX_BLOB_SIZE)
+        if inflater.unconsumed_tail or not inflater.eof:
+            raise CoverageBitmapError(f"Line coverage blob is truncated or exceeds {MAX_BLOB_SIZE} bytes")
+        (size,) = _HEADER.unpack_from(raw)
+    except (zlib.error, struct.error, TypeError) as e:
+        raise CoverageBitmapError(f"Invalid line coverage blob: {e}") from None
+    end = _HEADER.size + size
+    return int.from_bytes(raw[_HEADER.size:end], 'little'), int.from_bytes(raw[end:], 'little')
+
+def digest(blob):
+    return hashlib.blake2b(blob, digest_size=8).digest()
+
+def encode_files(line_maps):
+    """Blobs of parsed line maps ({path: (covered, instrumented)}, see coverage_reports)."""
+    return {path: encode(covered, instrumented) for path, (covered, instrumented) in line_maps.items()}
+
+def parse_line_coverage(value):
+    """
+    Reads the 'line_coverage' field of a webhook payload: {path: blob} where each
+    blob is either the base64 text of encode() (as posted by the watcher) or
+    {"covered": [line, ...], "instrumented": [line, ...]}. Returns {path: blob}.
+    Raises CoverageBitmapError for anything else.
+    """
+    if not isinstance(value, dict):
+        raise CoverageBitmapError("line_coverage must be an object of file paths")
+    blobs = {}
+    for path, lines in value.items():
+        if isinstance(lines, str):
+            try:
+                blob = base64.b64decode(lines, validate=True)
+            except ValueError:
+                raise CoverageBitmapError(f"line_coverage of {path} is not valid base64") from None
+            decode(blob)
+        elif isinstance(lines, dict):
+            try:
+                blob = encode(from_lines(int(n) for n in lines.get('covered', ())),
+                              from_lines(int(n) for n in lines.get('instrumented', ())))
+            except CoverageBitmapError as e:
+                raise CoverageBitmapError(f"line_coverage of {path}: {e}") from None
+            except (TypeError, ValueError, OverflowError):
+                raise CoverageBitmapError(f"line_coverage of {path} needs lists of line numbers") from None
+        else:
+            raise CoverageBitmapError(f"line_coverage of {path} must be base64 text or an object")
+        blobs[str(path)] = blob
+    return blobs
+
+def to_payload(blobs):
+    """JSON form of blobs for the 'line_coverage' webhook field."""
+    return {path: base64.b64encode(blob).decode('ascii') for path, blob in blobs.items()}
+
+# --- STORAGE ---
+
+def queue_build(pipe, project_id, build_id, blobs):
+    """
+    Adds the commands that store (or replace) a build's per-file blobs and their
+    digests to a pipeline (sync or asyncio).
+    """
+    blob_key, digest_key = _key(project_id, build_id), _key(project_id, build_id, 'digests')
+    pipe.delete(blob_key, digest_key)
+    if blobs:
+        pipe.hset(blob_key, mapping=blobs)
+        pipe.hset(digest_key, mapping={path: digest(blob) for path, blob in blobs.items()})
+        pipe.expire(blob_key, COVERAGE_LINES_RETENTION_S)
+        pipe.expire(digest_key, COVERAGE_LINES_RETENTION_S)
+    return pipe
+
+# --- DIFF ---
+
+def _count(bitmap):
+    return bin(bitmap).count('1')
+
+def diff(r, project_id, base_build, head_build, prefix=None):
+    """
+    Line coverage changes from base_build to head_build of a project, optionally
+    limited to paths starting with prefix. Only the digests of both builds are read
+    in full; blobs are fetched and decoded for files whose digest differs.
+    Per changed file: 'gained' lines (covered in head, not in base), 'lost' lines
+    (covered in base, instrumented but uncovered in head) as ranges, and the coverage
+    of 'new_lines' (instrumented in head only). Lines are compared by number, so
+    edits that shift a file show up as changes.
+    Raises LookupError if a build has no stored line coverage.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(_key(project_id, base_build, 'digests'))
+    pipe.hgetall(_key(project_id, head_build, 'digests'))
+    base_digests, head_digests = pipe.execute()
+    for build_id, digests in ((base_build, base_digests), (head_build, head_digests)):
+        if not digests:
+            raise LookupError(f"No line coverage stored for build {build_id} of project {project_id}.")
+
+    base_digests = {_decode(path): value for path, value in base_digests.items()}
+    head_digests = {_decode(path): value for path, value in head_digests.items()}
+    paths = base_digests.keys() | head_digests.keys()
+    if prefix:
+        paths = {path for path in paths if path.startswith(prefix)}
+    changed = sorted(path for path in paths if base_digests.get(path) != head_digests.get(path))
+
+    files = {}
+    totals = {'files_compared': len(paths), 'files_changed': 0, 'gained_lines': 0, 'lost_lines': 0,
+              'new_lines_covered': 0, 'new_lines_total': 0}
+    for start in range(0, len(changed), DIFF_CHUNK):
+        chunk = changed[start:start + DIFF_CHUNK]
+        pipe = r.pipeline(transaction=False)
+        pipe.hmget(_key(project_id, base_build), chunk)
+        pipe.hmget(_key(project_id, head_build), chunk)
+        base_blobs, head_blobs = pipe.execute()
+        for path, base_blob, head_blob in zip(chunk, base_blobs, head_blobs):
+            base_covered, base_instrumented = decode(base_blob) if base_blob is not None else (0, 0)
+            head_covered, head_instrumented = decode(head_blob) if head_blob is not None else (0, 0)
+            gained = head_covered & ~base_covered
+            lost = base_covered & head_instrumented & ~head_covered
+            new_lines = head_instrumented & ~base_instrumented
+            if not (gained or lost or new_lines):
+                continue
+            new_covered = _count(new_lines & head_covered)
+            files[path] = {
+                'gained': to_ranges(gained),
+                'lost': to_ranges(lost),
+                'new_lines': {'covered': new_covered, 'total': _count(new_lines)},
+            }
+            totals['files_changed'] += 1
+            totals['gained_lines'] += _count(gained)
+            totals['lost_lines'] += _count(lost)
+            totals['new_lines_covered'] += new_covered
+            totals['new_lines_total'] += _count(new_lines)
+    return {'totals': totals, 'files': files}
@@ -0,0 +1,252 @@
+import time
+import xml.etree.ElementTree as ET
+
+import coverage_bitmaps
+
+# --- CONFIGURATION ---
+# Bytes read per chunk when parsing a report from a file or request stream
+CHUNK_SIZE = 1024 * 1024
+FORMATS = ('lcov', 'cobertura')
+
+class CoverageReportError(ValueError):
+    """Raised when a coverage report is malformed or in an unknown format."""
+
+class CoverageTotals:
+    """
+    Line coverage of one report: overall totals and per-file (covered, total) counts.
+    Memory is proportional to the number of source files, not to the report size.
+    With lines=True, line_maps also holds each file's (covered, instrumented) line
+    bitmaps (see coverage_bitmaps), about one bit per source line.
+    """
+    __slots__ = ('format', 'covered_lines', 'total_lines', 'files', 'line_maps')
+
+    def __init__(self, fmt, lines=False):
+        self.format = fmt
+        self.covered_lines = 0
+        self.total_lines = 0
+        self.files = {}
+        self.line_maps = {} if lines else None
+
+    def add_file(self, path, covered, total, line_maps=None):
+        previous = self.files.get(path)
+        if line_maps is not None and self.line_maps is not None:
+            if path in self.line_maps:
+                # Repeated file: a line is covered if any section covered it
+                line_maps = tuple(a | b for a, b in zip(self.line_maps[path], line_maps))
+            self.line_maps[path] = line_maps
+        if previous is not None:
+            # The file was already reported (e.g. by an unmerged LCOV test section): keep the better count
+            self.covered_lines -= previous[0]
+            self.total_lines -= previous[1]
+            covered, total = max(covered, previous[0]), max(total, previous[1])
+        self.files[path] = (covered, total)
+        self.covered_lines += covered
+        self.total_lines += total
+
+    def summary(self):
+        """Short description of the report for API responses and logs."""
+        return {'format': self.format, 'covered_lines': self.covered_lines,
+                'total_lines': self.total_lines, 'files': len(self.files)}
+
+class LcovParser:
+    """
+    Push parser for LCOV tracefiles. Chunks may split lines anywhere; only the
+    unfinished last line of a chunk is buffered. Each SF ... end_of_record
+    section counts its DA lines (or LF/LH when it has none).
+    """
+
+    def __init__(self, lines=False):
+        self.totals = CoverageTotals('lcov', lines)
+        self._pending = b''
+        self._line_number = 0
+        self._path = None
+        self._covered = self._total = 0
+        self._found = self._hit = None
+        # Line numbers of the current record, when line maps are collected
+        self._lines = ([], []) if lines else None
+
+    def feed(self, chunk):
+        lines = (self._pending + chunk).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def _line(self, line):
+        self._line_number += 1
+        line = line.strip()
+        try:
+            if line.startswith(b'DA:'):
+                number, hits = line[3:].split(b',', 2)[:2]
+                self._total += 1
+                covered = int(hits) > 0
+                if covered:
+                    self._covered += 1
+                if self._lines is not None:
+                    number = int(number)
+                    self._lines[1].append(number)
+                    if covered:
+                        self._lines[0].append(number)
+            elif line.startswith(b'SF:'):
+                self._path = line[3:].decode('utf-8', 'replace')
+                self._covered = self._total = 0
+                self._found = self._hit = None
+                if self._lines is not None:
+                    self._lines = ([], [])
+            elif line.startswith(b'LF:'):
+                self._found = int(line[3:])
+            elif line.startswith(b'LH:'):
+                self._hit = int(line[3:])
+            elif line == b'end_of_record':
+                self._end_record()
+        except (IndexError, ValueError):
+            raise CoverageReportError(f"Malformed LCOV line {self._line_number}: {line[:80]!r}") from None
+
+    def _end_record(self):
+        if self._path is None:
+            raise CoverageReportError(f"end_of_record without SF at line {self._line_number}")
+        line_maps = None
+        if self._total == 0 and self._found is not None:
+            self._covered, self._total = self._hit or 0, self._found
+        elif self._lines is not None:
+            try:
+                line_maps = tuple(coverage_bitmaps.from_lines(numbers) for numbers in self._lines)
+            except coverage_bitmaps.CoverageBitmapError as e:
+                raise CoverageReportError(f"Bad line numbers in LCOV record for {self._path}: {e}") from None
+        self.totals.add_file(self._path, self._covered, self._total, line_maps)
+        self._path = None
+
+    def close(self):
+        if self._pending:
+            self._line(self._pending)
+            self._pending = b''
+        if self._path is not None:
+            # Truncated last record: count what it listed
+            self._end_record()
+        return self.totals
+
+class CoberturaParser:
+    """
+    Push parser for Cobertura XML built on XMLPullParser. Class-level <line>
+    elements are counted per class filename (method-level duplicates are
+    skipped) and every element is cleared once counted, so the parsed tree
+    never grows beyond the current package.
+    """
+
+    def __init__(self, lines=False):
+        self.totals = CoverageTotals('cobertura', lines)
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._path = None
+        self._in_method = False
+        self._covered = self._total = 0
+        self._lines = ([], []) if lines else None
+
+    def feed(self, chunk):
+        try:
+            self._parser.feed(chunk)
+        except ET.ParseError as e:
+            raise CoverageReportError(f"Malformed Cobertura XML: {e}") from None
+        self._drain()
+
+    def _drain(self):
+        try:
+            for event, element in self._parser.read_events():
+                tag = element.tag
+                if event == 'start':
+                    if tag == 'class':
+                        self._path = element.get('filename') or element.get('name')
+                        self._covered = self._total = 0
+                        if self._lines is not None:
+                            self._lines = ([], [])
+                    elif tag == 'method':
+                        self._in_method = True
+                    continue
+                if tag == 'line':
+                    if not self._in_method and self._path is not None:
+                        self._total += 1
+                        covered = int(element.get('hits', 0)) > 0
+                        if covered:
+                            self._covered += 1
+                        if self._lines is not None:
+                            number = int(element.get('number'))
+                            self._lines[1].append(number)
+                            if covered:
+                                self._lines[0].append(number)
+                    element.clear()
+                elif tag == 'method':
+                    self._in_method = False
+                    element.clear()
+                elif tag == 'class':
+                    line_maps = None
+                    if self._lines is not None:
+                        line_maps = tuple(coverage_bitmaps.from_lines(numbers) for numbers in self._lines)
+                    self.totals.add_file(self._path, self._covered, self._total, line_maps)
+                    self._path = None
+                    element.clear()
+                elif tag == 'package':
+                    element.clear()
+        except (TypeError, ValueError) as e:
+            raise CoverageReportError(f"Malformed Cobertura line: {e}") from None
+
+    def close(self):
+        try:
+            self._parser.close()
+        except ET.ParseError as e:
+            raise CoverageReportError(f"Malformed Cobertura XML: {e}") from None
+        self._drain()
+        return self.totals
+
+PARSERS = {'lcov': LcovParser, 'cobertura': CoberturaParser}
+
+def detect_format(head):
+    """Guesses the format from the first bytes of a report: XML is Cobertura, anything else LCOV."""
+    return 'cobertura' if head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] == b'<' else 'lcov'
+
+def parser_for(fmt, lines=False):
+    if fmt not in PARSERS:
+        raise CoverageReportError(f"Unknown coverage format '{fmt}'. Use one of: {', '.join(FORMATS)}.")
+    return PARSERS[fmt](lines)
+
+def parse_chunks(chunks, fmt=None, lines=False):
+    """
+    Parses a report given as an iterable of byte chunks in one pass.
+    The format is detected from the first chunk when fmt is None; lines=True
+    also collects per-file line bitmaps (CoverageTotals.line_maps).
+    """
+    parser = parser_for(fmt, lines) if fmt else None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if parser is None:
+            parser = parser_for(detect_format(chunk), lines)
+        parser.feed(chunk)
+    if parser is None:
+        raise CoverageReportError("Empty coverage report")
+    return parser.close()
+
+def build_record(params, totals):
+    """
+    Builds the SQ-5 build record of a parsed report for the existing aggregation input.
+    Build metadata comes from params (e.g. query parameters): jobId or project_id,
+    build_id or buildNumber, startTime (ms, default now), pipelineDurationMs and
+    coverageThresholdPassed. Raises ValueError for non-numeric times.
+    """
+    record = {
+        'reportVersion': 'SQ-5.1',
+        'jobId': params.get('jobId') or params.get('project_id') or 'default',
+        'build_id': params.get('build_id') or params.get('buildNumber'),
+        'startTime': float(params.get('startTime') or time.time() * 1000),
+        'pipelineDurationMs': float(params.get('pipelineDurationMs') or 0),
+        'covered_lines': totals.covered_lines,
+        'total_lines': totals.total_lines,
+    }
+    if 'coverageThresholdPassed' in params:
+        record['coverageThresholdPassed'] = params['coverageThresholdPassed']
+    return record
+
+def read_chunks(stream, size=CHUNK_SIZE):
+    """Iterates over a binary file-like object in chunks of size bytes."""
+    return iter(lambda: stream.read(size), b'')
+
+def parse_file(path, fmt=None, lines=False):
+    with open(path, 'rb') as f:
+        return parse_chunks(read_chunks(f), fmt, lines)
@@ -1,69 +1,389 @@
 import time
 import json
+import hashlib
+import queue
+import threading
 import redis
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
+import codec
+import coverage_bitmaps
+import history_store
+import instrumentation
+import project_summaries
+import rolling_stats
+import settings
+import summary_schema
 from flask_cors import CORS
+from settings import REDIS_HOST, REDIS_PORT, REDIS_DB, SUMMARY_KEY, SUMMARY_VERSION_KEY, SUMMARY_CHANNEL
 
 # --- Configuration ---
 # Flask App Setup
 app = Flask(__name__)
 # Enable CORS for all routes to allow frontend dashboard to access the API
 CORS(app) 
-API_PORT = 5002
-# Redis Configuration (Assumes Redis is running locally on default port)
-REDIS_HOST = 'localhost'
-REDIS_PORT = 6379
-# This key MUST match the key used by worker_processor.py
-SUMMARY_KEY = 'build_summary' 
-# Expose REDIS_KEY so worker_processor can import it (for flexibility)
-REDIS_KEY = SUMMARY_KEY 
+API_PORT = settings.DASHBOARD_API_PORT
+# Redis location and the summary keys shared with the worker come from settings.py
+# Idle SSE connections get a keep-alive comment this often
+STREAM_KEEPALIVE_S = 15
+# Updates buffered per SSE client; a client that falls further behind skips to the newest
+STREAM_CLIENT_BUFFER = 16
+# A cached summary younger than this is served without contacting Redis
+SUMMARY_CACHE_TTL_S = 1.0
+# While Redis is unreachable, a cached summary may be served for this long
+SUMMARY_STALE_TTL_S = 60.0
+
+# In-process cache of the latest summary as response JSON: {'etag', 'body', 'checked_at'}
+_summary_cache = None
+# Held by the request currently revalidating the cache; others serve the cached copy meanwhile
+_revalidate_lock = threading.Lock()
+
+# Queues of the connected SSE clients, fed by one shared pub/sub subscription
+_stream_clients = set()
+_stream_clients_lock = threading.Lock()
+_subscriber_thread = None
+
+# --- Instrumentation ---
+CACHE_HELP = "Build summary requests, by how they were answered."
+SUMMARY_CACHE_HITS = instrumentation.counter('dashboard_summary_cache_total', CACHE_HELP, result='hit')
+SUMMARY_REVALIDATIONS = instrumentation.counter('dashboard_summary_cache_total', CACHE_HELP, result='revalidated')
+SUMMARY_STALE = instrumentation.counter('dashboard_summary_cache_total', CACHE_HELP, result='stale')
+SUMMARY_UPDATES = instrumentation.counter('dashboard_summary_updates_total', "Summaries received over pub/sub.")
+instrumentation.gauge('dashboard_stream_clients', "Connected Server-Sent Events clients.", lambda: len(_stream_clients))
 
 # --- Initialization ---
 try:
     # Use decode_responses=True so that strings are returned instead of bytes
-    # IMPORTANT: The worker uses DB 0, so the API must use DB 0 to read the data.
-    redis_db = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+    redis_db = settings.redis_client(decode_responses=True)
+    # Summaries and history entries may be binary-encoded (see codec), so they are read as bytes
+    redis_bin = settings.redis_client()
     # Ping to check connection
     redis_db.ping()
-    print(f"[DASHBOARD API] Successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT} (DB 0)")
+    print(f"[DASHBOARD API] Successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT} (DB {REDIS_DB})")
 except Exception as e:
     print(f"[DASHBOARD API] ERROR: Could not connect to Redis. Ensure Redis server is running. Error: {e}")
     redis_db = None
+    redis_bin = None
 
 # --- API Endpoints ---
 
+def _summary_entry(stored, etag=None):
+    """
+    Cache entry for a stored summary: decoded once, hydrated with its config
+    version's metric metadata and serialized to JSON, so every request and SSE
+    client is served the same prepared text.
+    """
+    if etag is None:
+        # Summary written by a worker that predates version keys
+        etag = _summary_etag(stored)
+    summary = summary_schema.hydrate(redis_bin, [codec.decode(stored)])[0]
+    return {'etag': etag, 'body': codec.to_json(summary), 'checked_at': time.monotonic()}
+
+def _revalidate_summary():
+    """
+    Refreshes the summary cache from Redis. Only the short version key is read
+    when the cached copy is still current; the summary itself is fetched (with
+    its version, in one MGET) only when it changed.
+    Returns the cache entry, or None if Redis holds no summary.
+    """
+    global _summary_cache
+    cached = _summary_cache
+    now = time.monotonic()
+
+    if cached is not None and redis_db.get(SUMMARY_VERSION_KEY) == cached['etag']:
+        cached['checked_at'] = now
+        return cached
+
+    stored, etag = redis_bin.mget(SUMMARY_KEY, SUMMARY_VERSION_KEY)
+    if stored is None:
+        _summary_cache = None
+        return None
+    _summary_cache = _summary_entry(stored, etag.decode('utf-8') if etag is not None else None)
+    return _summary_cache
+
+def _summary_etag(stored):
+    """Same content hash the worker stores under SUMMARY_VERSION_KEY."""
+    return hashlib.sha1(stored).hexdigest()[:16]
+
+def _summary_response(entry, stale=False):
+    """Serves the cached summary JSON verbatim with an ETag (304 when the client is current)."""
+    response = Response(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.headers['Cache-Control'] = (
+        f"max-age={int(SUMMARY_CACHE_TTL_S)}, stale-while-revalidate={int(SUMMARY_STALE_TTL_S)}"
+    )
+    if stale:
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response.make_conditional(request)
+
 @app.route('/api/build-summary', methods=['GET'])
 def get_build_summary():
-    """Fetches the latest CI metrics summary from Redis."""
+    """
+    Fetches the latest CI metrics summary.
+    Served from an in-process cache of the serialized summary, revalidated against
+    the worker's version key at most once per SUMMARY_CACHE_TTL_S; answers
+    If-None-Match with 304 and keeps serving the cached copy through short Redis outages.
+    """
     if not redis_db:
         return jsonify({"error": "Database connection failed."}), 503
 
-    try:
-        # Get the JSON string stored by the worker using the correct key
-        summary_data_json = redis_db.get(SUMMARY_KEY)
-
-        if summary_data_json:
-            # Parse the JSON string back into a Python dictionary
-            summary_data = json.loads(summary_data_json)
-            print(f"[DASHBOARD API] Served summary data for build {summary_data.get('build_id')}")
-            return jsonify(summary_data)
-        else:
-            print("[DASHBOARD API] No summary data found in Redis.")
-            return jsonify({
-                "message": "No build summary data available. Run the pipeline first.",
-                "build_id": None,
-                "timestamp": time.time()
-            }), 404 # Returning 404 for 'Not Found' data is appropriate here
+    entry = _summary_cache
+    if entry is not None and time.monotonic() - entry['checked_at'] < SUMMARY_CACHE_TTL_S:
+        SUMMARY_CACHE_HITS.inc()
+        return _summary_response(entry)
 
+    if not _revalidate_lock.acquire(blocking=entry is None):
+        # Another request is already revalidating: serve what we have
+        SUMMARY_CACHE_HITS.inc()
+        return _summary_response(entry)
+    try:
+        SUMMARY_REVALIDATIONS.inc()
+        entry = _revalidate_summary()
+    except redis.exceptions.RedisError as e:
+        stale = _summary_cache
+        if stale is not None and time.monotonic() - stale['checked_at'] < SUMMARY_STALE_TTL_S:
+            SUMMARY_STALE.inc()
+            print(f"[DASHBOARD API] Redis unavailable ({e}); serving cached summary.")
+            return _summary_response(stale, stale=True)
+        print(f"[DASHBOARD API] An error occurred fetching data: {e}")
+        return jsonify({"error": "Internal server error during data retrieval."}), 500
     except Exception as e:
         print(f"[DASHBOARD API] An error occurred fetching or parsing data: {e}")
         return jsonify({"error": "Internal server error during data retrieval."}), 500
+    finally:
+        _revalidate_lock.release()
+
+    if entry is None:
+        print("[DASHBOARD API] No summary data found in Redis.")
+        return jsonify({
+            "message": "No build summary data available. Run the pipeline first.",
+            "build_id": None,
+            "timestamp": time.time()
+        }), 404 # Returning 404 for 'Not Found' data is appropriate here
+
+    return _summary_response(entry)
+
+def _subscribe_updates():
+    """
+    Background loop holding the API's single subscription to SUMMARY_CHANNEL.
+    Each published summary refreshes the summary cache and is handed to every
+    connected SSE client. Resubscribes after Redis errors.
+    """
+    global _summary_cache
+    while True:
+        try:
+            # The subscription waits indefinitely for messages, so it uses the client without socket timeout
+            pubsub = settings.redis_client(blocking=True).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SUMMARY_CHANNEL)
+            print(f"[DASHBOARD API] Subscribed to {SUMMARY_CHANNEL} for live updates.")
+            for message in pubsub.listen():
+                if message.get('type') != 'message':
+                    continue
+                SUMMARY_UPDATES.inc()
+                entry = _summary_entry(message['data'])
+                _summary_cache = entry
+                with _stream_clients_lock:
+                    clients = list(_stream_clients)
+                for client in clients:
+                    try:
+                        client.put_nowait(entry)
+                    except queue.Full:
+                        # Slow client: drop its backlog, only the newest summary matters
+                        with client.mutex:
+                            client.queue.clear()
+                        client.put_nowait(entry)
+        except Exception as e:
+            print(f"[DASHBOARD API] Live update subscription lost: {e}. Resubscribing in 2 seconds.")
+            time.sleep(2)
+
+def _ensure_subscriber():
+    """Starts the shared pub/sub subscriber thread on first use."""
+    global _subscriber_thread
+    with _stream_clients_lock:
+        if _subscriber_thread is None:
+            _subscriber_thread = threading.Thread(target=_subscribe_updates, name='summary-subscriber', daemon=True)
+            _subscriber_thread.start()
+
+def _sse_event(entry):
+    return f"id: {entry['etag']}\nevent: summary\ndata: {entry['body']}\n\n"
+
+@app.route('/api/stream', methods=['GET'])
+def stream_build_summary():
+    """
+    Server-Sent Events stream of build summaries.
+    Sends the current summary on connect, then every new one as the worker publishes it.
+    """
+    if not redis_db:
+        return jsonify({"error": "Database connection failed."}), 503
+    _ensure_subscriber()
+
+    client = queue.Queue(maxsize=STREAM_CLIENT_BUFFER)
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def generate():
+        with _stream_clients_lock:
+            _stream_clients.add(client)
+        try:
+            try:
+                current = _summary_cache or _revalidate_summary()
+            except redis.exceptions.RedisError:
+                current = _summary_cache
+            sent = last_event_id
+            if current is not None and current['etag'] != sent:
+                sent = current['etag']
+                yield _sse_event(current)
+            while True:
+                try:
+                    entry = client.get(timeout=STREAM_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if entry['etag'] != sent:
+                    sent = entry['etag']
+                    yield _sse_event(entry)
+        finally:
+            with _stream_clients_lock:
+                _stream_clients.discard(client)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/projects/summary', methods=['GET'])
+def get_projects_summary():
+    """
+    Latest summary of many projects in one call, ordered by project id.
+    ?ids=a,b,c selects projects (one MGET); without it all projects are listed.
+    ?coverage_below=80, ?duration_above=600 or any <metric>_below / <metric>_above
+    filter on the latest values. ?limit= and ?cursor= (next_cursor of the previous page) paginate.
+    """
+    if not redis_db:
+        return jsonify({"error": "Database connection failed."}), 503
+
+    ids = request.args.get('ids')
+    if ids is not None:
+        ids = [project_id for project_id in ids.split(',') if project_id]
+        if len(ids) > project_summaries.MAX_IDS:
+            return jsonify({"error": f"At most {project_summaries.MAX_IDS} ids per request."}), 400
+    try:
+        filters = project_summaries.parse_filters(request.args)
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        summaries, missing, next_cursor = project_summaries.get_page(
+            redis_bin, ids, request.args.get('cursor'), limit, filters)
+        projects = summary_schema.hydrate(redis_bin, summaries)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"[DASHBOARD API] An error occurred fetching project summaries: {e}")
+        return jsonify({"error": "Internal server error during data retrieval."}), 500
+
+    response = {"projects": projects, "next_cursor": next_cursor}
+    if ids is not None:
+        response["missing"] = missing
+    return jsonify(response)
+
+@app.route('/api/projects/<project_id>/history', methods=['GET'])
+def get_project_history(project_id):
+    """
+    Returns a project's build history between ?start= and ?end= (UNIX timestamps).
+    ?resolution=raw|hourly|daily selects per-build summaries or downsampled buckets.
+    """
+    if not redis_db:
+        return jsonify({"error": "Database connection failed."}), 503
+
+    try:
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        limit = min(request.args.get('limit', 500, type=int), 5000)
+        resolution = request.args.get('resolution', 'raw')
+        entries = history_store.get_history(redis_bin, project_id, start, end, resolution, limit)
+        if resolution == 'raw':
+            entries = summary_schema.hydrate(redis_bin, entries)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"[DASHBOARD API] An error occurred fetching history for {project_id}: {e}")
+        return jsonify({"error": "Internal server error during data retrieval."}), 500
+
+    return jsonify({"project_id": project_id, "resolution": resolution, "entries": entries})
+
+@app.route('/api/projects/<project_id>/coverage/diff', methods=['GET'])
+def get_coverage_diff(project_id):
+    """
+    Lines that gained or lost coverage between two builds of a project
+    (?base=<build_id>&head=<build_id>), with the coverage of lines new in head.
+    ?path= limits the diff to files under a path prefix.
+    """
+    if not redis_db:
+        return jsonify({"error": "Database connection failed."}), 503
+
+    base, head = request.args.get('base'), request.args.get('head')
+    if not base or not head:
+        return jsonify({"error": "Query parameters base and head (build ids) are required."}), 400
+    try:
+        result = coverage_bitmaps.diff(redis_bin, project_id, base, head, request.args.get('path'))
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        print(f"[DASHBOARD API] An error occurred diffing coverage of {project_id}: {e}")
+        return jsonify({"error": "Internal server error during data retrieval."}), 500
+
+    return jsonify({"project_id": project_id, "base": base, "head": head, **result})
+
+@app.route('/api/projects/<project_id>/stats', methods=['GET'])
+def get_project_stats(project_id):
+    """
+    Returns the rolling statistics of a project (count, mean, stddev, min/max,
+    EWMA, trend and approximate quantiles) for the tracked metrics.
+    By default they are cumulative over every build ever processed. Optional
+    query parameters limit them to recent builds, at hour granularity and up to
+    rolling_stats.WINDOW_RETENTION_S back:
+      window  builds started within this period, e.g. 7d, 24h, 90m or seconds
+      last    at least the newest N builds
+    """
+    if not redis_db:
+        return jsonify({"error": "Database connection failed."}), 503
+
+    window_s = last_builds = None
+    try:
+        if request.args.get('window'):
+            window_s = rolling_stats.parse_window(request.args['window'])
+        if request.args.get('last'):
+            last_builds = int(request.args['last'])
+            if last_builds < 1:
+                raise ValueError("Query parameter last must be a positive number of builds.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        stats = rolling_stats.get_stats(redis_db, project_id, window_s, last_builds)
+    except Exception as e:
+        print(f"[DASHBOARD API] An error occurred fetching stats for {project_id}: {e}")
+        return jsonify({"error": "Internal server error during data retrieval."}), 500
+
+    if not stats:
+        return jsonify({"error": f"No statistics available for project {project_id}."}), 404
+    return jsonify({"project_id": project_id, "window_s": window_s, "last": last_builds, "metrics": stats})
+
+@app.after_request
+def count_request(response):
+    """Counts handled requests by route and status code."""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    instrumentation.counter('dashboard_requests_total', "HTTP requests handled, by route and status.",
+                            route=route, status=str(response.status_code)).inc()
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of the dashboard API."""
+    return Response(instrumentation.render(), content_type=instrumentation.CONTENT_TYPE)
 
 # --- Service Execution ---
 
 if __name__ == '__main__':
     # This block is executed when run directly (for testing/debugging)
     print(f"[DASHBOARD API] Starting service on port {API_PORT}...")
+    instrumentation.maybe_start_profiler('dashboard_api')
     try:
         # Host on 0.0.0.0 to make it accessible to other services if necessary
         app.run(debug=False, host='0.0.0.0', port=API_PORT)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+# --- CONFIGURATION ---
+# Deduplicate webhook deliveries of the same build in the ingestion service and the worker
+DEDUPE_ENABLED = os.getenv('DEDUPE_ENABLED', '1') == '1'
+# How long a build is remembered; retries and re-posts within this window are dropped.
+# Memory is roughly one short key per build accepted in the window.
+DEDUPE_TTL_S = int(os.getenv('DEDUPE_TTL_S', 24 * 3600))
+
+KEY_PREFIX = 'dedupe'
+PROCESSED_PREFIX = 'processed'
+
+# --- KEY LAYOUT ---
+# dedupe:{project}:{build_id}       content hash of the payload accepted by ingestion
+# processed:{project}:{build_id}    content hash of the payload aggregated by a worker
+
+# Fields added by the ingestion service; they differ between deliveries of the same content
+_STAMPED_FIELDS = ('trace_id', 'ingest_ts', 'content_hash')
+
+def project_of(record):
+    """Project of a raw payload or normalized row (same fallback as the aggregation stage)."""
+    return str(record.get('project_id') or record.get('jobId') or 'default')
+
+def content_hash(record):
+    """Short hash of a payload's content, independent of key order and ingestion stamps."""
+    content = {key: value for key, value in record.items() if key not in _STAMPED_FIELDS}
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+def _key(prefix, record):
+    return f"{prefix}:{project_of(record)}:{record['build_id']}"
+
+# --- INGESTION SIDE ---
+
+def queue_claims(pipe, records):
+    """
+    Adds one atomic SET ... EX ttl GET per record to a pipeline (sync or asyncio).
+    Each command claims the record's (project, build_id) for its content hash and
+    returns the hash previously claimed, so concurrent retries cannot both pass.
+    Records must carry 'content_hash'.
+    """
+    for record in records:
+        pipe.set(_key(KEY_PREFIX, record), record['content_hash'], ex=DEDUPE_TTL_S, get=True)
+    return pipe
+
+def duplicate_flags(records, previous_hashes):
+    """
+    Interprets the results of queue_claims: True for a record whose identical
+    content was already accepted. A build re-posted with different content
+    (e.g. a corrected report) is not a duplicate.
+    """
+    return [
+        previous is not None and (previous.decode() if isinstance(previous, bytes) else previous) == record['content_hash']
+        for record, previous in zip(records, previous_hashes)
+    ]
+
+def queue_release(pipe, records, previous_hashes):
+    """Undoes claims whose records could not be queued, so a retry of the sender is accepted."""
+    for record, previous in zip(records, previous_hashes):
+        if previous is None:
+            pipe.delete(_key(KEY_PREFIX, record))
+        else:
+            pipe.set(_key(KEY_PREFIX, record), previous, ex=DEDUPE_TTL_S)
+    return pipe
+
+# --- WORKER SIDE ---
+
+def drop_processed(r, rows):
+    """
+    Returns the rows not aggregated before: duplicates within the batch and
+    builds whose processed marker holds the same content hash are dropped.
+    One MGET per batch. Rows without a content hash get one computed.
+    """
+    unique = {}
+    for row in rows:
+        row.setdefault('content_hash', content_hash(row))
+        # Later deliveries of the same build in one batch replace earlier ones
+        unique[(project_of(row), str(row['build_id']), row['content_hash'])] = row
+    candidates = list(unique.values())
+    if not candidates:
+        return []
+    processed = r.mget([_key(PROCESSED_PREFIX, row) for row in candidates])
+    return [row for row, flags in zip(candidates, duplicate_flags(candidates, processed)) if not flags]
+
+def queue_mark_processed(pipe, summaries):
+    """Adds the processed markers of persisted summaries to their persistence pipeline."""
+    for summary in summaries:
+        if summary.get('content_hash'):
+            pipe.set(_key(PROCESSED_PREFIX, summary), summary['content_hash'], ex=DEDUPE_TTL_S)
+    return pipe
@@ -0,0 +1,214 @@
+import fnmatch
+import os
+import time
+
+from redis.exceptions import WatchError
+
+import codec
+from dedupe import project_of
+from settings import FAIR_PENDING_KEY, REDIS_QUEUE
+
+def _parse_weights(spec):
+    weights = {}
+    for entry in spec.split(','):
+        project_id, _, weight = entry.partition('=')
+        if project_id.strip() and weight.strip():
+            weights[project_id.strip()] = max(1, int(weight))
+    return weights
+
+# --- CONFIGURATION ---
+# Priority classes, served strictly in this order: a class is served only while the ones before it are empty
+PRIORITY_CLASSES = ('high', 'normal')
+# Builds of these branches (glob patterns matched against 'branch' or 'ref') go to the high class
+FAIR_PRIORITY_BRANCHES = [pattern.strip() for pattern in
+                          os.getenv('FAIR_PRIORITY_BRANCHES', 'main,master,release/*').split(',') if pattern.strip()]
+# Builds taken from a project per turn before the next project of its class is served
+FAIR_QUANTUM = max(1, int(os.getenv('FAIR_QUANTUM', 10)))
+# Per-project weights, e.g. "platform=4,docs=1": a project's turn takes FAIR_QUANTUM * weight builds
+FAIR_PROJECT_WEIGHTS = _parse_weights(os.getenv('FAIR_PROJECT_WEIGHTS', ''))
+# A worker's claim on a project lapses after this long (a crashed worker's projects are served again)
+FAIR_CLAIM_TTL_S = float(os.getenv('FAIR_CLAIM_TTL_S', 60))
+# Idle workers re-check the rounds this often while waiting for work
+FAIR_IDLE_POLL_S = 0.05
+# Claimed projects stay in their round scored CLAIM_OFFSET + claim expiry: after every waiting
+# project, and untouched by ingestion's ZADD NX
+CLAIM_OFFSET = 1e12
+
+# --- KEY LAYOUT ---
+# ci_data_queue:{class}:{project}   LIST  encoded payloads of one project and class (LPUSH / RPOP, FIFO)
+# ci_data_queue:projects:{class}    ZSET  project -> time it (re)joined the round; lowest score is served next,
+#                                         or CLAIM_OFFSET + claim expiry while a worker holds the project
+# ci_data_queue:pending             payloads waiting across all sub-queues (see settings.queue_length)
+
+# Turns cut short by a full batch: (class, project) -> builds still owed, so the project keeps its place
+_deficits = {}
+# Projects claimed by this worker until release(): (class, project) ->
+# {'claim': claim score, 'score': round score to rejoin with (None: back of the round), 'more': work left}
+_held = {}
+
+def _queue_key(priority, project_id):
+    return f"{REDIS_QUEUE}:{priority}:{project_id}"
+
+def _round_key(priority):
+    return f"{REDIS_QUEUE}:projects:{priority}"
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def priority_of(record):
+    """Priority class of a payload: its 'priority' field if valid, else high for FAIR_PRIORITY_BRANCHES."""
+    priority = record.get('priority')
+    if priority in PRIORITY_CLASSES:
+        return priority
+    branch = record.get('branch') or record.get('ref')
+    if isinstance(branch, str):
+        branch = branch.removeprefix('refs/heads/')
+        if any(fnmatch.fnmatchcase(branch, pattern) for pattern in FAIR_PRIORITY_BRANCHES):
+            return PRIORITY_CLASSES[0]
+    return PRIORITY_CLASSES[-1]
+
+def quantum_of(project_id):
+    return FAIR_QUANTUM * FAIR_PROJECT_WEIGHTS.get(project_id, 1)
+
+# --- INGESTION SIDE ---
+
+def queue_push(pipe, payloads, records=None):
+    """
+    Adds the commands that route encoded payloads to their (class, project) sub-queues
+    to a pipeline (sync or asyncio). A project joins its class's round when it is not
+    already in it (ZADD NX); a claimed project is in it under its claim score, so the
+    push leaves it to the worker holding it. records are the decoded payloads when the caller has them;
+    otherwise each payload is decoded to find its route.
+    """
+    if records is None:
+        records = [codec.decode(payload) for payload in payloads]
+    routes = {}
+    for payload, record in zip(payloads, records):
+        # dicts keep insertion order, so each sub-queue receives its payloads in arrival order
+        routes.setdefault((priority_of(record), project_of(record)), []).append(payload)
+    now = time.time()
+    for (priority, project_id), queued in routes.items():
+        pipe.lpush(_queue_key(priority, project_id), *queued)
+        pipe.zadd(_round_key(priority), {project_id: now}, nx=True)
+    if payloads:
+        pipe.incrby(FAIR_PENDING_KEY, len(payloads))
+    return pipe
+
+# --- WORKER SIDE ---
+
+def _claim(r):
+    """
+    Claims the next waiting project of the highest non-empty round, or one whose claim
+    lapsed: (class, project) or None. The project stays in the round with a claim score,
+    so ingestion does not re-add it and no other worker serves it until release().
+    """
+    for priority in PRIORITY_CLASSES:
+        key = _round_key(priority)
+        with r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    head = pipe.zrange(key, 0, 0, withscores=True)
+                    now = time.time()
+                    if not head or head[0][1] - CLAIM_OFFSET > now:
+                        # Empty, or every project is held by a live claim
+                        break
+                    project_id, score = _decode(head[0][0]), head[0][1]
+                    claim = CLAIM_OFFSET + now + FAIR_CLAIM_TTL_S
+                    pipe.multi()
+                    pipe.zadd(key, {project_id: claim}, xx=True)
+                    pipe.execute()
+                except WatchError:
+                    continue
+                _held[(priority, project_id)] = {
+                    'claim': claim, 'score': score if score < CLAIM_OFFSET else now, 'more': True}
+                return priority, project_id
+    return None
+
+def _held_with_work():
+    """A project this worker already holds that still has work: (class, project) or None."""
+    for turn, hold in sorted(_held.items(), key=lambda item: PRIORITY_CLASSES.index(item[0][0])):
+        if hold['more']:
+            return turn
+    return None
+
+def _take_turn(r, priority, project_id, room):
+    """
+    Serves one turn of a claimed project: pops up to its remaining quantum (at most
+    room payloads). A turn cut short by room keeps the project's place (deficit
+    round-robin); a finished turn sends it to the back when it is released.
+    """
+    turn = (priority, project_id)
+    hold = _held[turn]
+    owed = _deficits.pop(turn, None) or quantum_of(project_id)
+    queue_key = _queue_key(priority, project_id)
+    # Only the claim holder pops this sub-queue, so its length can only grow until we do
+    available = r.llen(queue_key)
+    take = min(owed, room, available)
+    payloads = []
+    if take:
+        # The pending counter moves in the same transaction as the pop
+        pipe = r.pipeline(transaction=True)
+        pipe.rpop(queue_key, take)
+        pipe.decrby(FAIR_PENDING_KEY, take)
+        payloads = pipe.execute()[0] or []
+    hold['more'] = available > take
+    if hold['more'] and owed > take:
+        _deficits[turn] = owed - take
+    else:
+        hold['score'] = None
+    return payloads
+
+def release(r):
+    """
+    Ends the turns of all projects claimed by pop_batch, to be called once the batch
+    is processed. A project with work left rejoins its round (at its kept place or
+    the back); an empty one leaves it. Claims that lapsed and were taken over by
+    another worker are left alone.
+    """
+    while _held:
+        (priority, project_id), hold = _held.popitem()
+        round_key, queue_key = _round_key(priority), _queue_key(priority, project_id)
+        with r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # A push in between aborts the EXEC, so an empty check cannot strand new work
+                    pipe.watch(round_key, queue_key)
+                    if pipe.zscore(round_key, project_id) != hold['claim']:
+                        break
+                    remaining = pipe.llen(queue_key)
+                    pipe.multi()
+                    if remaining:
+                        pipe.zadd(round_key, {project_id: hold['score'] or time.time()})
+                    else:
+                        pipe.zrem(round_key, project_id)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+def pop_batch(r, size, timeout, linger):
+    """
+    Collects up to size payloads across projects, one turn per project in round
+    order, highest priority class first. Each served project stays claimed by this
+    worker until release(), so a project's builds are processed by one worker at a
+    time and in FIFO order. When no other project is waiting, projects already held
+    get further turns. Waits up to timeout seconds for the first payload, then at
+    most linger seconds for the batch to fill. Returns [] on timeout.
+    """
+    batch = []
+    deadline = time.monotonic() + timeout
+    lingering = False
+    while len(batch) < size:
+        turn = _claim(r) or _held_with_work()
+        if turn is None:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(min(FAIR_IDLE_POLL_S, wait))
+            continue
+        batch.extend(_take_turn(r, *turn, size - len(batch)))
+        if batch and not lingering:
+            lingering = True
+            deadline = time.monotonic() + linger
+    return batch
@@ -0,0 +1,147 @@
+import ast
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional: batch evaluation falls back to the scalar path without it
+    np = None
+
+# --- WHITELIST ---
+# Only these syntax nodes may appear in a metric formula
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Call, ast.Name, ast.Attribute, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.USub, ast.UAdd, ast.Not, ast.And, ast.Or,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+# Plain functions callable from formulas
+ALLOWED_FUNCTIONS = {'min': min, 'max': max, 'abs': abs, 'round': round}
+# Functions callable as math.<name>
+ALLOWED_MATH = {'sqrt', 'log', 'log10', 'exp', 'floor', 'ceil', 'fabs'}
+
+class FormulaError(ValueError):
+    """Raised when a formula is not valid Python or uses a construct outside the whitelist."""
+
+class _NumpyMath:
+    """Stand-in for the math module when a formula is evaluated over NumPy arrays."""
+    sqrt = staticmethod(lambda x: np.sqrt(x))
+    log = staticmethod(lambda x: np.log(x))
+    log10 = staticmethod(lambda x: np.log10(x))
+    exp = staticmethod(lambda x: np.exp(x))
+    floor = staticmethod(lambda x: np.floor(x))
+    ceil = staticmethod(lambda x: np.ceil(x))
+    fabs = staticmethod(lambda x: np.abs(x))
+
+def _validate(tree, source):
+    """Rejects any node, name or call that is not on the whitelist."""
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise FormulaError(f"Unsupported syntax '{type(node).__name__}' in formula: {source}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise FormulaError(f"Only numeric constants are allowed in formula: {source}")
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'math' and node.attr in ALLOWED_MATH):
+                raise FormulaError(f"Only math.{{{', '.join(sorted(ALLOWED_MATH))}}} may be used in formula: {source}")
+        if isinstance(node, ast.Call):
+            func = node.func
+            if node.keywords or not (isinstance(func, ast.Attribute) or
+                                     (isinstance(func, ast.Name) and func.id in ALLOWED_FUNCTIONS)):
+                raise FormulaError(f"Call not allowed in formula: {source}")
+        if isinstance(node, ast.Name) and node.id.startswith('_'):
+            raise FormulaError(f"Names may not start with '_' in formula: {source}")
+
+def _input_variables(tree):
+    """Returns the formula's free variables (input names) in a stable order."""
+    variables = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id != 'math' and node.id not in ALLOWED_FUNCTIONS:
+            if node.id not in variables:
+                variables.append(node.id)
+    return tuple(variables)
+
+def _compile_lambda(tree, variables, name, namespace):
+    """Wraps the validated expression in a lambda over its input variables and compiles it."""
+    arguments = ast.arguments(posonlyargs=[], args=[ast.arg(arg=v) for v in variables],
+                              vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    wrapper = ast.Expression(body=ast.Lambda(args=arguments, body=tree.body))
+    ast.fix_missing_locations(wrapper)
+    code = compile(wrapper, f"<formula:{name}>", 'eval')
+    return eval(code, namespace)
+
+class CompiledFormula:
+    """
+    A metric formula parsed, validated and compiled once.
+    Calling it only binds the input values positionally (in the order of
+    `variables`) and runs the compiled code object.
+    """
+    __slots__ = ('source', 'name', 'variables', '_fn', '_tree', '_vector_fn')
+
+    def __init__(self, source, name='formula'):
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise FormulaError(f"Invalid formula syntax ({e.msg}): {source}") from None
+        _validate(tree, source)
+
+        self.source = source
+        self.name = name
+        self.variables = _input_variables(tree)
+        self._tree = tree
+        self._fn = _compile_lambda(tree, self.variables, name,
+                                   {'__builtins__': {}, 'math': math, **ALLOWED_FUNCTIONS})
+        self._vector_fn = None
+
+    def __call__(self, *values):
+        return self._fn(*values)
+
+    def evaluate(self, scope):
+        """Evaluates the formula against a mapping of input values."""
+        return self._fn(*[scope[v] for v in self.variables])
+
+    def evaluate_batch(self, columns, row_count):
+        """
+        Evaluates the formula over row_count rows at once.
+        `columns` maps each input variable to a sequence of values (one per row).
+        With NumPy the formula runs once over float arrays; rows whose result is
+        not finite (e.g. division by zero) come back as 0. Returns a list of floats.
+        """
+        if np is None:
+            return self._evaluate_rows(columns, row_count)
+
+        if self._vector_fn is None:
+            self._vector_fn = _compile_lambda(self._tree, self.variables, self.name, {
+                '__builtins__': {}, 'math': _NumpyMath,
+                'min': np.minimum, 'max': np.maximum, 'abs': np.abs, 'round': np.round,
+            })
+        try:
+            arrays = [np.asarray(columns[v], dtype=np.float64) for v in self.variables]
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                result = np.asarray(self._vector_fn(*arrays), dtype=np.float64)
+        except (TypeError, ValueError):
+            # Non-numeric inputs or constructs without an array form (and/or, if-else)
+            return self._evaluate_rows(columns, row_count)
+        if result.ndim == 0:
+            # Formula without inputs: broadcast the constant to the number of rows
+            result = np.full(row_count, float(result))
+        result[~np.isfinite(result)] = 0.0
+        return result.tolist()
+
+    def _evaluate_rows(self, columns, row_count):
+        """Row-by-row evaluation used when the vectorized path is unavailable."""
+        if not self.variables:
+            return [_safe_scalar(self._fn, ())] * row_count
+        rows = zip(*[columns[v] for v in self.variables])
+        return [_safe_scalar(self._fn, row) for row in rows]
+
+def _safe_scalar(fn, row):
+    """Scalar fallback for evaluate_batch: failed rows evaluate to 0."""
+    try:
+        return fn(*row)
+    except (ArithmeticError, TypeError, ValueError):
+        return 0
+
+def compile_formula(source, name='formula'):
+    """Parses, validates and compiles a formula string. Raises FormulaError if it is rejected."""
+    return CompiledFormula(source, name)
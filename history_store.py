@@ -0,0 +1,243 @@
+import json
+import os
+import time
+
+import codec
+
+# --- CONFIGURATION ---
+# Raw per-build summaries are kept for this long, and at most this many per project
+HISTORY_RAW_RETENTION_S = int(os.getenv('HISTORY_RAW_RETENTION_S', 7 * 24 * 3600))
+HISTORY_RAW_MAX_BUILDS = int(os.getenv('HISTORY_RAW_MAX_BUILDS', 1000))
+# Downsampled buckets are kept for this long
+HISTORY_HOURLY_RETENTION_S = int(os.getenv('HISTORY_HOURLY_RETENTION_S', 90 * 24 * 3600))
+HISTORY_DAILY_RETENTION_S = int(os.getenv('HISTORY_DAILY_RETENTION_S', 2 * 365 * 24 * 3600))
+# Minimum time between two compaction passes for the same project
+HISTORY_COMPACT_INTERVAL_S = int(os.getenv('HISTORY_COMPACT_INTERVAL_S', 60))
+# A compaction lock older than this is considered abandoned
+HISTORY_COMPACT_LOCK_S = 30
+
+KEY_PREFIX = 'history'
+RESOLUTIONS = {'hourly': 3600, 'daily': 86400}
+# Build times above this are epoch milliseconds (SQ-5 startTime arrives in either unit)
+BUILD_TIME_MS_THRESHOLD = 1e11
+
+# Per-process record of when each project was last compacted
+_last_compaction = {}
+
+# --- KEY LAYOUT ---
+# history:{project}:index           ZSET  build_id -> build time (see history_score)
+# history:{project}:builds          HASH  build_id -> encoded summary (see codec)
+# history:{project}:{res}:index     ZSET  bucket start -> bucket start
+# history:{project}:{res}           HASH  bucket start -> bucket JSON
+# history:{project}:compacting      lock held during a compaction pass
+
+def _key(project_id, *parts):
+    return ':'.join((KEY_PREFIX, str(project_id)) + parts)
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def project_of(summary):
+    """Project a summary belongs to."""
+    return summary.get('project_id') or 'default'
+
+def build_order(record):
+    """
+    Sort key of a build within its project: numeric build number, then start time
+    (a summary's 'build_ts', or a normalized row's 'timestamp').
+    """
+    build_id = str(record.get('build_id'))
+    start = record['build_ts'] if 'build_ts' in record else record.get('timestamp')
+    return (int(build_id) if build_id.isdigit() else -1, start if isinstance(start, (int, float)) else 0)
+
+def build_time(summary):
+    """
+    When the build ran, in epoch seconds: its normalized start time ('build_ts'),
+    or the aggregation time for builds that did not report one.
+    """
+    value = summary.get('build_ts')
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        return summary['timestamp']
+    return value / 1000.0 if value > BUILD_TIME_MS_THRESHOLD else float(value)
+
+def history_score(summary):
+    """
+    Index score of a summary: its build time to the millisecond, plus the build
+    number (mod 1000) in microseconds, so builds started in the same millisecond
+    stay in build order instead of tying.
+    """
+    build_id = str(summary.get('build_id'))
+    order = int(build_id) % 1000 if build_id.isdigit() else 0
+    return round(build_time(summary), 3) + order * 1e-6
+
+def queue_history(pipe, summary):
+    """
+    Adds the commands that append one summary to its project's history to a pipeline.
+    Appending is O(log n) (one ZADD, one HSET); trimming and downsampling happen
+    later in compact(), outside the per-build path.
+    """
+    project_id = project_of(summary)
+    build_id = str(summary.get('build_id'))
+    pipe.zadd(_key(project_id, 'index'), {build_id: history_score(summary)})
+    pipe.hset(_key(project_id, 'builds'), build_id, codec.encode(summary))
+    return pipe
+
+# --- DOWNSAMPLING ---
+
+def _empty_bucket(start):
+    return {'start': start, 'count': 0, 'metrics': {}}
+
+def _fold_summary(bucket, summary):
+    """Adds one build summary to a bucket (count, sum, min, max, last per metric)."""
+    bucket['count'] += 1
+    for metric_key, metric in summary.get('metrics', {}).items():
+        value = metric.get('value') if isinstance(metric, dict) else metric
+        if not isinstance(value, (int, float)):
+            continue
+        stats = bucket['metrics'].get(metric_key)
+        if stats is None:
+            bucket['metrics'][metric_key] = {'count': 1, 'sum': value, 'min': value, 'max': value, 'last': value}
+        else:
+            stats['count'] += 1
+            stats['sum'] += value
+            stats['min'] = min(stats['min'], value)
+            stats['max'] = max(stats['max'], value)
+            stats['last'] = value
+
+def _fold_bucket(bucket, other):
+    """Merges one bucket into another (used to roll hourly buckets up into daily ones)."""
+    bucket['count'] += other['count']
+    for metric_key, stats in other['metrics'].items():
+        target = bucket['metrics'].get(metric_key)
+        if target is None:
+            bucket['metrics'][metric_key] = dict(stats)
+        else:
+            target['count'] += stats['count']
+            target['sum'] += stats['sum']
+            target['min'] = min(target['min'], stats['min'])
+            target['max'] = max(target['max'], stats['max'])
+            target['last'] = stats['last']
+
+def _merge_into_buckets(r, project_id, resolution, items, fold):
+    """
+    Folds (timestamp, record) items into the resolution's buckets,
+    merging with buckets that already exist. Returns the pipeline to execute.
+    """
+    width = RESOLUTIONS[resolution]
+    hash_key = _key(project_id, resolution)
+    index_key = _key(project_id, resolution, 'index')
+
+    grouped = {}
+    for timestamp, record in items:
+        grouped.setdefault(int(timestamp // width * width), []).append(record)
+
+    starts = sorted(grouped)
+    existing = r.hmget(hash_key, [str(start) for start in starts]) if starts else []
+    pipe = r.pipeline(transaction=True)
+    for start, stored in zip(starts, existing):
+        bucket = json.loads(stored) if stored else _empty_bucket(start)
+        for record in grouped[start]:
+            fold(bucket, record)
+        pipe.hset(hash_key, str(start), json.dumps(bucket))
+        pipe.zadd(index_key, {str(start): start})
+    return pipe
+
+def _evict(r, index_key, hash_key, cutoff):
+    """Returns (members, records) of entries with a score below cutoff, oldest first."""
+    members = r.zrangebyscore(index_key, '-inf', f'({cutoff}', withscores=True)
+    if not members:
+        return [], []
+    records = r.hmget(hash_key, [m for m, _ in members])
+    return members, records
+
+def compact(r, project_id, now=None):
+    """
+    Applies retention and downsampling to one project's history:
+    raw builds past the age or count limit are folded into hourly buckets,
+    hourly buckets past their retention into daily buckets, and daily buckets
+    past their retention are dropped. Guarded by a lock so concurrent workers
+    never fold the same data twice. Returns False if another worker holds the lock.
+    """
+    now = time.time() if now is None else now
+    lock_key = _key(project_id, 'compacting')
+    if not r.set(lock_key, '1', nx=True, ex=HISTORY_COMPACT_LOCK_S):
+        return False
+    try:
+        # 1. Raw builds -> hourly buckets
+        index_key, builds_key = _key(project_id, 'index'), _key(project_id, 'builds')
+        pipe = r.pipeline(transaction=False)
+        pipe.zcount(index_key, '-inf', f'({now - HISTORY_RAW_RETENTION_S}')
+        pipe.zcard(index_key)
+        expired, total = pipe.execute()
+        # The count limit applies too; evicting by rank never takes more than the overflow
+        evicted = max(expired, total - HISTORY_RAW_MAX_BUILDS)
+        members = r.zrange(index_key, 0, evicted - 1, withscores=True) if evicted > 0 else []
+        records = r.hmget(builds_key, [m for m, _ in members]) if members else []
+        if members:
+            items = [(score, codec.decode(record)) for (_, score), record in zip(members, records) if record]
+            pipe = _merge_into_buckets(r, project_id, 'hourly', items, _fold_summary)
+            pipe.zrem(index_key, *[m for m, _ in members])
+            pipe.hdel(builds_key, *[m for m, _ in members])
+            pipe.execute()
+
+        # 2. Hourly buckets -> daily buckets
+        index_key, hourly_key = _key(project_id, 'hourly', 'index'), _key(project_id, 'hourly')
+        members, records = _evict(r, index_key, hourly_key, now - HISTORY_HOURLY_RETENTION_S)
+        if members:
+            items = [(score, json.loads(record)) for (_, score), record in zip(members, records) if record]
+            pipe = _merge_into_buckets(r, project_id, 'daily', items, _fold_bucket)
+            pipe.zrem(index_key, *[m for m, _ in members])
+            pipe.hdel(hourly_key, *[m for m, _ in members])
+            pipe.execute()
+
+        # 3. Expired daily buckets are dropped
+        index_key, daily_key = _key(project_id, 'daily', 'index'), _key(project_id, 'daily')
+        members = r.zrangebyscore(index_key, '-inf', f'({now - HISTORY_DAILY_RETENTION_S}')
+        if members:
+            pipe = r.pipeline(transaction=True)
+            pipe.zrem(index_key, *members)
+            pipe.hdel(daily_key, *members)
+            pipe.execute()
+        return True
+    finally:
+        r.delete(lock_key)
+
+def maybe_compact(r, summaries, now=None):
+    """
+    Compacts the projects touched by a batch, at most once per
+    HISTORY_COMPACT_INTERVAL_S per project and process.
+    """
+    now = time.time() if now is None else now
+    for project_id in {project_of(summary) for summary in summaries}:
+        if now - _last_compaction.get(project_id, 0) < HISTORY_COMPACT_INTERVAL_S:
+            continue
+        _last_compaction[project_id] = now
+        try:
+            compact(r, project_id, now)
+        except Exception as e:
+            print(f"[HISTORY] Compaction failed for project {project_id}: {e}")
+
+# --- QUERIES ---
+
+def get_history(r, project_id, start=None, end=None, resolution='raw', limit=500):
+    """
+    Returns a project's history between two timestamps, oldest first.
+    resolution is 'raw' (stored per-build summaries), 'hourly' or 'daily' (bucket aggregates).
+    Raw summaries may be binary-encoded, so r must not decode responses.
+    One O(log n + k) range lookup on the sorted-set index plus one HMGET.
+    """
+    low = '-inf' if start is None else start
+    high = '+inf' if end is None else end
+    if resolution == 'raw':
+        index_key, hash_key = _key(project_id, 'index'), _key(project_id, 'builds')
+    elif resolution in RESOLUTIONS:
+        index_key, hash_key = _key(project_id, resolution, 'index'), _key(project_id, resolution)
+    else:
+        raise ValueError(f"Unknown resolution '{resolution}'. Use raw, hourly or daily.")
+
+    # Newest `limit` entries in range, returned oldest first
+    members = r.zrevrangebyscore(index_key, high, low, start=0, num=limit)
+    if not members:
+        return []
+    records = r.hmget(hash_key, [_decode(m) for m in reversed(members)])
+    return [codec.decode(record) for record in records if record]
@@ -0,0 +1,448 @@
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+from redis import asyncio as redis_asyncio, exceptions as redis_exceptions
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+
+# Reuse the validation rules and settings of the simple (Flask) ingestion mode
+from ingestion_service import (
+    BATCH_MAX_RECORDS, QUEUE_HIGH_WATER_MARK, QUEUE_DEPTH_CACHE_S, QUEUE_RETRY_AFTER_S,
+    PAYLOADS_DUPLICATE, PAYLOADS_QUEUED, PAYLOADS_REJECTED, PAYLOADS_THROTTLED,
+    enqueue_payloads, pop_line_coverage, stamp_trace, validate_payload
+)
+import codec
+import coverage_bitmaps
+import coverage_reports
+import dedupe
+import instrumentation
+from settings import (
+    INGESTION_PORT, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_MAX_CONNECTIONS,
+    REDIS_HEALTH_CHECK_INTERVAL, REDIS_SOCKET_TIMEOUT_S, queue_length
+)
+
+# --- CONFIGURATION ---
+# Number of uvicorn worker processes; each process owns one event loop and one Redis pool
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', os.cpu_count() or 1))
+# Where the worker processes publish their metrics, so /metrics reports all of them (see handle_metrics)
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR') or os.path.join(
+    tempfile.gettempdir(), f"ingestion-asgi-metrics-{INGESTION_PORT}")
+NDJSON_TYPES = (b'application/x-ndjson', b'application/jsonl')
+
+redis_client = None
+# (monotonic time of the reading, queue length), shared by all requests of this process
+_queue_depth = (0.0, 0)
+
+def get_redis():
+    """
+    Returns the process-wide asyncio Redis client, creating its connection pool on first use.
+    Like the Flask mode, no PING is sent per request; broken connections are
+    replaced by the pool when a command fails.
+    """
+    global redis_client
+    if redis_client is None:
+        pool = redis_asyncio.ConnectionPool(
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT_S, socket_connect_timeout=REDIS_SOCKET_TIMEOUT_S,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+            retry=Retry(ExponentialBackoff(cap=0.5, base=0.05), 1),
+            retry_on_error=[redis_exceptions.ConnectionError, redis_exceptions.TimeoutError]
+        )
+        redis_client = redis_asyncio.Redis(connection_pool=pool)
+    return redis_client
+
+async def queue_saturated():
+    """Async variant of ingestion_service.queue_saturated (cached queue length vs. high-water mark)."""
+    global _queue_depth
+    checked_at, depth = _queue_depth
+    now = time.monotonic()
+    if now - checked_at >= QUEUE_DEPTH_CACHE_S:
+        try:
+            depth = await queue_length(get_redis())
+        except redis_exceptions.RedisError:
+            depth = 0
+        _queue_depth = (now, depth)
+    return depth >= QUEUE_HIGH_WATER_MARK
+
+# --- ASGI HELPERS ---
+
+async def send_json(send, status, payload, headers=()):
+    """Sends a complete JSON response."""
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def iter_body_chunks(receive):
+    """Yields the request body chunk by chunk as it arrives."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunk = message.get('body', b'')
+        if chunk:
+            yield chunk
+        if not message.get('more_body', False):
+            return
+
+async def read_body(receive):
+    """Reads the full request body."""
+    chunks = [chunk async for chunk in iter_body_chunks(receive)]
+    return b''.join(chunks)
+
+async def iter_ndjson_records(receive):
+    """
+    Yields decoded records from an NDJSON request body without buffering it whole.
+    Lines that are not valid JSON are yielded as exceptions.
+    """
+    pending = b''
+    async for chunk in iter_body_chunks(receive):
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield e
+    if pending.strip():
+        try:
+            yield json.loads(pending)
+        except json.JSONDecodeError as e:
+            yield e
+
+async def claim_payloads(records):
+    """Async variant of ingestion_service.claim_payloads; Redis errors propagate to the handler."""
+    for record in records:
+        record['content_hash'] = dedupe.content_hash(record)
+    if not dedupe.DEDUPE_ENABLED or not records:
+        return [False] * len(records), None
+    previous = await dedupe.queue_claims(get_redis().pipeline(transaction=False), records).execute()
+    return dedupe.duplicate_flags(records, previous), previous
+
+async def release_claims(records, previous):
+    """Best-effort undo of claims for records that could not be queued."""
+    if previous is None or not records:
+        return
+    try:
+        await dedupe.queue_release(get_redis().pipeline(transaction=False), records, previous).execute()
+    except redis_exceptions.RedisError as e:
+        print(f"[INGESTION ASGI] Could not release dedupe claims of {len(records)} record(s): {e}")
+
+async def send_backpressure(send):
+    return await send_json(send, 429, {"error": "Ingestion queue is full. Retry later.", "retry_after": QUEUE_RETRY_AFTER_S},
+                           headers=[(b'retry-after', str(QUEUE_RETRY_AFTER_S).encode())])
+
+def content_type(scope):
+    """Returns the request media type without parameters (e.g. charset)."""
+    for name, value in scope.get('headers', []):
+        if name == b'content-type':
+            return value.split(b';')[0].strip().lower()
+    return b''
+
+# --- HANDLERS ---
+
+async def handle_webhook(scope, receive, send):
+    """Async variant of ingestion_service.ci_webhook."""
+    if content_type(scope) != b'application/json':
+        return await send_json(send, 400, {"error": "Content-Type must be application/json"})
+
+    try:
+        data = json.loads(await read_body(receive))
+    except Exception as e:
+        print(f"\n[INGESTION ASGI] Error parsing JSON payload: {e}")
+        return await send_json(send, 400, {"error": "Invalid JSON received"})
+
+    _, error = validate_payload(data)
+    if error:
+        PAYLOADS_REJECTED.inc()
+        return await send_json(send, 400, {"error": error})
+
+    try:
+        blobs = pop_line_coverage(data)
+    except coverage_bitmaps.CoverageBitmapError as e:
+        PAYLOADS_REJECTED.inc()
+        return await send_json(send, 400, {"error": str(e)})
+
+    if await queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return await send_backpressure(send)
+
+    return await queue_record(scope, send, data, blobs=blobs)
+
+async def store_line_coverage(items):
+    """Async variant of ingestion_service.store_line_coverage (best-effort, after the records are queued)."""
+    if not items:
+        return True
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for data, blobs in items:
+            coverage_bitmaps.queue_build(pipe, dedupe.project_of(data), data['build_id'], blobs)
+        await pipe.execute()
+    except redis_exceptions.RedisError as e:
+        print(f"[INGESTION ASGI] Could not store line coverage of {len(items)} build(s): {e}")
+        return False
+    return True
+
+async def queue_record(scope, send, data, extra=None, blobs=None):
+    """
+    Stamps, deduplicates and queues one validated record, then stores its line
+    bitmaps (blobs, if any) best-effort; extra is added to a successful response.
+    """
+    trace_header = dict(scope.get('headers', [])).get(b'x-trace-id')
+    stamp_trace(data, trace_header.decode('latin-1') if trace_header else None)
+    previous = None
+    try:
+        (duplicate,), previous = await claim_payloads([data])
+        if duplicate:
+            PAYLOADS_DUPLICATE.inc()
+            return await send_json(send, 200, {"status": "duplicate", "message": "Build already accepted",
+                                               "build_id": data['build_id'], **(extra or {})})
+        await enqueue_payloads(get_redis().pipeline(transaction=False), [codec.encode(data)], [data]).execute()
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError) as e:
+        print(f"[INGESTION ASGI] REDIS CONNECTION FAILED during LPUSH: {e}")
+        await release_claims([data], previous)
+        return await send_json(send, 503, {"error": "Redis connection unavailable. Data cannot be queued."})
+    except redis_exceptions.RedisError as e:
+        print(f"[INGESTION ASGI] REDIS ERROR during LPUSH: {e}")
+        await release_claims([data], previous)
+        return await send_json(send, 500, {"status": "error", "message": "Internal server error during Redis operation."})
+
+    PAYLOADS_QUEUED.inc()
+    extra = dict(extra or {})
+    if blobs is not None and not await store_line_coverage([(data, blobs)]):
+        extra["line_coverage"] = "not stored"
+    return await send_json(send, 200, {"status": "success", "message": "Data queued successfully",
+                                       "build_id": data['build_id'], "trace_id": data['trace_id'], **extra})
+
+async def handle_coverage(scope, receive, send):
+    """Async variant of ingestion_service.ci_webhook_coverage: the report is parsed as its chunks arrive."""
+    params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    if not (params.get('build_id') or params.get('buildNumber')):
+        PAYLOADS_REJECTED.inc()
+        return await send_json(send, 400, {"error": "Missing required query parameter: build_id or buildNumber"})
+
+    if await queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return await send_backpressure(send)
+
+    fmt = params.get('format')
+    try:
+        parser = coverage_reports.parser_for(fmt, lines=True) if fmt else None
+        async for chunk in iter_body_chunks(receive):
+            if parser is None:
+                parser = coverage_reports.parser_for(coverage_reports.detect_format(chunk), lines=True)
+            parser.feed(chunk)
+        if parser is None:
+            raise coverage_reports.CoverageReportError("Empty coverage report")
+        totals = parser.close()
+        data = coverage_reports.build_record(params, totals)
+    except ValueError as e:
+        PAYLOADS_REJECTED.inc()
+        return await send_json(send, 400, {"error": str(e)})
+    validate_payload(data)
+
+    return await queue_record(scope, send, data, {"coverage": totals.summary()},
+                              coverage_bitmaps.encode_files(totals.line_maps))
+
+async def handle_batch(scope, receive, send):
+    """Async variant of ingestion_service.ci_webhook_batch."""
+    if await queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return await send_backpressure(send)
+
+    mimetype = content_type(scope)
+    if mimetype in NDJSON_TYPES:
+        records = iter_ndjson_records(receive)
+    elif mimetype == b'application/json':
+        try:
+            body = json.loads(await read_body(receive))
+        except Exception as e:
+            print(f"\n[INGESTION ASGI] Error parsing batch payload: {e}")
+            return await send_json(send, 400, {"error": "Invalid JSON received"})
+        if not isinstance(body, list):
+            return await send_json(send, 400, {"error": "Invalid JSON received"})
+
+        async def iter_list():
+            for record in body:
+                yield record
+        records = iter_list()
+    else:
+        return await send_json(send, 400, {"error": "Content-Type must be application/json or application/x-ndjson"})
+
+    results = []
+    accepted = []
+    accepted_blobs = []
+    index = 0
+    async for record in records:
+        if index >= BATCH_MAX_RECORDS:
+            return await send_json(send, 413, {"error": f"Batch exceeds the maximum of {BATCH_MAX_RECORDS} records"})
+        if isinstance(record, Exception):
+            results.append({"index": index, "status": "rejected", "error": "Invalid JSON received"})
+        else:
+            build_id, error = validate_payload(record)
+            blobs = None
+            if not error:
+                try:
+                    blobs = pop_line_coverage(record)
+                except coverage_bitmaps.CoverageBitmapError as e:
+                    error = str(e)
+            if error:
+                results.append({"index": index, "status": "rejected", "error": error})
+            else:
+                stamp_trace(record)
+                accepted.append(record)
+                accepted_blobs.append(blobs)
+                results.append({"index": index, "status": "queued", "build_id": build_id, "trace_id": record['trace_id']})
+        index += 1
+
+    if not results:
+        return await send_json(send, 400, {"error": "Batch contains no records"})
+
+    queued = []
+    claimed = []
+    claimed_previous = None
+    coverage = []
+    duplicates = 0
+    try:
+        flags, previous = await claim_payloads(accepted)
+        claimed_previous = [] if previous is not None else None
+        accepted_results = (result for result in results if result['status'] == 'queued')
+        for position, (record, blobs, result, duplicate) in enumerate(zip(accepted, accepted_blobs, accepted_results, flags)):
+            if duplicate:
+                result['status'] = 'duplicate'
+                duplicates += 1
+                continue
+            queued.append(codec.encode(record))
+            claimed.append(record)
+            if previous is not None:
+                claimed_previous.append(previous[position])
+            if blobs is not None:
+                coverage.append((record, blobs, result))
+        if queued:
+            await enqueue_payloads(get_redis().pipeline(transaction=False), queued, claimed).execute()
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError) as e:
+        print(f"[INGESTION ASGI] REDIS CONNECTION FAILED during batch LPUSH: {e}")
+        await release_claims(claimed, claimed_previous)
+        return await send_json(send, 503, {"error": "Redis connection unavailable. Data cannot be queued."})
+    except redis_exceptions.RedisError as e:
+        print(f"[INGESTION ASGI] REDIS ERROR during batch LPUSH: {e}")
+        await release_claims(claimed, claimed_previous)
+        return await send_json(send, 500, {"status": "error", "message": "Internal server error during Redis operation."})
+    if not await store_line_coverage([(record, blobs) for record, blobs, _ in coverage]):
+        for _, _, result in coverage:
+            result['line_coverage'] = "not stored"
+
+    rejected = len(results) - len(accepted)
+    PAYLOADS_QUEUED.inc(len(queued))
+    PAYLOADS_REJECTED.inc(rejected)
+    PAYLOADS_DUPLICATE.inc(duplicates)
+    status_code = 200 if not rejected else (207 if accepted else 400)
+    return await send_json(send, status_code, {
+        "status": "success" if accepted else "error",
+        "queued": len(queued),
+        "duplicates": duplicates,
+        "rejected": rejected,
+        "results": results
+    })
+
+async def handle_metrics(send):
+    """
+    Prometheus metrics of all uvicorn worker processes, whichever one serves the
+    scrape: every series carries a worker="<pid>" label, and the other workers'
+    values are at most instrumentation.METRICS_SHARE_INTERVAL_S old. Scrape the
+    ingestion port as one target and aggregate with sum without (worker) (...).
+    """
+    try:
+        text = instrumentation.render_shared(METRICS_MULTIPROC_DIR)
+    except OSError as e:
+        print(f"[INGESTION ASGI] Could not read the metrics of the other workers: {e}")
+        text = instrumentation.render()
+    body = text.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', instrumentation.CONTENT_TYPE.encode()), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+ROUTES = {
+    '/webhook/ci': handle_webhook,
+    '/webhook/ci/batch': handle_batch,
+    '/webhook/ci/coverage': handle_coverage,
+}
+
+# Last queue length read by queue_saturated(); a scrape never waits on Redis
+instrumentation.gauge('ingestion_queue_depth', "Payloads waiting in the Redis queue (as last read by this process).",
+                      lambda: _queue_depth[1])
+
+async def handle_lifespan(receive, send):
+    """Opens the Redis pool at startup and releases it on shutdown."""
+    global redis_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            instrumentation.maybe_start_profiler('ingestion-asgi')
+            instrumentation.share_metrics(METRICS_MULTIPROC_DIR)
+            try:
+                await get_redis().ping()
+                print(f"[INGESTION ASGI] Successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT} (DB {REDIS_DB})")
+            except redis_exceptions.ConnectionError as e:
+                print(f"[INGESTION ASGI] REDIS CONNECTION FAILED: Could not connect to Redis at {REDIS_HOST}:{REDIS_PORT}. Error: {e}")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if redis_client is not None:
+                await redis_client.aclose()
+                redis_client = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """
+    Production ingestion entry point (ASGI).
+    Serves the same endpoints as the Flask app without blocking a thread per request.
+    """
+    if scope['type'] == 'lifespan':
+        return await handle_lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == '/metrics' and scope['method'] == 'GET':
+        return await handle_metrics(send)
+    handler = ROUTES.get(scope['path'])
+    if handler is None:
+        return await send_json(send, 404, {"error": "Not found"})
+    if scope['method'] != 'POST':
+        return await send_json(send, 405, {"error": "Method not allowed"})
+
+    async def counting_send(message):
+        if message['type'] == 'http.response.start':
+            instrumentation.counter('ingestion_requests_total', "HTTP requests handled, by route and status.",
+                                    route=scope['path'], status=str(message['status'])).inc()
+        await send(message)
+
+    try:
+        await handler(scope, receive, counting_send)
+    except Exception as e:
+        print(f"[INGESTION ASGI] UNHANDLED EXCEPTION in webhook: {e}")
+        await send_json(send, 500, {"status": "error", "message": "Internal server error. Check logs."})
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("[INGESTION ASGI] FATAL ERROR: uvicorn is required for the production ingestion mode (pip install uvicorn).")
+        sys.exit(1)
+
+    # Metrics published by the workers of an earlier run would be reported as live ones
+    instrumentation.reset_shared(METRICS_MULTIPROC_DIR)
+    print(f"\n--- Running Ingestion API (ASGI, {INGESTION_WORKERS} workers) on http://127.0.0.1:{INGESTION_PORT}/webhook/ci ---")
+    uvicorn.run('ingestion_asgi:app', host='127.0.0.1', port=INGESTION_PORT,
+                workers=INGESTION_WORKERS, access_log=False, log_level='warning')
@@ -2,47 +2,231 @@ import json
 import os
 import signal
 import sys
-from flask import Flask, request, jsonify
-from redis import Redis, exceptions as redis_exceptions
+import uuid
+from flask import Flask, Response, request, jsonify
+from redis import exceptions as redis_exceptions
 import time
+import codec
+import coverage_bitmaps
+import coverage_reports
+import dedupe
+import fair_queue
+import instrumentation
+import settings
+from settings import (
+    INGESTION_PORT, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_QUEUE,
+    REDIS_STREAM, REDIS_STREAM_FIELD, queue_length
+)
+from write_ahead_log import WriteAheadLog
 
-# --- CONFIGURATION (Shared Globals) ---
-INGESTION_PORT = 5000
-REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
-REDIS_PORT = os.getenv('REDIS_PORT', 6379)
-REDIS_DB = 0
-REDIS_QUEUE = 'ci_data_queue' 
+# --- CONFIGURATION ---
+# Upper bound on records accepted by a single /webhook/ci/batch request
+BATCH_MAX_RECORDS = int(os.getenv('BATCH_MAX_RECORDS', 10000))
+# Number of payloads sent per LPUSH command inside the batch pipeline
+BATCH_PUSH_CHUNK = 500
+# Backpressure: above this many queued payloads new data is refused with 429 until the workers catch up
+QUEUE_HIGH_WATER_MARK = int(os.getenv('QUEUE_HIGH_WATER_MARK', 100000))
+# The queue length is read from Redis at most once per interval and shared by all requests
+QUEUE_DEPTH_CACHE_S = 0.5
+# Retry-After (seconds) sent with 429 responses
+QUEUE_RETRY_AFTER_S = int(os.getenv('QUEUE_RETRY_AFTER_S', 5))
+# Spool accepted payloads to the local write-ahead log while Redis is unreachable (202 instead of 503)
+WAL_ENABLED = os.getenv('WAL_ENABLED', '1') == '1'
 
 app = Flask(__name__)
 redis_client = None
+# Write-ahead log; created by init_wal() in the Flask service process only
+wal = None
+# (monotonic time of the reading, queue length)
+_queue_depth = (0.0, 0)
+
+# --- INSTRUMENTATION ---
+PAYLOADS_QUEUED = instrumentation.counter('ingestion_payloads_total', "Payloads received, by outcome.", outcome='queued')
+PAYLOADS_SPOOLED = instrumentation.counter('ingestion_payloads_total', "Payloads received, by outcome.", outcome='spooled')
+PAYLOADS_REJECTED = instrumentation.counter('ingestion_payloads_total', "Payloads received, by outcome.", outcome='rejected')
+PAYLOADS_THROTTLED = instrumentation.counter('ingestion_payloads_total', "Payloads received, by outcome.", outcome='throttled')
+PAYLOADS_DUPLICATE = instrumentation.counter('ingestion_payloads_total', "Payloads received, by outcome.", outcome='duplicate')
 
 def init_redis(log_connection=False):
     """
-    Initializes and returns the Redis client. 
-    Attempts to connect/ping, and sets redis_client to None on failure.
+    Initializes and returns the Redis client backed by the shared connection pool
+    (see settings.redis_client). No PING is sent per call, so the hot path costs
+    exactly one round trip per request.
+    Only the startup call (log_connection=True) pings to report connectivity.
     """
     global redis_client
-    
-    if redis_client:
+
+    if redis_client is None:
+        redis_client = settings.redis_client()
+
+    if log_connection:
         try:
-            # Check if existing connection is alive
             redis_client.ping()
-            return redis_client
-        except redis_exceptions.ConnectionError:
-            print("[INGESTION SERVICE] Redis connection lost, re-attempting initialization.")
-            redis_client = None # Force re-initialization
+            print("[INGESTION SERVICE] Successfully connected to Redis at {}:{} (DB {})".format(REDIS_HOST, REDIS_PORT, REDIS_DB))
+        except redis_exceptions.ConnectionError as e:
+            print(f"[INGESTION SERVICE] REDIS CONNECTION FAILED: Could not connect to Redis at {REDIS_HOST}:{REDIS_PORT}. Error: {e}")
+    return redis_client
+
+def reset_redis():
+    """Drops all pooled connections after a Redis error so the next request reconnects."""
+    global redis_client
+    settings.reset_redis_clients()
+    redis_client = None
+
+def enqueue_payloads(pipe, payloads, records=None):
+    """
+    Adds the commands that queue the given encoded payloads to a pipeline,
+    using the configured queue backend. The caller executes the pipeline.
+    records (the decoded payloads, if at hand) spare the fair backend decoding them to route.
+    """
+    if settings.QUEUE_BACKEND == 'stream':
+        for payload in payloads:
+            pipe.xadd(REDIS_STREAM, {REDIS_STREAM_FIELD: payload})
+        return pipe
+    if settings.QUEUE_BACKEND == 'fair':
+        return fair_queue.queue_push(pipe, payloads, records)
+    for start in range(0, len(payloads), BATCH_PUSH_CHUNK):
+        pipe.lpush(REDIS_QUEUE, *payloads[start:start + BATCH_PUSH_CHUNK])
+    return pipe
+
+def queue_saturated():
+    """
+    True when the queue is above QUEUE_HIGH_WATER_MARK.
+    The length is cached for QUEUE_DEPTH_CACHE_S, so under load this costs one
+    LLEN per interval rather than one per request. If Redis cannot be reached
+    the queue is treated as not saturated (the payload is spooled instead).
+    """
+    global _queue_depth
+    checked_at, depth = _queue_depth
+    now = time.monotonic()
+    if now - checked_at >= QUEUE_DEPTH_CACHE_S:
+        try:
+            depth = queue_length(init_redis())
+        except redis_exceptions.RedisError:
+            depth = 0
+        _queue_depth = (now, depth)
+    return depth >= QUEUE_HIGH_WATER_MARK
+
+def backpressure_response():
+    response = jsonify({"error": "Ingestion queue is full. Retry later.", "retry_after": QUEUE_RETRY_AFTER_S})
+    response.headers['Retry-After'] = str(QUEUE_RETRY_AFTER_S)
+    return response, 429
 
-    # If redis_client is None (first run or connection lost)
+def push_payloads(payloads):
+    """Queues payloads in one atomic MULTI/EXEC pipeline (used to replay the write-ahead log)."""
     try:
-        temp_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, socket_timeout=5, socket_connect_timeout=5)
-        temp_client.ping()
-        redis_client = temp_client
-        if log_connection:
-            print("[INGESTION SERVICE] Successfully connected to Redis at {}:{} (DB {})".format(REDIS_HOST, REDIS_PORT, REDIS_DB))
-        return redis_client
-    except redis_exceptions.ConnectionError as e:
-        print(f"[INGESTION SERVICE] REDIS CONNECTION FAILED: Could not connect to Redis at {REDIS_HOST}:{REDIS_PORT}. Error: {e}")
-        return None
+        enqueue_payloads(init_redis().pipeline(transaction=True), payloads).execute()
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError):
+        reset_redis()
+        raise
+
+def queue_or_spool(payloads, records=None):
+    """
+    Queues payloads in Redis, or appends them to the write-ahead log when Redis
+    is unreachable. While the log still holds older payloads, new ones are
+    appended behind them so builds reach the workers in arrival order.
+    Returns True if the payloads were spooled rather than queued.
+    Raises the Redis error when no write-ahead log is configured.
+    """
+    if wal is not None and wal.has_pending():
+        wal.append(payloads)
+        return True
+    try:
+        enqueue_payloads(init_redis().pipeline(transaction=False), payloads, records).execute()
+        return False
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError) as e:
+        reset_redis()
+        if wal is None:
+            raise
+        print(f"[INGESTION SERVICE] Redis unavailable ({e}); spooling {len(payloads)} payload(s) to the write-ahead log.")
+        wal.append(payloads)
+        return True
+
+def init_wal():
+    """Opens the write-ahead log and starts replaying it whenever Redis accepts data again."""
+    global wal
+    wal = WriteAheadLog()
+    wal.start_drain_thread(push_payloads, can_drain=lambda: not queue_saturated())
+    return wal
+
+def stamp_trace(data, trace_id=None):
+    """
+    Stamps a record with a trace ID (kept if the sender already set one) and the
+    ingest time, so downstream stages can measure queue wait and end-to-end latency.
+    """
+    data.setdefault('trace_id', trace_id or uuid.uuid4().hex)
+    data['ingest_ts'] = time.time()
+    return data
+
+def claim_payloads(records):
+    """
+    Stamps each record's content hash and claims it for deduplication in one
+    pipelined round trip. Returns (duplicate flags, previous hashes); when
+    deduplication is off or Redis is unreachable nothing is claimed, every flag
+    is False and previous hashes is None (the worker still drops duplicates).
+    """
+    for record in records:
+        record['content_hash'] = dedupe.content_hash(record)
+    if not dedupe.DEDUPE_ENABLED:
+        return [False] * len(records), None
+    try:
+        previous = dedupe.queue_claims(init_redis().pipeline(transaction=False), records).execute()
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError):
+        reset_redis()
+        return [False] * len(records), None
+    return dedupe.duplicate_flags(records, previous), previous
+
+def release_claims(records, previous):
+    """Best-effort undo of claims for records that could not be queued."""
+    if previous is None:
+        return
+    try:
+        dedupe.queue_release(init_redis().pipeline(transaction=False), records, previous).execute()
+    except redis_exceptions.RedisError as e:
+        print(f"[INGESTION SERVICE] Could not release dedupe claims of {len(records)} record(s): {e}")
+
+def validate_payload(data):
+    """
+    Applies the webhook validation rules to a single decoded record.
+    Returns (build_id, None) on success or (None, error_message) on failure.
+    On success the record's 'build_id' is normalized to a string in place.
+    """
+    if not isinstance(data, dict):
+        return None, "Record must be a JSON object"
+
+    build_id = data.get('build_id') or data.get('buildNumber')
+
+    # Check for the required build identifier (build_id or buildNumber)
+    if not build_id:
+        return None, "Missing required field: build_id or buildNumber"
+
+    # Ensure build_id is consistently in the dictionary and is a string
+    data['build_id'] = str(build_id)
+    return data['build_id'], None
+
+def iter_batch_records():
+    """
+    Yields decoded records from the current batch request.
+    A JSON array body is decoded at once; an NDJSON body (application/x-ndjson)
+    is read line by line from the request stream so large uploads are never
+    buffered whole. Lines that are not valid JSON are yielded as exceptions.
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield e
+        return
+
+    records = request.get_json()
+    if not isinstance(records, list):
+        raise ValueError("Batch body must be a JSON array")
+    for record in records:
+        yield record
 
 @app.route('/webhook/ci', methods=['POST'])
 def ci_webhook():
@@ -61,40 +245,253 @@ def ci_webhook():
         return jsonify({"error": "Invalid JSON received"}), 400
     
     
-    build_id = data.get('build_id') or data.get('buildNumber')
-    
-    # Check for the required build identifier (build_id or buildNumber)
-    if not build_id:
-        return jsonify({"error": "Missing required field: build_id or buildNumber"}), 400
+    _, error = validate_payload(data)
+    if error:
+        PAYLOADS_REJECTED.inc()
+        return jsonify({"error": error}), 400
 
-    # Ensure build_id is consistently in the dictionary and is a string
-    data['build_id'] = str(build_id)
-    
-    # Try to get a valid Redis connection immediately before use
-    redis_conn = init_redis() 
-    if redis_conn is None:
-        # Return 503 Service Unavailable if Redis connection fails
-        return jsonify({"error": "Redis connection unavailable. Data cannot be queued."}), 503
+    try:
+        blobs = pop_line_coverage(data)
+    except coverage_bitmaps.CoverageBitmapError as e:
+        PAYLOADS_REJECTED.inc()
+        return jsonify({"error": str(e)}), 400
+
+    if queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return backpressure_response()
+
+    body, status = queue_record(data, request.headers.get('X-Trace-Id'), blobs)
+    return jsonify(body), status
+
+def pop_line_coverage(data):
+    """
+    Removes the 'line_coverage' field from a validated record and returns its parsed
+    blobs (None if it has none). Per-file line coverage is stored as bitmaps once the
+    record is accepted and never travels through the queue.
+    Raises CoverageBitmapError for malformed line coverage.
+    """
+    line_coverage = data.pop('line_coverage', None)
+    return None if line_coverage is None else coverage_bitmaps.parse_line_coverage(line_coverage)
 
+def store_line_coverage(items):
+    """
+    Best-effort store of the line bitmaps of accepted records, items being
+    (record, blobs) pairs, in one pipelined round trip. The records themselves are
+    already queued or spooled, so a Redis failure here only loses their coverage
+    diffs. Returns True if the bitmaps were stored.
+    """
+    if not items:
+        return True
     try:
-        # Queue the data as a JSON string
-        json_data = json.dumps(data)
-        redis_conn.lpush(REDIS_QUEUE, json_data) 
-        print(f"\n[INGESTION SERVICE] Received build {data['build_id']} and queued to Redis.")
-        
-        # Must return a successful response to the watcher
-        return jsonify({"status": "success", "message": "Data queued successfully", "build_id": data['build_id']}), 200
+        pipe = init_redis().pipeline(transaction=False)
+        for data, blobs in items:
+            coverage_bitmaps.queue_build(pipe, dedupe.project_of(data), data['build_id'], blobs)
+        pipe.execute()
+    except redis_exceptions.RedisError as e:
+        if isinstance(e, (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError)):
+            reset_redis()
+        print(f"[INGESTION SERVICE] Could not store line coverage of {len(items)} build(s): {e}")
+        return False
+    return True
+
+def queue_record(data, trace_id=None, blobs=None):
+    """
+    Stamps, deduplicates and queues (or spools) one validated record, then stores
+    its line bitmaps (blobs, if any) best-effort.
+    Returns the response (body, status) shared by the single-record endpoints.
+    """
+    stamp_trace(data, trace_id)
+    (duplicate,), previous = claim_payloads([data])
+    if duplicate:
+        # Sender retry or watcher re-post of content we already have: nothing to queue
+        PAYLOADS_DUPLICATE.inc()
+        return {"status": "duplicate", "message": "Build already accepted", "build_id": data['build_id']}, 200
 
+    try:
+        # Queue the data encoded with the configured codec (format marked per message)
+        if queue_or_spool([codec.encode(data)], [data]):
+            PAYLOADS_SPOOLED.inc()
+            # Durably accepted; the write-ahead log delivers it once Redis is back
+            body, status = {"status": "accepted", "message": "Redis unavailable. Data spooled for delivery", "build_id": data['build_id'], "trace_id": data['trace_id']}, 202
+        else:
+            PAYLOADS_QUEUED.inc()
+            print(f"\n[INGESTION SERVICE] Received build {data['build_id']} (trace {data['trace_id']}) and queued to Redis.")
+
+            # Must return a successful response to the watcher
+            body, status = {"status": "success", "message": "Data queued successfully", "build_id": data['build_id'], "trace_id": data['trace_id']}, 200
+        if blobs is not None and not store_line_coverage([(data, blobs)]):
+            body["line_coverage"] = "not stored"
+        return body, status
+
+    except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError) as e:
+        # Return 503 Service Unavailable if Redis cannot be reached and no write-ahead log is configured
+        print(f"[INGESTION SERVICE] REDIS CONNECTION FAILED during LPUSH: {e}")
+        release_claims([data], previous)
+        return {"error": "Redis connection unavailable. Data cannot be queued."}, 503
     except redis_exceptions.RedisError as e:
-        # Explicitly set redis_client to None on push failure 
+        # Drop pooled connections on push failure
         print(f"[INGESTION SERVICE] REDIS ERROR during LPUSH: {e}")
-        global redis_client
-        redis_client = None
-        return jsonify({"status": "error", "message": "Internal server error during Redis operation. Redis client invalidated."}), 500
+        reset_redis()
+        release_claims([data], previous)
+        return {"status": "error", "message": "Internal server error during Redis operation. Redis client invalidated."}, 500
     except Exception as e:
         # Catch any other unhandled errors
         print(f"[INGESTION SERVICE] UNHANDLED EXCEPTION in webhook: {e}")
-        return jsonify({"status": "error", "message": "Internal server error. Check logs."}), 500
+        return {"status": "error", "message": "Internal server error. Check logs."}, 500
+
+@app.route('/webhook/ci/coverage', methods=['POST'])
+def ci_webhook_coverage():
+    """
+    Receives a raw LCOV or Cobertura XML report as the request body and queues its
+    line totals as one build; the per-file line bitmaps are stored for coverage diffs.
+    The body is parsed chunk by chunk while it is read, so memory stays flat for
+    reports of any size. ?format=lcov|cobertura overrides detection.
+    """
+    if not (request.args.get('build_id') or request.args.get('buildNumber')):
+        PAYLOADS_REJECTED.inc()
+        return jsonify({"error": "Missing required query parameter: build_id or buildNumber"}), 400
+
+    if queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return backpressure_response()
+
+    try:
+        totals = coverage_reports.parse_chunks(coverage_reports.read_chunks(request.stream),
+                                               request.args.get('format'), lines=True)
+        data = coverage_reports.build_record(request.args, totals)
+    except ValueError as e:
+        # CoverageReportError, or a malformed number in the build metadata
+        PAYLOADS_REJECTED.inc()
+        return jsonify({"error": str(e)}), 400
+    validate_payload(data)
+
+    body, status = queue_record(data, request.headers.get('X-Trace-Id'),
+                                coverage_bitmaps.encode_files(totals.line_maps))
+    if status < 300:
+        body["coverage"] = totals.summary()
+    return jsonify(body), status
+
+@app.route('/webhook/ci/batch', methods=['POST'])
+def ci_webhook_batch():
+    """
+    Receives many CI runs in one request (JSON array or NDJSON stream),
+    validates each record and queues all valid ones in a single pipelined call.
+    Responds with a per-record status list.
+    """
+    if request.mimetype not in ('application/json', 'application/x-ndjson', 'application/jsonl'):
+        return jsonify({"error": "Content-Type must be application/json or application/x-ndjson"}), 400
+
+    if queue_saturated():
+        PAYLOADS_THROTTLED.inc()
+        return backpressure_response()
+
+    results = []
+    accepted = []
+    # Parsed line coverage of each accepted record (None if it has none)
+    accepted_blobs = []
+    try:
+        for index, record in enumerate(iter_batch_records()):
+            if index >= BATCH_MAX_RECORDS:
+                return jsonify({"error": f"Batch exceeds the maximum of {BATCH_MAX_RECORDS} records"}), 413
+            if isinstance(record, Exception):
+                results.append({"index": index, "status": "rejected", "error": "Invalid JSON received"})
+                continue
+            build_id, error = validate_payload(record)
+            if error:
+                results.append({"index": index, "status": "rejected", "error": error})
+                continue
+            try:
+                blobs = pop_line_coverage(record)
+            except coverage_bitmaps.CoverageBitmapError as e:
+                results.append({"index": index, "status": "rejected", "error": str(e)})
+                continue
+            stamp_trace(record)
+            accepted.append(record)
+            accepted_blobs.append(blobs)
+            results.append({"index": index, "status": "queued", "build_id": build_id, "trace_id": record['trace_id']})
+    except Exception as e:
+        print(f"\n[INGESTION SERVICE] Error parsing batch payload: {e}")
+        return jsonify({"error": "Invalid JSON received"}), 400
+
+    if not results:
+        return jsonify({"error": "Batch contains no records"}), 400
+
+    # Drop records whose identical content was already accepted (all claimed in one round trip)
+    flags, previous = claim_payloads(accepted)
+    queued = []
+    claimed = []
+    claimed_previous = []
+    # (record, blobs, result) of queued records carrying line coverage
+    coverage = []
+    duplicates = 0
+    accepted_results = (result for result in results if result['status'] == 'queued')
+    for position, (record, blobs, result, duplicate) in enumerate(zip(accepted, accepted_blobs, accepted_results, flags)):
+        if duplicate:
+            result['status'] = 'duplicate'
+            duplicates += 1
+            continue
+        queued.append(codec.encode(record))
+        claimed.append(record)
+        if previous is not None:
+            claimed_previous.append(previous[position])
+        if blobs is not None:
+            coverage.append((record, blobs, result))
+
+    spooled = False
+    if queued:
+        try:
+            # One round trip for the whole batch; records keep their arrival order in the queue
+            spooled = queue_or_spool(queued, claimed)
+        except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError) as e:
+            print(f"[INGESTION SERVICE] REDIS CONNECTION FAILED during batch LPUSH: {e}")
+            release_claims(claimed, claimed_previous if previous is not None else None)
+            return jsonify({"error": "Redis connection unavailable. Data cannot be queued."}), 503
+        except redis_exceptions.RedisError as e:
+            print(f"[INGESTION SERVICE] REDIS ERROR during batch LPUSH: {e}")
+            reset_redis()
+            release_claims(claimed, claimed_previous if previous is not None else None)
+            return jsonify({"status": "error", "message": "Internal server error during Redis operation. Redis client invalidated."}), 500
+        if not store_line_coverage([(record, blobs) for record, blobs, _ in coverage]):
+            for _, _, result in coverage:
+                result['line_coverage'] = "not stored"
+
+    rejected = len(results) - len(accepted)
+    (PAYLOADS_SPOOLED if spooled else PAYLOADS_QUEUED).inc(len(queued))
+    PAYLOADS_REJECTED.inc(rejected)
+    PAYLOADS_DUPLICATE.inc(duplicates)
+    print(f"\n[INGESTION SERVICE] Batch received: {len(queued)} {'spooled' if spooled else 'queued'}, "
+          f"{duplicates} duplicate, {rejected} rejected.")
+
+    # 200 when every record was accepted (202 if spooled), 207 for a partial batch, 400 when nothing was usable
+    status_code = (202 if spooled else 200) if not rejected else (207 if accepted else 400)
+    return jsonify({
+        "status": "success" if accepted else "error",
+        "queued": len(queued),
+        "duplicates": duplicates,
+        "rejected": rejected,
+        "spooled": spooled,
+        "results": results
+    }), status_code
+
+@app.after_request
+def count_request(response):
+    """Counts handled requests by route and status code."""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    instrumentation.counter('ingestion_requests_total', "HTTP requests handled, by route and status.",
+                            route=route, status=str(response.status_code)).inc()
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this ingestion process."""
+    return Response(instrumentation.render(), content_type=instrumentation.CONTENT_TYPE)
+
+def register_gauges():
+    """Scrape-time gauges of the Flask service: queue depth and write-ahead log backlog."""
+    instrumentation.gauge('ingestion_queue_depth', "Payloads waiting in the Redis queue.",
+                          lambda: queue_length(init_redis()))
+    instrumentation.gauge('ingestion_wal_pending', "1 while the write-ahead log holds payloads not yet replayed.",
+                          lambda: int(wal is not None and wal.has_pending()))
 
 def signal_handler(sig, frame):
     """Graceful exit handler for the Flask app process."""
@@ -105,6 +502,10 @@ def signal_handler(sig, frame):
 if __name__ == '__main__':
     # Initialize Redis connection on startup (log connection details here)
     init_redis(log_connection=True)
+    if WAL_ENABLED:
+        init_wal()
+    register_gauges()
+    instrumentation.maybe_start_profiler('ingestion')
     
     # Register signal handlers
     signal.signal(signal.SIGINT, signal_handler)
@@ -114,7 +515,8 @@ if __name__ == '__main__':
     
     # Flask run command will block here until termination
     try:
-        app.run(host='127.0.0.1', port=INGESTION_PORT, debug=False)
+        # Simple mode: threaded Flask server. Use ingestion_asgi.py for the production mode.
+        app.run(host='127.0.0.1', port=INGESTION_PORT, debug=False, threaded=True)
     except OSError as e:
         if "Address already in use" in str(e):
             print(f"[INGESTION SERVICE] FATAL ERROR: Port {INGESTION_PORT} is already in use. Terminating Ingestion service.")
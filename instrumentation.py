@@ -0,0 +1,309 @@
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- CONFIGURATION ---
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Sampling profiler: sample every N ms when set (0 disables it)
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 0))
+PROFILER_OUTPUT_DIR = os.getenv('PROFILER_OUTPUT_DIR', 'profiles')
+# How often the profiler rewrites its output file
+PROFILER_FLUSH_INTERVAL_S = 30
+# Multi-process servers: how often each process publishes its metrics for the others (see share_metrics)
+METRICS_SHARE_INTERVAL_S = float(os.getenv('METRICS_SHARE_INTERVAL_S', 5))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name -> {'type', 'help', 'series': {label tuple: metric}}
+_families = {}
+_registry_lock = threading.Lock()
+
+class Counter:
+    """Monotonic counter."""
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Histogram:
+    """
+    Fixed-bucket histogram: observe() is one bisect and one increment, and
+    memory does not grow with the number of observations.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        result = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            result.append((name + '_bucket', labels + (('le', le),), cumulative))
+        result.append((name + '_sum', labels, total))
+        result.append((name + '_count', labels, count))
+        return result
+
+class Gauge:
+    """Value read from a callback at scrape time, so nothing is updated on the hot path."""
+    __slots__ = ('read',)
+
+    def __init__(self, read):
+        self.read = read
+
+    def samples(self, name, labels):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [] if value is None else [(name, labels, value)]
+
+def _series(kind, name, help_text, labels, factory):
+    key = tuple(sorted(labels.items()))
+    family = _families.get(name)
+    if family is not None and key in family['series']:
+        return family['series'][key]
+    with _registry_lock:
+        family = _families.setdefault(name, {'type': kind, 'help': help_text, 'series': {}})
+        if family['type'] != kind:
+            raise ValueError(f"Metric {name} is already registered as a {family['type']}")
+        return family['series'].setdefault(key, factory())
+
+def counter(name, help_text, **labels):
+    """Returns the counter for name and labels, registering it on first use."""
+    return _series('counter', name, help_text, labels, Counter)
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, **labels):
+    """Returns the histogram for name and labels, registering it on first use."""
+    return _series('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+def gauge(name, help_text, read, **labels):
+    """Registers a gauge whose value is read(); replaces an earlier callback for the same labels."""
+    series = _series('gauge', name, help_text, labels, lambda: Gauge(read))
+    series.read = read
+    return series
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+def _collect(extra_labels=()):
+    """name -> {'type', 'help', 'samples': [(sample name, labels, value)]} of the registered metrics."""
+    families = {}
+    for name, family in list(_families.items()):
+        samples = []
+        for labels, series in list(family['series'].items()):
+            samples.extend(series.samples(name, tuple(extra_labels) + labels))
+        families[name] = {'type': family['type'], 'help': family['help'], 'samples': samples}
+    return families
+
+def _format(families):
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample_name, sample_labels, value in family['samples']:
+            lines.append(f"{sample_name}{_format_labels(sample_labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    return _format(_collect())
+
+# --- MULTI-PROCESS SERVERS ---
+# A server with several worker processes behind one port (uvicorn --workers) answers
+# each scrape from whichever process accepted the connection. Each process therefore
+# publishes its metrics to a shared directory, and /metrics returns those of all
+# processes, every series labelled worker="<pid>". Scrape the port as a single target
+# and aggregate with sum without (worker) (...); counters of a restarted worker
+# continue as a new series, which rate() and increase() handle.
+
+def _process_file(directory, pid):
+    return os.path.join(directory, f"{pid}.json")
+
+def _write_shared(directory):
+    pid = os.getpid()
+    path = _process_file(directory, pid)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(_collect((('worker', str(pid)),)), f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def _share_loop(directory, interval_s):
+    while True:
+        try:
+            _write_shared(directory)
+        except OSError as e:
+            print(f"[METRICS] Could not publish metrics to {directory}: {e}")
+        time.sleep(interval_s)
+
+def reset_shared(directory):
+    """Empties the shared directory; call in the parent process before starting the workers."""
+    os.makedirs(directory, exist_ok=True)
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.json') or file_name.endswith('.tmp'):
+            os.remove(os.path.join(directory, file_name))
+
+def share_metrics(directory, interval_s=METRICS_SHARE_INTERVAL_S):
+    """
+    Publishes this process's metrics to directory every interval_s from a daemon
+    thread, for render_shared() in its sibling processes.
+    """
+    os.makedirs(directory, exist_ok=True)
+    thread = threading.Thread(target=_share_loop, args=(directory, interval_s), name='metrics-share', daemon=True)
+    thread.start()
+    return thread
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def render_shared(directory):
+    """
+    Metrics of every process sharing directory, labelled by worker pid: this
+    process's current values and the others' as last published (at most
+    METRICS_SHARE_INTERVAL_S old). Files of processes that exited are removed.
+    """
+    own_pid = os.getpid()
+    families = _collect((('worker', str(own_pid)),))
+    for file_name in os.listdir(directory):
+        pid_text, extension = os.path.splitext(file_name)
+        if extension != '.json' or not pid_text.isdigit() or int(pid_text) == own_pid:
+            continue
+        path = os.path.join(directory, file_name)
+        if not _running(int(pid_text)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                published = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, family in published.items():
+            merged = families.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': []})
+            if merged['type'] != family['type']:
+                continue
+            merged['samples'].extend((sample_name, tuple(tuple(label) for label in labels), value)
+                                     for sample_name, labels, value in family['samples'])
+    return _format(families)
+
+# --- SIDECAR SERVER ---
+
+def start_metrics_server(port, health_check=None, host='0.0.0.0'):
+    """
+    Serves /metrics (and /healthz) from a daemon thread, for processes without
+    an HTTP server of their own. health_check() returns (ok, detail).
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                status, content_type, body = 200, CONTENT_TYPE, render()
+            elif self.path == '/healthz':
+                ok, detail = health_check() if health_check else (True, 'ok')
+                status, content_type, body = (200 if ok else 503), 'text/plain; charset=utf-8', detail + '\n'
+            else:
+                status, content_type, body = 404, 'text/plain; charset=utf-8', 'Not found\n'
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the service log
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"[METRICS] Could not serve metrics on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"[METRICS] Serving /metrics and /healthz on port {port}.")
+    return server
+
+# --- SAMPLING PROFILER ---
+
+def _profile_loop(service_name, interval_s):
+    own_id = threading.get_ident()
+    stacks = collections.Counter()
+    path = os.path.join(PROFILER_OUTPUT_DIR, f"{service_name}-{os.getpid()}.folded")
+    next_flush = time.monotonic() + PROFILER_FLUSH_INTERVAL_S
+    while True:
+        time.sleep(interval_s)
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stacks[';'.join(reversed(parts))] += 1
+        if time.monotonic() >= next_flush:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            os.replace(temp_path, path)
+            next_flush = time.monotonic() + PROFILER_FLUSH_INTERVAL_S
+
+def maybe_start_profiler(service_name):
+    """
+    Starts the built-in sampling profiler when PROFILER_INTERVAL_MS is set.
+    It samples every thread's stack at that interval and periodically writes
+    collapsed stacks (flamegraph.pl / speedscope format) to PROFILER_OUTPUT_DIR.
+    """
+    if PROFILER_INTERVAL_MS <= 0:
+        return None
+    os.makedirs(PROFILER_OUTPUT_DIR, exist_ok=True)
+    thread = threading.Thread(target=_profile_loop, args=(service_name, PROFILER_INTERVAL_MS / 1000.0),
+                              name='sampling-profiler', daemon=True)
+    thread.start()
+    print(f"[METRICS] Sampling profiler active for {service_name} every {PROFILER_INTERVAL_MS:g} ms "
+          f"(output: {PROFILER_OUTPUT_DIR}).")
+    return thread
@@ -1,46 +1,166 @@
-# --- SIMULATED INFRASTRUCTURE ---
-RAW_DB = {} # Simulates InfluxDB/Raw Metrics Storage
+class NormalizationError(ValueError):
+    """Raised when a payload matches no adapter or fails its adapter's mapping or validation."""
+
+# --- INTERNAL SCHEMA ---
+# Every adapter produces exactly these fields; downstream stages rely on nothing else
+SCHEMA_FIELDS = (
+    'project_id', 'build_id', 'timestamp', 'pipeline_duration_s',
+    'covered_lines', 'total_lines', 'coverage_threshold_passed'
+)
+
+# Fields stamped by the ingestion service (tracing, deduplication); copied through unchanged when present
+INGEST_FIELDS = ('trace_id', 'ingest_ts', 'content_hash')
+
+# Checks applied to every normalized record, as (expression over `n`, error message)
+VALIDATION_RULES = (
+    ("n['pipeline_duration_s'] >= 0", "pipeline duration must not be negative"),
+    ("n['covered_lines'] >= 0", "covered_lines must not be negative"),
+    ("n['total_lines'] >= 0", "total_lines must not be negative"),
+    ("n['covered_lines'] <= n['total_lines']", "covered_lines exceeds total_lines"),
+)
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+# Converters that field mappings may reference by name
+CONVERTERS = {'str': str, 'int': int, 'float': float, 'bool': _to_bool}
+
+class Adapter:
+    """
+    Implements the Adapter Pattern for one input schema.
+    The field mapping is compiled once into a single function that builds the
+    normalized record with one dict display (no per-field branching at run time);
+    the validation rules are compiled into one boolean expression.
+
+    fields maps each SCHEMA_FIELDS entry to (source_key, converter_name, default, scale),
+    where default None marks a required field and scale is an optional multiplier.
+    source_key may be a tuple of keys tried in order (the first present one is used).
+    """
+
+    def __init__(self, name, fields, report_versions=(), shape_key=None):
+        missing = set(SCHEMA_FIELDS) - set(fields)
+        if missing:
+            raise ValueError(f"Adapter {name} does not map fields: {sorted(missing)}")
+        self.name = name
+        self.report_versions = tuple(report_versions)
+        self.shape_key = shape_key
+        self._map = self._compile_mapping(fields)
+        self._valid = eval(compile(
+            "lambda n: " + " and ".join(f"({rule})" for rule, _ in VALIDATION_RULES),
+            f"<adapter:{name}:validate>", 'eval'), {'__builtins__': {}})
+
+    def _compile_mapping(self, fields):
+        entries = []
+        for out_key in SCHEMA_FIELDS:
+            source_key, converter, default, scale = fields[out_key]
+            source_keys = source_key if isinstance(source_key, tuple) else (source_key,)
+            lookup = f"d[{source_keys[-1]!r}]" if default is None else f"d.get({source_keys[-1]!r}, {default!r})"
+            for key in reversed(source_keys[:-1]):
+                lookup = f"(d[{key!r}] if {key!r} in d else {lookup})"
+            expression = f"{converter}({lookup})"
+            if scale is not None:
+                expression = f"{expression} * {scale!r}"
+            entries.append(f"{out_key!r}: {expression}")
+        source = "lambda d: {" + ", ".join(entries) + "}"
+        return eval(compile(source, f"<adapter:{self.name}>", 'eval'), {'__builtins__': {}, **CONVERTERS})
+
+    def apply(self, raw_data):
+        try:
+            normalized = self._map(raw_data)
+        except KeyError as e:
+            raise NormalizationError(f"{self.name}: missing required field {e}") from None
+        except (TypeError, ValueError) as e:
+            raise NormalizationError(f"{self.name}: invalid field value ({e})") from None
+        if not self._valid(normalized):
+            # Slow path only for rejected payloads: find the first failing rule for the message
+            for rule, message in VALIDATION_RULES:
+                if not eval(rule, {'__builtins__': {}}, {'n': normalized}):
+                    raise NormalizationError(f"{self.name}: {message}")
+        return normalized
+
+# --- ADAPTER REGISTRY ---
+ADAPTERS_BY_VERSION = {}
+# (shape_key, adapter) probes for payloads without a known reportVersion, checked in order
+ADAPTERS_BY_SHAPE = []
+
+def register_adapter(adapter):
+    """Registers an adapter for its report versions and, if given, its payload shape."""
+    for version in adapter.report_versions:
+        ADAPTERS_BY_VERSION[version] = adapter
+    if adapter.shape_key:
+        ADAPTERS_BY_SHAPE.append((adapter.shape_key, adapter))
+    return adapter
+
+# CI reports in the camelCase SQ-5 schema (see ci_run_data.json)
+register_adapter(Adapter(
+    'sq5',
+    {
+        'project_id': ('jobId', 'str', None, None),
+        # Older SQ-5 reporters only send the numeric buildNumber
+        'build_id': (('build_id', 'buildNumber'), 'str', None, None),
+        'timestamp': ('startTime', 'float', None, None),
+        'pipeline_duration_s': ('pipelineDurationMs', 'float', None, 0.001),
+        'covered_lines': ('covered_lines', 'int', 0, None),
+        'total_lines': ('total_lines', 'int', 0, None),
+        'coverage_threshold_passed': ('coverageThresholdPassed', 'bool', False, None),
+    },
+    report_versions=('SQ-5.0', 'SQ-5.1'),
+    shape_key='pipelineDurationMs'
+))
+
+# Payloads already in the internal schema (e.g. produced by other pipeline stages)
+register_adapter(Adapter(
+    'internal',
+    {field: (field, converter, default, None) for field, converter, default in (
+        ('project_id', 'str', None),
+        ('build_id', 'str', None),
+        ('timestamp', 'float', None),
+        ('pipeline_duration_s', 'float', None),
+        ('covered_lines', 'int', 0),
+        ('total_lines', 'int', 0),
+        ('coverage_threshold_passed', 'bool', False),
+    )},
+    report_versions=('internal-1',),
+    shape_key='pipeline_duration_s'
+))
+
+def select_adapter(raw_data):
+    """Dispatches on reportVersion (one dict lookup), falling back to the payload shape."""
+    adapter = ADAPTERS_BY_VERSION.get(raw_data.get('reportVersion'))
+    if adapter is not None:
+        return adapter
+    for shape_key, adapter in ADAPTERS_BY_SHAPE:
+        if shape_key in raw_data:
+            return adapter
+    raise NormalizationError(f"No adapter for reportVersion {raw_data.get('reportVersion')!r} or payload shape")
 
 def normalize_data(raw_data):
     """
-    Implements the Adapter Pattern for normalization.
-    Cleans raw code coverage data and maps it to the internal schema.
+    Maps a raw CI payload onto the internal schema with its registered adapter.
+    Raises NormalizationError for unknown or malformed payloads.
     """
-    
-    print(f"  [NORMALIZE] Processing build {raw_data['buildNumber']}...")
-
-    # Adapter Logic: Transform and standardize fields
-    normalized = {
-        "project_id": raw_data['jobId'],
-        "build_id": raw_data['buildNumber'],
-        "timestamp": raw_data['startTime'],
-        
-        "pipeline_duration_s": raw_data['pipelineDurationMs'] / 1000,
-        
-        "covered_lines": raw_data.get('covered_lines', 0),
-        "total_lines": raw_data.get('total_lines', 0),
-        "coverage_threshold_passed": raw_data.get('coverageThresholdPassed', False)
-    }
-    
-    # Store Normalized Data (Simulates writing to Raw Metrics DB)
-    RAW_DB[normalized['build_id']] = normalized
-    print(f"  [NORMALIZE OK] Stored normalized line-count data for build {normalized['build_id']}.")
+    if not isinstance(raw_data, dict):
+        raise NormalizationError("Payload must be a JSON object")
+    normalized = select_adapter(raw_data).apply(raw_data)
+    for field in INGEST_FIELDS:
+        if field in raw_data:
+            normalized[field] = raw_data[field]
     return normalized
 
 # ----------------------------------------------------------------------
-# UPDATED WORKER FUNCTION: It now receives the 'raw_data' (the job) directly, 
+# WORKER FUNCTION: It receives the 'raw_data' (the job) directly,
 # as the queue consuming is handled by worker_processor.py (using Redis).
 # ----------------------------------------------------------------------
-def run_normalization(raw_data): 
+def run_normalization(raw_data):
     """Worker function that processes the received job."""
-    print("\n--- 2. NORMALIZATION SERVICE (WORKER) ---")
-    
     # If raw_data is None, it means the queue was empty.
-    if raw_data is None: 
+    if raw_data is None:
         return None
-    
+
     # Since we already have the data, we just pass it to the processing function.
     return normalize_data(raw_data)
 
 if __name__ == '__main__':
-    print("Run the main execution flow via the worker processor for testing.")
\ No newline at end of file
+    print("Run the main execution flow via the worker processor for testing.")
@@ -0,0 +1,133 @@
+from redis.exceptions import WatchError
+
+import codec
+from history_store import build_order, project_of
+
+# --- CONFIGURATION ---
+# Projects examined per MGET while a filtered page is being filled from the index
+SCAN_CHUNK = 500
+# Upper bound on explicitly requested project ids (?ids=) per request
+MAX_IDS = 1000
+# Filter shorthands accepted by the API: coverage_below=80, duration_above=600
+METRIC_ALIASES = {'coverage': 'line_code_coverage', 'duration': 'pipeline_duration_s'}
+
+KEY_PREFIX = 'latest'
+INDEX_KEY = 'latest_projects'
+
+# --- KEY LAYOUT ---
+# latest:{project}     encoded summary of the project's newest build by build order (see codec)
+# latest_projects      ZSET  project -> 0, walked in lexicographic order for cursor pagination
+
+def _key(project_id):
+    return f"{KEY_PREFIX}:{project_id}"
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def update_latest(r, summaries):
+    """
+    Makes each project's newest summary of a batch (by build order, see
+    history_store.build_order) its latest summary, unless the stored latest is a
+    newer build: a retried or reclaimed older build never replaces it. Compare and
+    set run as one WATCH transaction over the batch's projects (one MGET, then
+    one SET per replaced project and one ZADD for the index).
+    """
+    newest = {}
+    for summary in summaries:
+        project_id = str(project_of(summary))
+        # On a tie the summary processed last wins
+        if project_id not in newest or build_order(summary) >= build_order(newest[project_id]):
+            newest[project_id] = summary
+    if not newest:
+        return
+    keys = [_key(project_id) for project_id in newest]
+    with r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                stored = pipe.mget(keys)
+                pipe.multi()
+                for (project_id, summary), current in zip(newest.items(), stored):
+                    if current is not None and build_order(codec.decode(current)) > build_order(summary):
+                        continue
+                    pipe.set(_key(project_id), codec.encode(summary))
+                pipe.zadd(INDEX_KEY, {project_id: 0 for project_id in newest})
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+# --- FILTERS ---
+
+def parse_filters(args):
+    """
+    Reads metric filters from query arguments: <metric>_below=x keeps projects whose
+    latest value is below x, <metric>_above=x those above x (coverage and duration
+    are shorthands for their metrics). Returns [(metric, op, threshold)].
+    Raises ValueError for a threshold that is not a number.
+    """
+    filters = []
+    for name, value in args.items():
+        for suffix, op in (('_below', '<'), ('_above', '>')):
+            if name.endswith(suffix):
+                metric = name[:-len(suffix)]
+                try:
+                    threshold = float(value)
+                except ValueError:
+                    raise ValueError(f"Filter {name} needs a number, got '{value}'.") from None
+                filters.append((METRIC_ALIASES.get(metric, metric), op, threshold))
+    return filters
+
+def _metric_value(summary, metric):
+    value = summary.get('metrics', {}).get(metric)
+    # Summaries stored before compact storage hold {'value', 'unit', 'description'}
+    return value.get('value') if isinstance(value, dict) else value
+
+def matches(summary, filters):
+    """True if the summary passes every filter; a project without the metric never does."""
+    for metric, op, threshold in filters:
+        value = _metric_value(summary, metric)
+        if not isinstance(value, (int, float)):
+            return False
+        if (op == '<' and not value < threshold) or (op == '>' and not value > threshold):
+            return False
+    return True
+
+# --- QUERIES ---
+
+def _index_chunks(r, cursor):
+    """Project ids from the index after cursor, SCAN_CHUNK at a time (one ZRANGEBYLEX each)."""
+    while True:
+        low = f"({cursor}" if cursor else '-'
+        chunk = [_decode(member) for member in r.zrangebylex(INDEX_KEY, low, '+', start=0, num=SCAN_CHUNK)]
+        if not chunk:
+            return
+        yield chunk
+        cursor = chunk[-1]
+
+def get_page(r, ids=None, cursor=None, limit=100, filters=()):
+    """
+    Returns up to limit latest summaries matching filters, ordered by project id,
+    starting after cursor (a project id). ids restricts the page to those projects
+    and is fetched with a single MGET; without ids all projects are walked through
+    the index. Returns (summaries, missing ids, next cursor or None).
+    """
+    if ids is not None:
+        remaining = sorted({project_id for project_id in ids if not cursor or project_id > cursor})
+        chunks = iter([remaining] if remaining else [])
+    else:
+        chunks = _index_chunks(r, cursor)
+
+    summaries, missing = [], []
+    for chunk in chunks:
+        for project_id, stored in zip(chunk, r.mget([_key(project_id) for project_id in chunk])):
+            if stored is None:
+                missing.append(project_id)
+                continue
+            summary = codec.decode(stored)
+            if matches(summary, filters):
+                summaries.append(summary)
+                if len(summaries) == limit:
+                    more = project_id != chunk[-1] or ids is None
+                    return summaries, missing, project_id if more else None
+    return summaries, missing, None
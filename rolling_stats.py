@@ -0,0 +1,439 @@
+import json
+import math
+import os
+import socket
+import time
+
+from redis.exceptions import WatchError
+
+from history_store import build_time, project_of
+
+# --- CONFIGURATION ---
+# Metrics tracked with streaming statistics
+ROLLING_METRICS = ('pipeline_duration_s', 'line_code_coverage')
+# Smoothing factor of the exponentially weighted moving average (and of its trend)
+EWMA_ALPHA = float(os.getenv('ROLLING_EWMA_ALPHA', 0.1))
+# t-digest compression: higher is more accurate and larger (a few hundred centroids at 50)
+DIGEST_COMPRESSION = 50
+# Quantiles reported by the read endpoint
+REPORTED_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+# Identifies this process's shard; stable across restarts when set by the supervisor
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# A shard whose worker has written nothing for this long is folded into the retired shard
+STATS_SHARD_MAX_AGE_S = int(os.getenv('ROLLING_STATS_SHARD_MAX_AGE_S', 7 * 24 * 3600))
+# Each process checks a project for dead shards at most this often
+STATS_PRUNE_INTERVAL_S = 3600
+# Attempts of a prune whose watched keys keep changing before it waits for the next interval
+STATS_PRUNE_ATTEMPTS = 3
+# Windowed statistics: the same statistics per hour of build start time, kept this long, so reads
+# can be limited to recent builds (?window=7d, ?last=500) instead of covering every build ever seen
+WINDOW_BUCKET_S = 3600
+WINDOW_RETENTION_S = int(os.getenv('ROLLING_WINDOW_RETENTION_S', 8 * 24 * 3600))
+# Units accepted by parse_window
+WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+KEY_PREFIX = 'stats'
+# stats:{project}          HASH  worker id -> shard; RETIRED_SHARD holds the folded shards of dead workers
+# stats:{project}:windows  HASH  "{bucket start}:{worker id}" -> shard of the builds started in that hour
+# stats_heartbeats         HASH  worker id -> time of its last statistics write
+HEARTBEAT_KEY = f"{KEY_PREFIX}_heartbeats"
+RETIRED_SHARD = '_retired'
+
+class TDigest:
+    """
+    Merging t-digest for approximate quantiles in bounded space.
+    Points are buffered and merged into a bounded number of centroids,
+    so adding is amortized O(1) and two digests merge by re-compressing
+    their combined centroids.
+    """
+    __slots__ = ('compression', 'centroids', 'total', '_buffer')
+
+    def __init__(self, compression=DIGEST_COMPRESSION, centroids=None):
+        self.compression = compression
+        self.centroids = [list(c) for c in centroids] if centroids else []
+        self.total = sum(w for _, w in self.centroids)
+        self._buffer = []
+
+    def add(self, value, weight=1):
+        self._buffer.append([value, weight])
+        self.total += weight
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend([list(c) for c in other.centroids])
+        self.total += other.total
+        self._compress()
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        merged = []
+        cumulative = 0.0
+        mean, weight = points[0]
+        for point_mean, point_weight in points[1:]:
+            proposed = weight + point_weight
+            q = (cumulative + proposed / 2.0) / self.total
+            # Centroids near the tails stay small, which keeps extreme quantiles accurate
+            if proposed <= max(1.0, 4.0 * self.total * q * (1.0 - q) / self.compression):
+                mean += (point_mean - mean) * point_weight / proposed
+                weight = proposed
+            else:
+                merged.append([mean, weight])
+                cumulative += weight
+                mean, weight = point_mean, point_weight
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        """Approximate value at quantile q (0..1), interpolating between centroid centers."""
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        cumulative = 0.0
+        previous_center, previous_mean = None, None
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2.0
+            if target <= center:
+                if previous_center is None:
+                    return mean
+                fraction = (target - previous_center) / (center - previous_center)
+                return previous_mean + fraction * (mean - previous_mean)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def to_list(self):
+        self._compress()
+        return [[float(f"{m:.6g}"), w] for m, w in self.centroids]
+
+class RunningStats:
+    """
+    O(1)-per-update statistics of one metric stream: count, mean and variance
+    (Welford), min/max, EWMA with an EWMA-smoothed trend, and a t-digest.
+    Two instances merge exactly for count/mean/variance/min/max and
+    approximately for EWMA, trend and quantiles.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max', 'ewma', 'trend', 'last', 'digest')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.ewma = None
+        self.trend = 0.0
+        self.last = None
+        self.digest = TDigest()
+
+    def copy(self):
+        return RunningStats.from_dict(self.to_dict())
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.ewma is None:
+            self.ewma = float(value)
+        else:
+            previous = self.ewma
+            self.ewma += EWMA_ALPHA * (value - self.ewma)
+            self.trend += EWMA_ALPHA * ((self.ewma - previous) - self.trend)
+        self.last = value
+        self.digest.add(value)
+
+    def merge(self, other):
+        """Combines another shard's statistics into this one (Chan et al. for the variance)."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            for name in ('count', 'mean', 'm2', 'min', 'max', 'ewma', 'trend', 'last'):
+                setattr(self, name, getattr(other, name))
+            self.digest.merge(other.digest)
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.mean += delta * other.count / total
+        weight = other.count / total
+        self.ewma += (other.ewma - self.ewma) * weight
+        self.trend += (other.trend - self.trend) * weight
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count = total
+        self.digest.merge(other.digest)
+        return self
+
+    def to_dict(self):
+        return {'n': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max,
+                'ewma': self.ewma, 'trend': self.trend, 'last': self.last, 'digest': self.digest.to_list()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count = data['n']
+        stats.mean = data['mean']
+        stats.m2 = data['m2']
+        stats.min = data['min']
+        stats.max = data['max']
+        stats.ewma = data['ewma']
+        stats.trend = data['trend']
+        stats.last = data['last']
+        stats.digest = TDigest(centroids=data['digest'])
+        return stats
+
+    def report(self):
+        """Read-side view: summary statistics and quantiles."""
+        variance = self.m2 / (self.count - 1) if self.count > 1 else 0.0
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'stddev': math.sqrt(variance),
+            'min': self.min,
+            'max': self.max,
+            'ewma': self.ewma,
+            'trend': self.trend,
+            'last': self.last,
+            'quantiles': {f"p{int(q * 100)}": self.digest.quantile(q) for q in REPORTED_QUANTILES}
+        }
+
+# --- WORKER SIDE ---
+# This process's shards: (project_id, bucket start or None for all builds) -> {metric_key: RunningStats}
+_shards = {}
+# Shards updated by the last queue_stats(); commit_stats() applies them once the write succeeded
+_staged = {}
+# time.time() of this process's last committed write, and of the last prune per project
+_last_write = 0.0
+_last_prune = {}
+
+def _key(project_id):
+    return f"{KEY_PREFIX}:{project_id}"
+
+def _windows_key(project_id):
+    return f"{KEY_PREFIX}:{project_id}:windows"
+
+def _location(slot):
+    """(hash key, field) a shard is stored under."""
+    project_id, bucket = slot
+    if bucket is None:
+        return _key(project_id), WORKER_ID
+    return _windows_key(project_id), f"{bucket}:{WORKER_ID}"
+
+def _bucket_expired(bucket, now):
+    return bucket + WINDOW_BUCKET_S <= now - WINDOW_RETENTION_S
+
+def _slots(summary, now):
+    """Shards a summary is counted in: its project's cumulative shard and, if still retained, its hour."""
+    project_id = project_of(summary)
+    yield project_id, None
+    bucket = int(build_time(summary) // WINDOW_BUCKET_S * WINDOW_BUCKET_S)
+    if not _bucket_expired(bucket, now):
+        yield project_id, bucket
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _load_shard(stored):
+    if not stored:
+        return {}
+    return {metric: RunningStats.from_dict(data) for metric, data in json.loads(stored).items()}
+
+def _dump_shard(shard):
+    return json.dumps({metric: stats.to_dict() for metric, stats in shard.items()}, separators=(',', ':'))
+
+def ensure_loaded(r, summaries):
+    """
+    Loads this worker's persisted shards (cumulative and hourly) touched by a batch
+    for the first time, so statistics continue across restarts. One pipelined round trip.
+    A process idle for longer than STATS_SHARD_MAX_AGE_S may have had its shards
+    retired (see prune_shards), so it reloads them all.
+    """
+    now = time.time()
+    if _last_write and now - _last_write > STATS_SHARD_MAX_AGE_S:
+        _shards.clear()
+    for slot in [slot for slot in _shards if slot[1] is not None and _bucket_expired(slot[1], now)]:
+        del _shards[slot]
+    missing = list({slot for summary in summaries for slot in _slots(summary, now)} - _shards.keys())
+    if not missing:
+        return
+    pipe = r.pipeline(transaction=False)
+    # Marks this worker alive before its shards are in memory, so they are not retired under it
+    pipe.hset(HEARTBEAT_KEY, WORKER_ID, now)
+    for slot in missing:
+        pipe.hget(*_location(slot))
+    for slot, stored in zip(missing, pipe.execute()[1:]):
+        _shards[slot] = _load_shard(stored)
+
+def queue_stats(pipe, summaries):
+    """
+    Updates copies of this worker's statistics with a batch of summaries (O(1) per
+    build and metric, once for all builds and once for the build's hour) and adds the
+    write-back of every touched shard to the pipeline. The copies replace the
+    in-memory shards only in commit_stats(), so a failed write cannot count a
+    redelivered batch twice.
+    """
+    _staged.clear()
+    now = time.time()
+    for summary in summaries:
+        metrics = summary.get('metrics', {})
+        values = []
+        for metric_key in ROLLING_METRICS:
+            metric = metrics.get(metric_key)
+            value = metric.get('value') if isinstance(metric, dict) else metric
+            if isinstance(value, (int, float)):
+                values.append((metric_key, value))
+        if not values:
+            continue
+        for slot in _slots(summary, now):
+            shard = _staged.get(slot)
+            if shard is None:
+                if slot[1] is not None and slot not in _shards:
+                    # Hour not loaded by ensure_loaded (it expired in between): nothing to continue from
+                    continue
+                shard = _staged[slot] = {metric: stats.copy() for metric, stats in _shards.get(slot, {}).items()}
+            for metric_key, value in values:
+                shard.setdefault(metric_key, RunningStats()).update(value)
+    for slot, shard in _staged.items():
+        pipe.hset(*_location(slot), _dump_shard(shard))
+    if _staged:
+        pipe.hset(HEARTBEAT_KEY, WORKER_ID, now)
+    return pipe
+
+def commit_stats():
+    """Applies the shards staged by the last queue_stats(); call once its pipeline has executed."""
+    global _last_write
+    if _staged:
+        _shards.update(_staged)
+        _staged.clear()
+        _last_write = time.time()
+
+def prune_shards(r, project_id, now=None):
+    """
+    Folds the shards of dead workers (no statistics write for STATS_SHARD_MAX_AGE_S,
+    or none recorded) into the project's retired shard, so reads merge a bounded
+    number of shards while no build drops out of the statistics. Runs as a WATCH
+    transaction over the project and the heartbeats; returns the number of shards folded.
+    Hourly shards past WINDOW_RETENTION_S are deleted.
+    """
+    now = time.time() if now is None else now
+    windows_key = _windows_key(project_id)
+    expired = [field for field in r.hkeys(windows_key)
+               if _bucket_expired(int(_decode(field).split(':', 1)[0]), now)]
+    if expired:
+        r.hdel(windows_key, *expired)
+    key = _key(project_id)
+    with r.pipeline(transaction=True) as pipe:
+        for _ in range(STATS_PRUNE_ATTEMPTS):
+            try:
+                pipe.watch(key, HEARTBEAT_KEY)
+                heartbeats = {_decode(worker): float(seen) for worker, seen in pipe.hgetall(HEARTBEAT_KEY).items()}
+                shards = {_decode(worker): stored for worker, stored in pipe.hgetall(key).items()}
+                dead = [worker for worker in shards if worker not in (RETIRED_SHARD, WORKER_ID)
+                        and now - heartbeats.get(worker, 0) > STATS_SHARD_MAX_AGE_S]
+                if not dead:
+                    return 0
+                retired = {}
+                for worker in [RETIRED_SHARD] + dead:
+                    _merge_into(retired, shards.get(worker))
+                pipe.multi()
+                pipe.hset(key, RETIRED_SHARD, _dump_shard(retired))
+                pipe.hdel(key, *dead)
+                stale = [worker for worker in dead if worker in heartbeats]
+                if stale:
+                    pipe.hdel(HEARTBEAT_KEY, *stale)
+                pipe.execute()
+                return len(dead)
+            except WatchError:
+                continue
+    return 0
+
+def maybe_prune(r, summaries, now=None):
+    """
+    Prunes dead and expired shards of the projects touched by a batch, at most once
+    per STATS_PRUNE_INTERVAL_S per project and process.
+    """
+    now = time.time() if now is None else now
+    for project_id in {project_of(summary) for summary in summaries}:
+        if now - _last_prune.get(project_id, 0) < STATS_PRUNE_INTERVAL_S:
+            continue
+        _last_prune[project_id] = now
+        try:
+            folded = prune_shards(r, project_id, now)
+            if folded:
+                print(f"[STATS] Retired {folded} dead worker shard(s) of project {project_id}.")
+        except Exception as e:
+            print(f"[STATS] Pruning failed for project {project_id}: {e}")
+
+# --- READ SIDE ---
+
+def _merge_into(merged, stored):
+    """Merges a stored shard into merged ({metric: RunningStats}) and returns merged."""
+    for metric, stats in _load_shard(stored).items():
+        if metric in merged:
+            merged[metric].merge(stats)
+        else:
+            merged[metric] = stats
+    return merged
+
+def parse_window(value):
+    """
+    Reads a window length such as '7d', '24h', '90m' or '3600' (seconds).
+    Raises ValueError for other input or a window longer than WINDOW_RETENTION_S.
+    """
+    text = str(value).strip().lower()
+    unit = WINDOW_UNITS.get(text[-1:]) if text[-1:].isalpha() else 1
+    number = text[:-1] if text[-1:].isalpha() else text
+    try:
+        seconds = float(number) * unit
+    except (TypeError, ValueError):
+        seconds = None
+    if not seconds or not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"Invalid window '{value}'. Use seconds or a number with s, m, h or d.")
+    if seconds > WINDOW_RETENTION_S:
+        raise ValueError(f"Window '{value}' exceeds the {WINDOW_RETENTION_S // 3600} hours of windowed statistics kept.")
+    return seconds
+
+def get_stats(r, project_id, window_s=None, last_builds=None, now=None):
+    """
+    Merges the worker shards of a project and returns the per-metric report.
+    Without arguments the statistics are cumulative over every build seen.
+    window_s limits them to builds started in the hourly buckets overlapping the
+    last window_s seconds; last_builds to the newest hourly buckets holding at least
+    that many builds (so 'count' may exceed it by up to one hour's builds). Both
+    reach back at most WINDOW_RETENTION_S.
+    Cost is bounded by the number of shards (and retained hours) and the digest
+    size, not by build count.
+    """
+    if window_s is None and last_builds is None:
+        merged = {}
+        for stored in r.hvals(_key(project_id)):
+            _merge_into(merged, stored)
+        return {metric: stats.report() for metric, stats in merged.items()}
+
+    now = time.time() if now is None else now
+    buckets = {}
+    for field, stored in r.hgetall(_windows_key(project_id)).items():
+        bucket = int(_decode(field).split(':', 1)[0])
+        if _bucket_expired(bucket, now) or (window_s is not None and bucket + WINDOW_BUCKET_S <= now - window_s):
+            continue
+        _merge_into(buckets.setdefault(bucket, {}), stored)
+    merged = {}
+    # Newest hour first, so 'last' is the newest build and last_builds stops at the right hour
+    for bucket in sorted(buckets, reverse=True):
+        for metric, stats in buckets[bucket].items():
+            current = merged.get(metric)
+            if current is None:
+                merged[metric] = stats
+            elif last_builds is None or current.count < last_builds:
+                current.merge(stats)
+    return {metric: stats.report() for metric, stats in merged.items()}
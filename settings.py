@@ -0,0 +1,99 @@
+import inspect
+import os
+import threading
+
+# Shared settings of all pipeline services, read once from the environment.
+# Importing this module is cheap: no framework is loaded and no connection is
+# opened until a service asks for a Redis client.
+
+# --- REDIS ---
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_DB = int(os.getenv('REDIS_DB', 0))
+# Connection pool sizing (one pool per process and client kind, shared by all threads)
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+# Idle connections are re-validated after this many seconds instead of pinging per request
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# Socket timeout of request/response clients; blocking clients (pub/sub) have none
+REDIS_SOCKET_TIMEOUT_S = 5
+
+# --- QUEUE ---
+REDIS_QUEUE = 'ci_data_queue'
+# Queue backend: 'list' (LPUSH/BRPOP, worker_processor), 'stream' (Redis Streams consumer groups,
+# stream_worker) or 'fair' (per-project sub-queues served round-robin by worker_processor, see fair_queue)
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'list')
+# Payloads waiting across all sub-queues of the fair backend
+FAIR_PENDING_KEY = f"{REDIS_QUEUE}:pending"
+REDIS_STREAM = 'ci_data_stream'
+REDIS_STREAM_GROUP = 'aggregators'
+# Field holding the encoded payload inside each stream entry
+REDIS_STREAM_FIELD = 'data'
+
+# --- SUMMARY KEYS ---
+# Latest build summary, written by the workers and served by the dashboard API
+SUMMARY_KEY = 'build_summary'
+# Content hash of the latest summary, written next to SUMMARY_KEY
+SUMMARY_VERSION_KEY = f"{SUMMARY_KEY}:version"
+# Pub/sub channel notified with every new summary
+SUMMARY_CHANNEL = f"{SUMMARY_KEY}:updates"
+
+# --- PORTS ---
+INGESTION_PORT = int(os.getenv('INGESTION_PORT', 5000))
+DASHBOARD_API_PORT = int(os.getenv('DASHBOARD_API_PORT', 5002))
+# Port of the worker /metrics and /healthz sidecar (0 disables it)
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 9102))
+
+# (decode_responses, blocking) -> client; pools are created on first use
+_clients = {}
+_clients_lock = threading.Lock()
+
+def redis_client(decode_responses=False, blocking=False):
+    """
+    Returns the process-wide Redis client of the given kind, backed by a pooled
+    connection. Nothing connects until the first command; connections are checked
+    lazily by the pool (health_check_interval) and re-established when a command fails.
+    blocking=True gives a client without socket timeout, for pub/sub listeners.
+    """
+    key = (decode_responses, blocking)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import redis
+                from redis.backoff import ExponentialBackoff
+                from redis.retry import Retry
+                pool = redis.ConnectionPool(
+                    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    socket_timeout=None if blocking else REDIS_SOCKET_TIMEOUT_S,
+                    socket_connect_timeout=REDIS_SOCKET_TIMEOUT_S,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                    decode_responses=decode_responses,
+                    # Retry once on a dropped socket before surfacing the error to the caller
+                    retry=Retry(ExponentialBackoff(cap=0.5, base=0.05), 1),
+                    retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError]
+                )
+                client = _clients[key] = redis.Redis(connection_pool=pool)
+    return client
+
+def reset_redis_clients():
+    """Drops all pooled connections after a Redis error so the next command reconnects."""
+    for client in list(_clients.values()):
+        client.connection_pool.disconnect()
+
+def queue_length(conn):
+    """Queue length command for the configured backend (works with sync and asyncio clients)."""
+    if QUEUE_BACKEND == 'stream':
+        # Processed entries are deleted by the stream workers, so XLEN counts outstanding work
+        return conn.xlen(REDIS_STREAM)
+    if QUEUE_BACKEND == 'fair':
+        # A plain read: the counter does not exist until the first payload is queued
+        pending = conn.get(FAIR_PENDING_KEY)
+        if inspect.isawaitable(pending):
+            return _await_count(pending)
+        return int(pending or 0)
+    return conn.llen(REDIS_QUEUE)
+
+async def _await_count(pending):
+    return int(await pending or 0)
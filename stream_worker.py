@@ -0,0 +1,205 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+import redis
+
+import history_store
+import project_summaries
+import rolling_stats
+import settings
+import summary_schema
+from settings import REDIS_STREAM, REDIS_STREAM_GROUP, REDIS_STREAM_FIELD
+from aggregation_service import start_config_watcher
+import instrumentation
+from worker_processor import (
+    WORKER_BATCH_SIZE, WORKER_METRICS_PORT, health_check, process_batch, queue_summaries, record_persisted
+)
+
+# --- CONFIGURATION ---
+# Block time of XREADGROUP while waiting for new entries
+STREAM_BLOCK_MS = 1000
+# Entries pending longer than this on a consumer are considered abandoned and reclaimed
+STREAM_RECLAIM_IDLE_MS = int(os.getenv('STREAM_RECLAIM_IDLE_MS', 60000))
+# How often each consumer scans the pending entries list for abandoned entries
+STREAM_RECLAIM_INTERVAL_S = 15
+# Delay before the supervisor restarts a crashed worker process
+SUPERVISOR_RESTART_DELAY_S = 2
+
+def consumer_name():
+    """Unique, human-readable consumer name for this process within the group."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def ensure_group(r):
+    """Creates the stream and consumer group if they do not exist yet."""
+    try:
+        r.xgroup_create(REDIS_STREAM, REDIS_STREAM_GROUP, id='0', mkstream=True)
+        print(f"[STREAM WORKER] Created consumer group '{REDIS_STREAM_GROUP}' on stream '{REDIS_STREAM}'.")
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def process_entries(r, entries):
+    """
+    Aggregates a batch of stream entries and persists the results.
+    The summaries, XACK and XDEL go out in one MULTI/EXEC pipeline, so an entry
+    is acknowledged if and only if its result was written. Malformed entries are
+    acknowledged too, otherwise they would be redelivered forever.
+    """
+    if not entries:
+        return 0
+    entry_ids = [entry_id for entry_id, _ in entries]
+    raw_messages = [fields.get(REDIS_STREAM_FIELD.encode(), b'') for _, fields in entries]
+
+    summaries, superseded = process_batch(raw_messages, r)
+    started = time.perf_counter()
+    rolling_stats.ensure_loaded(r, summaries)
+
+    pipe = r.pipeline(transaction=True)
+    queue_summaries(pipe, summaries, superseded)
+    pipe.xack(REDIS_STREAM, REDIS_STREAM_GROUP, *entry_ids)
+    # Processed entries are removed so the stream only holds outstanding work
+    pipe.xdel(REDIS_STREAM, *entry_ids)
+    pipe.execute()
+    rolling_stats.commit_stats()
+    summary_schema.commit_metadata()
+    project_summaries.update_latest(r, summaries)
+    record_persisted(summaries, started)
+    history_store.maybe_compact(r, summaries)
+    rolling_stats.maybe_prune(r, summaries)
+    return len(summaries) + len(superseded)
+
+def reclaim_abandoned(r, consumer):
+    """
+    Takes over entries left pending by consumers that died before acknowledging them
+    and processes them. Returns the number of reclaimed entries.
+    """
+    reclaimed = 0
+    start_id = '0-0'
+    while True:
+        response = r.xautoclaim(REDIS_STREAM, REDIS_STREAM_GROUP, consumer,
+                                min_idle_time=STREAM_RECLAIM_IDLE_MS, start_id=start_id,
+                                count=WORKER_BATCH_SIZE)
+        start_id, entries = response[0], response[1]
+        # Entries deleted from the stream while pending come back as None
+        entries = [entry for entry in entries if entry and entry[1] is not None]
+        if entries:
+            process_entries(r, entries)
+            reclaimed += len(entries)
+        if start_id in (b'0-0', '0-0'):
+            return reclaimed
+
+def run_consumer(metrics_port=None):
+    """
+    Consumer loop of one worker process: reads new entries for this consumer
+    with XREADGROUP, periodically reclaims abandoned entries, and acknowledges
+    each batch after persistence.
+    """
+    r = settings.redis_client()
+    consumer = consumer_name()
+    next_reclaim = 0.0
+    start_config_watcher()
+    if metrics_port:
+        instrumentation.gauge('worker_queue_depth', "Entries waiting in the Redis stream.",
+                              lambda: r.xlen(REDIS_STREAM))
+        instrumentation.start_metrics_server(metrics_port, health_check)
+    instrumentation.maybe_start_profiler(f"stream-worker-{consumer}")
+    print(f"[STREAM WORKER] Consumer {consumer} reading stream '{REDIS_STREAM}' (group '{REDIS_STREAM_GROUP}').")
+
+    while True:
+        try:
+            if time.monotonic() >= next_reclaim:
+                ensure_group(r)
+                reclaimed = reclaim_abandoned(r, consumer)
+                if reclaimed:
+                    print(f"[STREAM WORKER] {consumer} reclaimed {reclaimed} abandoned entries.")
+                next_reclaim = time.monotonic() + STREAM_RECLAIM_INTERVAL_S
+
+            response = r.xreadgroup(REDIS_STREAM_GROUP, consumer, {REDIS_STREAM: '>'},
+                                    count=WORKER_BATCH_SIZE, block=STREAM_BLOCK_MS)
+            if not response:
+                continue
+            entries = response[0][1]
+            processed = process_entries(r, entries)
+            print(f"[STREAM WORKER] {consumer} processed {processed}/{len(entries)} entries.")
+
+        except redis.exceptions.ConnectionError:
+            print("[STREAM WORKER] Redis Connection Error. Retrying in 5 seconds.")
+            time.sleep(5)
+        except redis.exceptions.ResponseError as e:
+            if 'NOGROUP' in str(e):
+                # Stream or group was deleted under us; recreate on the next iteration
+                next_reclaim = 0.0
+                continue
+            print(f"[STREAM WORKER] Redis Error: {e}")
+            time.sleep(1)
+        except Exception as e:
+            print(f"[STREAM WORKER] Worker Unhandled Error: {e}")
+            time.sleep(1)
+
+def worker_main(slot):
+    """Entry point of a supervised worker process."""
+    # Forked children inherit the supervisor's id; give each slot its own stable statistics shard
+    # (under the orchestrator, within the instance's WORKER_ID)
+    rolling_stats.WORKER_ID = f"{os.getenv('WORKER_ID') or socket.gethostname()}-stream-{slot}"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        # Each slot serves its own sidecar, on the ports following WORKER_METRICS_PORT
+        run_consumer(WORKER_METRICS_PORT + 1 + slot if WORKER_METRICS_PORT else None)
+    except Exception as e:
+        print(f"[STREAM WORKER] FATAL WORKER ERROR: {e}")
+        traceback.print_exc()
+        os._exit(1)
+
+def supervise(process_count):
+    """
+    Runs process_count consumer processes and restarts any that exit.
+    Entries held by a crashed process are picked up by the reclaim pass of the others.
+    """
+    print("=====================================================================")
+    print("  STARTING STREAM WORKER SUPERVISOR (Redis Streams Consumer Group)   ")
+    print("=====================================================================")
+    print(f"Running {process_count} worker process(es). (Press Ctrl+C to stop)")
+
+    processes = {}
+    stopping = False
+
+    def stop(sig, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        for slot in range(process_count):
+            process = processes.get(slot)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                print(f"[SUPERVISOR] Worker {slot} (PID {process.pid}) exited with code {process.exitcode}. Restarting.")
+                time.sleep(SUPERVISOR_RESTART_DELAY_S)
+            process = multiprocessing.Process(target=worker_main, args=(slot,), name=f"stream-worker-{slot}", daemon=True)
+            process.start()
+            processes[slot] = process
+            print(f"[SUPERVISOR] Started worker {slot} (PID {process.pid}).")
+        time.sleep(0.5)
+
+    print("\n[SUPERVISOR] Shutting down worker processes...")
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    for process in processes.values():
+        process.join(timeout=5)
+    print("[SUPERVISOR] All worker processes stopped.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Redis Streams worker pool for the aggregation stage.")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (default: one per CPU core).")
+    args = parser.parse_args()
+    supervise(max(1, args.processes))
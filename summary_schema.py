@@ -0,0 +1,78 @@
+import codec
+
+# --- STORED SUMMARY LAYOUT ---
+# Stored and published summaries carry bare metric values: {'metrics': {key: value}, 'config_version': v}.
+# The unit and description of each metric are the same for every build of a config
+# version, so they are stored once per version instead of once per build:
+# summary_meta:{config_version}    JSON  {metric_key: {'unit', 'description'}}
+META_PREFIX = 'summary_meta'
+
+# Versions whose metadata this process has already written
+_written_versions = set()
+# Version queued by the last queue_metadata(); commit_metadata() marks it written once the write succeeded
+_staged_version = None
+# Per-process cache of metadata read back by the API; a version's metadata never changes
+_metadata_cache = {}
+
+def _key(version):
+    return f"{META_PREFIX}:{version}"
+
+def metadata_of(snapshot):
+    """Unit and description of every metric of a compiled config snapshot."""
+    return {
+        metric_key: {'unit': metric.unit, 'description': metric.description}
+        for metric_key, metric in snapshot.metrics.items()
+    }
+
+def queue_metadata(pipe, summaries, snapshot):
+    """
+    Adds the metadata of the snapshot's config version to a pipeline, once per
+    version and process, if any of the summaries were aggregated under it.
+    The version counts as written only after commit_metadata().
+    """
+    global _staged_version
+    _staged_version = None
+    if snapshot is None or snapshot.version in _written_versions:
+        return pipe
+    if any(summary.get('config_version') == snapshot.version for summary in summaries):
+        pipe.set(_key(snapshot.version), codec.to_json(metadata_of(snapshot)))
+        _staged_version = snapshot.version
+    return pipe
+
+def commit_metadata():
+    """Marks the version queued by the last queue_metadata() as written; call once its pipeline has executed."""
+    global _staged_version
+    if _staged_version is not None:
+        _written_versions.add(_staged_version)
+        _staged_version = None
+
+def _load_metadata(r, versions):
+    missing = [version for version in versions if version not in _metadata_cache]
+    if missing:
+        for version, stored in zip(missing, r.mget([_key(version) for version in missing])):
+            if stored is not None:
+                _metadata_cache[version] = codec.decode(stored)
+    return {version: _metadata_cache.get(version, {}) for version in versions}
+
+def hydrate(r, summaries):
+    """
+    Returns copies of stored summaries in the API shape, with every metric as
+    {'value', 'unit', 'description'}. Metadata is read once per config version
+    (one MGET for the versions not seen before). Summaries already in that shape
+    (written before compact storage) are returned unchanged.
+    """
+    versions = {summary.get('config_version') for summary in summaries
+                if any(not isinstance(value, dict) for value in summary.get('metrics', {}).values())}
+    metadata = _load_metadata(r, [version for version in versions if version is not None]) if versions else {}
+    hydrated = []
+    for summary in summaries:
+        meta = metadata.get(summary.get('config_version'), {})
+        metrics = {}
+        for metric_key, value in summary.get('metrics', {}).items():
+            if isinstance(value, dict):
+                metrics[metric_key] = value
+            else:
+                info = meta.get(metric_key, {})
+                metrics[metric_key] = {'value': value, 'unit': info.get('unit'), 'description': info.get('description')}
+        hydrated.append(dict(summary, metrics=metrics))
+    return hydrated
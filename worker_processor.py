@@ -1,78 +1,317 @@
+import hashlib
+import os
 import redis
+import signal
 import time
-import json
 import traceback # Import traceback for detailed error logging
 # Import the aggregation function
-from aggregation_service import aggregate_metrics 
-# Import Redis connection details from the ingestion service config
-from ingestion_service import REDIS_HOST, REDIS_PORT, REDIS_QUEUE
-
-# Import the output key used by the Dashboard API
-try:
-    from dashboard_api import REDIS_KEY as SUMMARY_REDIS_KEY
-except ImportError:
-    # Fallback if dashboard_api.py is not available in the path, use the hardcoded value
-    SUMMARY_REDIS_KEY = 'build_summary' 
-    print(f"[WORKER] Warning: Could not import REDIS_KEY from dashboard_api. Using default: {SUMMARY_REDIS_KEY}")
-
-# Connect to Redis
-try:
-    # We use db=0 for both the queue (input) and the summary (output)
-    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-    r.ping() 
-    print("[WORKER] Redis connection established successfully.")
-except Exception as e:
-    print(f"[WORKER] Redis connection failed: {e}")
-    # We allow the script to proceed here, as the loop handles reconnection attempts.
+from aggregation_service import aggregate_metrics_batch, current_snapshot, start_config_watcher
+import codec
+import dedupe
+import fair_queue
+import history_store
+import instrumentation
+import project_summaries
+import rolling_stats
+import settings
+import summary_schema
+from normalization_worker import NormalizationError, normalize_data
+# Queue and summary keys shared with the ingestion service and the dashboard API, read from
+# the settings module so the worker never loads their Flask apps or opens their clients.
+# SUMMARY_VERSION_KEY holds the content hash of the latest summary (cheap revalidation) and
+# SUMMARY_CHANNEL is notified after every write (fanned out by the dashboard API).
+from settings import REDIS_QUEUE, SUMMARY_CHANNEL, SUMMARY_VERSION_KEY, WORKER_METRICS_PORT
+from settings import SUMMARY_KEY as SUMMARY_REDIS_KEY
+
+# --- BATCH MODE CONFIGURATION ---
+# Maximum number of messages drained and aggregated per loop iteration (1 disables batching)
+WORKER_BATCH_SIZE = max(1, int(os.getenv('WORKER_BATCH_SIZE', 100)))
+# How long to wait for a partially filled batch to fill up after the first message arrives
+WORKER_BATCH_LINGER_S = float(os.getenv('WORKER_BATCH_LINGER_MS', 20)) / 1000.0
+# Latest-wins coalescing: of several builds of one project in a batch only the newest (by build
+# number, then start time) takes the latest-summary path (rolling statistics, latest summaries).
+# 'off' processes every build fully, 'history' appends superseded builds to the history only,
+# 'skip' drops them, so catching up on a backlog costs per project rather than per build.
+WORKER_COALESCE = os.getenv('WORKER_COALESCE', 'off')
+
+# --- INSTRUMENTATION ---
+STAGE_HELP = "Time spent per stage: queue_wait per message, the other stages per batch."
+QUEUE_WAIT = instrumentation.histogram('worker_stage_seconds', STAGE_HELP, stage='queue_wait')
+NORMALIZATION_TIME = instrumentation.histogram('worker_stage_seconds', STAGE_HELP, stage='normalization')
+AGGREGATION_TIME = instrumentation.histogram('worker_stage_seconds', STAGE_HELP, stage='aggregation')
+PERSISTENCE_TIME = instrumentation.histogram('worker_stage_seconds', STAGE_HELP, stage='persistence')
+END_TO_END_TIME = instrumentation.histogram('worker_end_to_end_seconds', "From ingest_ts to the summary being persisted.")
+MESSAGES_TOTAL = instrumentation.counter('worker_messages_total', "Queue messages pulled by the worker.")
+BUILDS_TOTAL = instrumentation.counter('worker_builds_total', "Build summaries persisted.")
+BATCHES_TOTAL = instrumentation.counter('worker_batches_total', "Batches processed.")
+DECODE_ERRORS = instrumentation.counter('worker_rejected_total', "Messages skipped, by reason.", reason='decode')
+NORMALIZATION_ERRORS = instrumentation.counter('worker_rejected_total', "Messages skipped, by reason.", reason='normalization')
+DUPLICATES = instrumentation.counter('worker_rejected_total', "Messages skipped, by reason.", reason='duplicate')
+COALESCE_HELP = "Superseded builds taken off the latest-summary path, by where they went."
+COALESCED_TO_HISTORY = instrumentation.counter('worker_coalesced_total', COALESCE_HELP, outcome='history')
+COALESCED_SKIPPED = instrumentation.counter('worker_coalesced_total', COALESCE_HELP, outcome='skipped')
+
+# Set by SIGTERM; the worker loop exits once the batch in progress is persisted
+_stop_requested = False
+
+# Shared pooled client for the queue (input) and the summary (output); connects on first use
+r = settings.redis_client()
+
+def drain_batch(first_message):
+    """
+    Collects up to WORKER_BATCH_SIZE raw messages, starting with the one returned by brpop.
+    Whatever is already queued is taken with a single RPOP <count> call; if the batch is
+    still short, waits at most WORKER_BATCH_LINGER_S for more to arrive.
+    """
+    batch = [first_message]
+    deadline = time.monotonic() + WORKER_BATCH_LINGER_S
+
+    while len(batch) < WORKER_BATCH_SIZE:
+        more = r.rpop(REDIS_QUEUE, WORKER_BATCH_SIZE - len(batch))
+        if more:
+            batch.extend(more)
+            continue
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Queue is empty: block for the rest of the linger window instead of spinning
+        message = r.brpop(REDIS_QUEUE, timeout=remaining)
+        if not message:
+            break
+        batch.append(message[1])
+
+    return batch
+
+def next_batch():
+    """
+    Waits up to 1 second for the first message and returns the batch drained
+    after it ([] on timeout). With the fair backend the batch is assembled from
+    per-project sub-queues in round-robin order (see fair_queue); its projects stay
+    claimed until finish_batch().
+    """
+    if settings.QUEUE_BACKEND == 'fair':
+        return fair_queue.pop_batch(r, WORKER_BATCH_SIZE, 1, WORKER_BATCH_LINGER_S)
+    # Blocking pop (brpop) waits up to 1 second for the first message of a batch.
+    message = r.brpop(REDIS_QUEUE, timeout=1)
+    return drain_batch(message[1]) if message else []
+
+def finish_batch():
+    """Releases the projects claimed for the batch just processed (fair backend only)."""
+    if settings.QUEUE_BACKEND == 'fair':
+        fair_queue.release(r)
+
+def coalesce(rows):
+    """
+    Splits normalized rows into (newest build of each project, superseded builds),
+    both in queue order. On a tie the build queued last wins.
+    """
+    newest = {}
+    for index, row in enumerate(rows):
+        project_id = history_store.project_of(row)
+        best = newest.get(project_id)
+        if best is None or history_store.build_order(row) >= history_store.build_order(rows[best]):
+            newest[project_id] = index
+    kept = set(newest.values())
+    return ([row for index, row in enumerate(rows) if index in kept],
+            [row for index, row in enumerate(rows) if index not in kept])
+
+def process_batch(raw_messages, redis_conn=None):
+    """
+    Decodes, normalizes and aggregates a batch of raw queue messages.
+    Messages that cannot be decoded or fail normalization are skipped individually,
+    as are builds already aggregated with the same content (checked against
+    redis_conn, the worker's connection by default).
+    Returns (summaries, superseded): the final summaries in queue order and, in
+    WORKER_COALESCE=history mode, the summaries of builds superseded within the batch.
+    """
+    MESSAGES_TOTAL.inc(len(raw_messages))
+    BATCHES_TOTAL.inc()
+    dequeued_at = time.time()
+    started = time.perf_counter()
+    rows = []
+    for raw_message in raw_messages:
+        try:
+            raw_data = codec.decode(raw_message)
+        except codec.CodecError as e:
+            DECODE_ERRORS.inc()
+            print(f"[WORKER] Decode Error: {e}. Skipping message.")
+            continue
+
+        # --- 2. NORMALIZATION STAGE ---
+        # Malformed or unknown payloads are rejected here, before they cost aggregation time
+        try:
+            rows.append(normalize_data(raw_data))
+        except NormalizationError as e:
+            NORMALIZATION_ERRORS.inc()
+            print(f"[WORKER] Normalization rejected build {raw_data.get('build_id') if isinstance(raw_data, dict) else None}: {e}")
+
+    if dedupe.DEDUPE_ENABLED and rows:
+        try:
+            unique_rows = dedupe.drop_processed(redis_conn or r, rows)
+        except redis.exceptions.RedisError as e:
+            print(f"[WORKER] Duplicate check skipped: {e}")
+            unique_rows = rows
+        if len(unique_rows) < len(rows):
+            DUPLICATES.inc(len(rows) - len(unique_rows))
+            print(f"[WORKER] Skipped {len(rows) - len(unique_rows)} duplicate build(s).")
+        rows = unique_rows
+
+    for row in rows:
+        ingest_ts = row.get('ingest_ts')
+        if isinstance(ingest_ts, (int, float)):
+            QUEUE_WAIT.observe(max(0.0, dequeued_at - ingest_ts))
+    superseded = []
+    if WORKER_COALESCE in ('history', 'skip') and len(rows) > 1:
+        rows, superseded = coalesce(rows)
+        if superseded:
+            print(f"[WORKER] Coalesced {len(superseded)} superseded build(s) ({WORKER_COALESCE}).")
+            if WORKER_COALESCE == 'history':
+                COALESCED_TO_HISTORY.inc(len(superseded))
+            else:
+                COALESCED_SKIPPED.inc(len(superseded))
+                superseded = []
+    normalized = time.perf_counter()
+    NORMALIZATION_TIME.observe(normalized - started)
+
+    # --- 3. AGGREGATION STAGE ---
+    # Each compiled formula is evaluated once over the whole batch (superseded builds included)
+    summaries = aggregate_metrics_batch(rows + superseded)
+    AGGREGATION_TIME.observe(time.perf_counter() - normalized)
+    return summaries[:len(rows)], summaries[len(rows):]
+
+def record_persisted(summaries, started):
+    """Records persistence time of a batch (since the perf_counter value started) and end-to-end latency per build."""
+    PERSISTENCE_TIME.observe(time.perf_counter() - started)
+    BUILDS_TOTAL.inc(len(summaries))
+    now = time.time()
+    for summary in summaries:
+        ingest_ts = summary.get('ingest_ts')
+        if isinstance(ingest_ts, (int, float)):
+            END_TO_END_TIME.observe(max(0.0, now - ingest_ts))
+
+def summary_version(encoded_summary):
+    """Short content hash of an encoded summary, used as its ETag."""
+    return hashlib.sha1(encoded_summary).hexdigest()[:16]
+
+def queue_summaries(pipe, summaries, superseded=()):
+    """
+    Adds the persistence commands for a batch of summaries to a pipeline:
+    every summary is appended to its project's history, folded into the
+    project's rolling statistics and marked as processed, the metadata of a new config version
+    is stored once, and the newest summary of the batch becomes the global latest
+    summary (the summary key only ever holds the latest build) and is published
+    to SUMMARY_CHANNEL for live dashboards. Superseded summaries (see coalesce)
+    are only appended to the history and marked as processed.
+    Call rolling_stats.ensure_loaded() for the batch first and
+    rolling_stats.commit_stats() and summary_schema.commit_metadata() once the
+    pipeline has executed, then project_summaries.update_latest().
+    """
+    for summary in superseded:
+        history_store.queue_history(pipe, summary)
+    dedupe.queue_mark_processed(pipe, superseded)
+    for summary in summaries:
+        history_store.queue_history(pipe, summary)
+    rolling_stats.queue_stats(pipe, summaries)
+    dedupe.queue_mark_processed(pipe, summaries)
+    summary_schema.queue_metadata(pipe, summaries, current_snapshot())
+    if summaries:
+        encoded_summary = codec.encode(summaries[-1])
+        pipe.set(SUMMARY_REDIS_KEY, encoded_summary)
+        pipe.set(SUMMARY_VERSION_KEY, summary_version(encoded_summary))
+        pipe.publish(SUMMARY_CHANNEL, encoded_summary)
+    return pipe
+
+def persist_summaries(summaries, superseded=()):
+    """Saves the batch results to Redis in one pipelined round trip, then applies history retention."""
+    if not summaries:
+        return
+    started = time.perf_counter()
+    rolling_stats.ensure_loaded(r, summaries)
+    queue_summaries(r.pipeline(transaction=False), summaries, superseded).execute()
+    rolling_stats.commit_stats()
+    summary_schema.commit_metadata()
+    project_summaries.update_latest(r, summaries)
+    record_persisted(summaries, started)
+    history_store.maybe_compact(r, summaries)
+    rolling_stats.maybe_prune(r, summaries)
+
+def health_check():
+    """Sidecar /healthz: Redis reachable and a metrics configuration loaded."""
+    try:
+        r.ping()
+    except redis.exceptions.RedisError as e:
+        return False, f"redis unreachable: {e}"
+    if current_snapshot() is None:
+        return False, "no metrics configuration loaded"
+    return True, "ok"
+
+def start_metrics_sidecar(port=None):
+    """Starts the worker's /metrics and /healthz endpoint with a queue depth gauge."""
+    port = WORKER_METRICS_PORT if port is None else port
+    if not port:
+        return None
+    instrumentation.gauge('worker_queue_depth', "Messages waiting in the Redis queue.",
+                          lambda: settings.queue_length(r))
+    return instrumentation.start_metrics_server(port, health_check)
+
+def request_stop(sig, frame):
+    """SIGTERM handler: finish the batch in progress, then exit (used when the orchestrator scales down)."""
+    global _stop_requested
+    print(f"\n[WORKER] Signal {sig} received. Stopping after the current batch.")
+    _stop_requested = True
 
 def start_worker():
     """
     Starts the worker process, continuously pulling messages from the Redis queue,
-    processing them, and saving the final summary to Redis.
+    processing them in batches, and saving the final summary to Redis.
     """
     print("=====================================================================")
     print("  STARTING WORKER PROCESSOR (Redis Consumer)                         ")
     print("=====================================================================")
     print(f"Worker polling queue: {REDIS_QUEUE}. Saving results to key: {SUMMARY_REDIS_KEY}")
+    print(f"Batch size: {WORKER_BATCH_SIZE}, max linger: {WORKER_BATCH_LINGER_S * 1000:.0f} ms")
     print("Worker is now polling Redis continuously. (Press Ctrl+C to stop)")
+
+    try:
+        r.ping()
+        print("[WORKER] Redis connection established successfully.")
+    except Exception as e:
+        # We allow the worker to proceed here, as the loop handles reconnection attempts.
+        print(f"[WORKER] Redis connection failed: {e}")
+
+    # Pick up metrics_config.json edits without restarting the worker
+    start_config_watcher()
+    start_metrics_sidecar()
+    instrumentation.maybe_start_profiler('worker')
+    signal.signal(signal.SIGTERM, request_stop)
     
-    while True:
+    while not _stop_requested:
         try:
-            # Blocking pop (brpop) waits up to 1 second for a message.
-            message = r.brpop(REDIS_QUEUE, timeout=1) 
-            
-            if message:
-                # Decode the raw message bytes and parse the JSON string
-                raw_data_json = message[1].decode('utf-8')
-                raw_data = json.loads(raw_data_json)
-                
-                print(f"\n[WORKER] Message pulled from Redis. Build ID: {raw_data.get('build_id')}")
-                
-                # --- 2. NORMALIZATION STAGE ---
-                normalized_data = raw_data 
-                print("[WORKER] Normalization complete.")
-                
-                # --- 3. AGGREGATION STAGE ---
-                # Capture the returned summary data
-                final_summary = aggregate_metrics(normalized_data)
-                
-                # --- 4. PERSISTENCE STAGE (THE FIX) ---
-                # Serialize the dictionary and save it to the shared summary key
-                summary_json_string = json.dumps(final_summary)
-                r.set(SUMMARY_REDIS_KEY, summary_json_string)
-                
-                print(f"[WORKER] Successfully saved final summary to Redis key: {SUMMARY_REDIS_KEY}")
-                print("[WORKER] Message processed. Ready for next message.")
-                
-            else:
-                # Timeout occurred (no messages in 1 second), continue polling
-                pass
+            try:
+                raw_messages = next_batch()
+
+                if raw_messages:
+                    print(f"\n[WORKER] Pulled {len(raw_messages)} message(s) from Redis.")
+
+                    summaries, superseded = process_batch(raw_messages)
+
+                    # --- 4. PERSISTENCE STAGE ---
+                    persist_summaries(summaries, superseded)
+
+                    if summaries:
+                        print(f"[WORKER] Saved summary for build {summaries[-1].get('build_id')} to Redis key: {SUMMARY_REDIS_KEY}")
+                    print(f"[WORKER] Batch processed ({len(summaries)} build(s)). Ready for next batch.")
+
+                else:
+                    # Timeout occurred (no messages in 1 second), continue polling
+                    pass
+            finally:
+                finish_batch()
                 
         except redis.exceptions.ConnectionError:
             print("[WORKER] Redis Connection Error. Retrying in 5 seconds.")
             time.sleep(5)
-        except json.JSONDecodeError as e:
-            print(f"[WORKER] JSON Decode Error: {e}. Skipping message.")
         except Exception as e:
             print(f"[WORKER] Worker Unhandled Error: {e}")
             time.sleep(1)
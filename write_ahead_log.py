@@ -0,0 +1,148 @@
+import os
+import struct
+import threading
+import time
+
+# --- CONFIGURATION ---
+# Directory holding the log segments of this ingestion process
+WAL_DIR = os.getenv('WAL_DIR', 'ingestion_wal')
+# A segment is closed and a new one started once it grows past this size
+WAL_SEGMENT_MAX_BYTES = int(os.getenv('WAL_SEGMENT_MAX_BYTES', 4 * 1024 * 1024))
+# fsync after every append: survives a host crash, at the cost of one disk flush per request
+WAL_FSYNC = os.getenv('WAL_FSYNC', '1') == '1'
+# Drain retry delays while Redis stays unreachable
+WAL_DRAIN_BACKOFF_INITIAL_S = 0.5
+WAL_DRAIN_BACKOFF_MAX_S = 30.0
+
+SEGMENT_SUFFIX = '.wal'
+# Each record is framed by its length, so binary (e.g. MessagePack) payloads are stored as-is
+_FRAME = struct.Struct('>I')
+
+class WriteAheadLog:
+    """
+    Append-only, segmented on-disk log of encoded payloads (length-prefixed records).
+    Payloads are appended while Redis is unavailable and replayed into the queue
+    segment by segment, oldest first; a segment is deleted only after its whole
+    content was queued, so a crash at any point loses nothing (a replayed segment
+    may be queued twice).
+    """
+
+    def __init__(self, directory=WAL_DIR, segment_max_bytes=WAL_SEGMENT_MAX_BYTES, fsync=WAL_FSYNC):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        # Continue numbering after segments left by a previous run
+        self._next_sequence = int(segments[-1][:-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+        # Kept in memory so the request path can check for a backlog without touching the disk
+        self._pending = bool(segments)
+
+    def segments(self):
+        """Segment file names, oldest first."""
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def has_pending(self):
+        """True while any appended payload has not been replayed yet."""
+        return self._pending
+
+    def _open_segment(self):
+        name = f"{self._next_sequence:012d}{SEGMENT_SUFFIX}"
+        self._next_sequence += 1
+        self._file = open(os.path.join(self.directory, name), 'ab')
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, payloads):
+        """Durably appends encoded payloads (bytes) to the active segment, rotating it when full."""
+        data = b''.join(_FRAME.pack(len(payload)) + payload for payload in payloads)
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_max_bytes:
+                self._close_segment()
+            self._pending = True
+        self._wakeup.set()
+
+    def _read_segment(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            data = f.read()
+        payloads = []
+        offset = 0
+        while offset + _FRAME.size <= len(data):
+            (length,) = _FRAME.unpack_from(data, offset)
+            end = offset + _FRAME.size + length
+            if end > len(data):
+                # Torn write after a crash: the record was never acknowledged
+                break
+            payloads.append(data[offset + _FRAME.size:end])
+            offset = end
+        return payloads
+
+    def drain(self, push):
+        """
+        Replays segments oldest first. push(payloads) must queue the whole list
+        atomically or raise; the segment is deleted after a successful push.
+        Returns the number of replayed payloads. Exceptions from push propagate.
+        """
+        replayed = 0
+        while True:
+            with self._lock:
+                segments = self.segments()
+                if not segments:
+                    self._pending = False
+                    return replayed
+                name = segments[0]
+                if self._file is not None and os.path.basename(self._file.name) == name:
+                    # Only the active segment is left: close it so appends go to a new one
+                    self._close_segment()
+            payloads = self._read_segment(name)
+            if payloads:
+                push(payloads)
+            os.remove(os.path.join(self.directory, name))
+            replayed += len(payloads)
+
+    def _run(self, push, can_drain):
+        backoff = WAL_DRAIN_BACKOFF_INITIAL_S
+        while True:
+            if not self.has_pending():
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                if can_drain():
+                    replayed = self.drain(push)
+                    if replayed:
+                        print(f"[WAL] Replayed {replayed} spooled payload(s) into the queue.")
+                    backoff = WAL_DRAIN_BACKOFF_INITIAL_S
+                    continue
+            except Exception as e:
+                print(f"[WAL] Drain failed, retrying in {backoff:.1f}s: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, WAL_DRAIN_BACKOFF_MAX_S)
+
+    def start_drain_thread(self, push, can_drain=lambda: True):
+        """
+        Starts the background thread that replays the log whenever it has pending
+        segments. can_drain() is checked before each pass (e.g. queue below its
+        high-water mark); failed passes are retried with exponential backoff.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(push, can_drain),
+                                            name='wal-drain', daemon=True)
+            self._thread.start()
+            pending = self.segments()
+            if pending:
+                print(f"[WAL] {len(pending)} segment(s) from a previous run pending replay in {self.directory}.")
+        return self._thread